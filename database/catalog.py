@@ -0,0 +1,158 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import sqlite3
+import pathlib
+import threading
+from typing import Dict, List, Tuple, Union
+
+
+class GalleryCatalog:
+    """
+        persistent index of the gallery, identities, image paths, image hashes and embedding files
+        are kept in a sqlite database in WAL mode so readers in other processes are not blocked
+    """
+    FILENAME = 'catalog.sqlite3'
+
+    __schema = [
+        "CREATE TABLE IF NOT EXISTS identities (name TEXT PRIMARY KEY, dir TEXT, npy TEXT)",
+        "CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, identity TEXT NOT NULL, hash TEXT)",
+        "CREATE INDEX IF NOT EXISTS images_identity ON images (identity)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE IF NOT EXISTS folders (dir TEXT PRIMARY KEY, mtime TEXT)",
+    ]
+
+    def __init__(self, db_path):
+        """
+        :param db_path: folder of the catalog file, keep it outside the scanned gallery root since sqlite
+                        creates and deletes its -wal and -shm files next to it
+        """
+        self._path = pathlib.Path(db_path).joinpath(self.FILENAME)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self._path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            for statement in self.__schema:
+                self._conn.execute(statement)
+
+    def __repr__(self):
+        return f"GalleryCatalog: {self._path}"
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def get_meta(self, key: str, default: Union[str, None] = None) -> Union[str, None]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key: str, value) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def sync(self, ids_dict: Dict[str, Tuple[List[str], List[str]]], dirs: Dict[str, str]) -> None:
+        """
+        replace the catalog with a parsed gallery, hashes of the unchanged paths are kept
+        :param ids_dict: identity name -> (image paths, npy paths) like ImageDatabase.parse
+        :param dirs: identity name -> identity folder
+        :return: None
+        """
+        with self._lock, self._conn:
+            hashes = dict(self._conn.execute("SELECT path, hash FROM images WHERE hash IS NOT NULL").fetchall())
+            self._conn.execute("DELETE FROM images")
+            self._conn.execute("DELETE FROM identities")
+            self._conn.executemany("INSERT OR REPLACE INTO identities (name, dir, npy) VALUES (?, ?, ?)",
+                                   [(name, dirs.get(name), nps[0] if nps else None)
+                                    for name, (_, nps) in ids_dict.items()])
+            self._conn.executemany("INSERT OR REPLACE INTO images (path, identity, hash) VALUES (?, ?, ?)",
+                                   [(p, name, hashes.get(p)) for name, (images, _) in ids_dict.items()
+                                    for p in images])
+
+    def add_images(self, name: str, directory: str, paths: List[str]) -> None:
+        """
+        register new images of an identity, the identity is created when it does not exist
+        :param name: identity name
+        :param directory: identity folder
+        :param paths: image paths
+        :return: None
+        """
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO identities (name, dir, npy) VALUES (?, ?, NULL)",
+                               (name, directory))
+            self._conn.executemany("INSERT OR REPLACE INTO images (path, identity, hash) VALUES (?, ?, NULL)",
+                                   [(p, name) for p in paths])
+
+    def folders(self) -> Dict[str, str]:
+        """
+        :return: gallery folder -> mtime of the last scan
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT dir, mtime FROM folders").fetchall())
+
+    def set_folders(self, folders: Dict[str, str]) -> None:
+        """
+        replace the folder mtimes of the last scan
+        :param folders: gallery folder -> mtime
+        :return: None
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM folders")
+            self._conn.executemany("INSERT INTO folders (dir, mtime) VALUES (?, ?)",
+                                   [(d, str(m)) for d, m in folders.items()])
+
+    def set_npy(self, name: str, npy: Union[str, None]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE identities SET npy = ? WHERE name = ?", (npy, name))
+
+    def set_hashes(self, hashes: Dict[str, str]) -> None:
+        """
+        :param hashes: image path -> content hash
+        :return: None
+        """
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE images SET hash = ? WHERE path = ?",
+                                   [(h, p) for p, h in hashes.items()])
+
+    def identities(self) -> Dict[str, Tuple[List[str], List[str]]]:
+        """
+        :return: identity name -> (image paths, npy paths) like ImageDatabase.parse
+        """
+        with self._lock:
+            names = self._conn.execute("SELECT name, npy FROM identities ORDER BY name").fetchall()
+            images = self._conn.execute("SELECT identity, path FROM images ORDER BY path").fetchall()
+        ids_dict = {name: ([], [npy] if npy else []) for name, npy in names}
+        for name, path in images:
+            ids_dict[name][0].append(path)
+        return ids_dict
+
+    def dirs(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT name, dir FROM identities ORDER BY name").fetchall())
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT name FROM identities ORDER BY name").fetchall()]
+
+    def has_identity(self, name: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM identities WHERE name = ?", (name,)).fetchone() is not None
+
+    def npy_paths(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT name, npy FROM identities WHERE npy IS NOT NULL ORDER BY name").fetchall())
+
+    def is_stable(self) -> bool:
+        """
+        :return: True when there is at least one identity and every identity has an embedding file
+        """
+        with self._lock:
+            total, missing = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(npy IS NULL), 0) FROM identities").fetchone()
+        return total > 0 and missing == 0
@@ -3,7 +3,6 @@ from __future__ import absolute_import
 from __future__ import division
 
 import os
-import json
 import pathlib
 import configparser
 from typing import Tuple
@@ -13,8 +12,12 @@ import numpy as np
 from itertools import chain
 from sklearn import preprocessing
 from .utils import extract_filename, tabulate_print
-from recognition.utils import create_random_name
+from recognition.utils import create_random_name, facenet_model_path
 from .npy_builder import builder
+from .manifest import BuildManifest
+from .snapshot import GallerySnapshot
+from .catalog import GalleryCatalog
+from v2.core.distance import IVFIndex, QuantizedEngine
 from PIL import ImageOps
 from settings import IMAGE_CONF, GALLERY_CONF
 
@@ -101,14 +104,14 @@ class Image:
 
 class Identity:
     __slots__ = ['_name', '_images']
-    identities_name = []
+    identities_name = set()
 
     def __init__(self, name: str):
         self._name = name
         self._images = []
 
     def __del__(self):
-        Identity.identities_name.remove(self._name)
+        Identity.identities_name.discard(self._name)
 
     @classmethod
     def create(cls, name):
@@ -120,8 +123,8 @@ class Identity:
 
     @classmethod
     def add_new_id(cls, name: str) -> tuple:
-        status = True if name in cls.identities_name else False
-        cls.identities_name.append(name)
+        status = name in cls.identities_name
+        cls.identities_name.add(name)
         return name, status
 
     @classmethod
@@ -130,7 +133,7 @@ class Identity:
         this method reset class state
         :return: None
         """
-        cls.identities_name = []
+        cls.identities_name = set()
 
     def add_image(self, im_path):
         """
@@ -165,49 +168,123 @@ class Identity:
 
 
 class ImageDatabase:
-    __slots__ = ['_identities', '_db_path', '_db_json_path']
+    __slots__ = ['_db_path', '_catalog', '_catalog_path', '_snapshot_path']
     COMMITTED = 'committed'
     MODIFIED = "modified"
 
     def __init__(self, db_path):
         self._db_path = db_path
-        self._identities = list()
-        self._db_json_path = self._gen_json_filename()
-        if not self._db_json_path.exists():
-            self.initiate_conf_file()
+        pathlib.Path(self._db_path).mkdir(parents=True, exist_ok=True)
+        # next to the snapshot, sqlite files inside the gallery root would show up as gallery changes
+        self._catalog_path = pathlib.Path(self._db_path).parent.joinpath('catalog')
+        self._catalog_path.mkdir(parents=True, exist_ok=True)
+        self._catalog = GalleryCatalog(self._catalog_path)
+        self._snapshot_path = pathlib.Path(self._db_path).parent.joinpath('snapshot')
         self.update()
 
-    def build_npy(self):
-        base = pathlib.Path(self._db_path)
+    def build_npy(self, full: bool = False):
+        """
+        embed the gallery images, only new or modified images are embedded unless full is set
+        :param full: rebuild every identity
+        :return: None
+        """
+        ids_dict = self.rescan()
+        dirs = self._catalog.dirs()
         ids = []
-        for ch in base.glob('**'):
-            ids_dict = dict()
-            if ch.stem != base.stem:
-                ids_dict['npy'] = os.path.join(str(ch), ch.stem + '.npy')
-                ids_dict['name'] = ch.stem
-                images = []
-                for p in ch.glob('**/*.jpg'):
-                    images.append(Image(im_path=str(p)))
-                ids_dict['images'] = images
-                ids.append(ids_dict)
-
-        builder(ids)
+        for name, (images, _) in ids_dict.items():
+            ids.append({'npy': os.path.join(dirs[name], name + '.npy'), 'name': name,
+                        'images': [Image(im_path=p) for p in images]})
+
+        # the model of the active backend, switching between pb and tflite embeds every identity again
+        manifest = BuildManifest(self._db_path, facenet_model_path(), reset=full)
+        builder(ids, manifest)
+        for a in ids:
+            self._catalog.set_npy(a['name'], a['npy'] if os.path.isfile(a['npy']) else None)
+            self._catalog.set_hashes(manifest.image_hashes(a['name'], os.path.dirname(a['npy'])))
         self.commit()
         print("$ embedding matrices had been created.")
+        version = self.build_snapshot()
+        print(f"$ gallery snapshot v{version} had been created at {self._snapshot_path}")
+
+    def build_snapshot(self) -> int:
+        """
+        consolidate identity npy files into one versioned snapshot
+        :return: snapshot version
+        """
+        embeds, labels = self.bulk_embeddings()
+        version = GallerySnapshot.write(self._snapshot_path, embeds, labels)
+        snapshot = GallerySnapshot.open(self._snapshot_path)
+        if snapshot.embeddings.shape[0] >= int(GALLERY_CONF.get("ann_min_size")):
+            IVFIndex(similarity_threshold=0.).fit(snapshot.embeddings).save(snapshot.index_path)
+            print(f"$ ann index had been created at {snapshot.index_path}")
+        codec = GALLERY_CONF.get("quantization")
+        if codec != "none":
+            quantized = QuantizedEngine(similarity_threshold=0., codec=codec,
+                                        pq_subspaces=int(GALLERY_CONF.get("pq_subspaces")))
+            quantized.fit(snapshot.embeddings).save(snapshot.quantized_path)
+            print(f"$ {codec} gallery ({quantized.nbytes} bytes) had been created at {snapshot.quantized_path}")
+        self._catalog.set_meta('snapshot', version)
+        return version
+
+    def load_gallery(self):
+        """
+        load gallery embeddings, encoded labels and label encoder, the memory mapped snapshot is
+        preferred and identity npy files are used when there is no snapshot
+        :return: embeddings, labels, label encoder
+        """
+        snapshot = GallerySnapshot.open(self._snapshot_path)
+        if snapshot is not None:
+            return snapshot.embeddings, snapshot.labels, snapshot.label_encoder
+
+        embeds, labels = self.bulk_embeddings()
+        encoded_labels = preprocessing.LabelEncoder()
+        encoded_labels.fit(list(set(labels)))
+        return embeds, encoded_labels.transform(labels), encoded_labels
+
+    def gallery_version(self):
+        """
+        version key of the committed gallery, the snapshot version is preferred and the commit
+        revision of the catalog is used when there is no snapshot
+        :return: version key or None when the gallery is modified and not committed yet
+        """
+        version = GallerySnapshot.current_version(self._snapshot_path)
+        if version:
+            return f"snapshot:{version}"
+        if self.check() != self.COMMITTED:
+            return None
+        return f"commit:{self._catalog.get_meta('revision', '0')}"
+
+    @property
+    def snapshot_path(self) -> pathlib.Path:
+        return self._snapshot_path
+
+    @property
+    def index_path(self):
+        return GallerySnapshot.current_index_path(self._snapshot_path)
+
+    @property
+    def quantized_path(self):
+        return GallerySnapshot.current_quantized_path(self._snapshot_path)
+
+    @property
+    def catalog(self) -> GalleryCatalog:
+        return self._catalog
 
     def get_identity_image_paths(self):
-        return {iden.name: iden.get_images_path() for iden in self._identities}
+        return {name: (Image(im_path=p) for p in images) for name, (images, _) in self.parse().items()}
 
     def add_identity(self, iden: Identity):
-        self._identities.append(iden)
+        self._catalog.add_images(iden.name, os.path.join(self._db_path, iden.name),
+                                 [im.image_path for im in iden.get_images_path()])
 
-    def parse(self):
+    def _scan(self):
         """
-        parse Gallery set
-        :return:
+        walk the gallery folders
+        :return: identity name -> (image paths, npy paths) and identity name -> folder
         """
         base = pathlib.Path(self._db_path)
         ids_dict = dict()
+        dirs = dict()
         for ch in base.glob('**'):
             if ch.stem != base.stem:
                 images = list()
@@ -217,20 +294,40 @@ class ImageDatabase:
                 for p in ch.glob('**/*.npy'):
                     nps.append(str(p))
                 ids_dict[ch.stem] = (images, nps)
+                dirs[ch.stem] = str(ch)
+
+        return ids_dict, dirs
+
+    def _folders(self):
+        """
+        :return: gallery folder -> mtime, a folder changes when an image is added to or removed from it
+        """
+        base = pathlib.Path(self._db_path)
+        return {str(ch): str(os.stat(ch).st_mtime_ns) for ch in base.glob('**') if ch.stem != base.stem}
 
+    def rescan(self):
+        """
+        walk the gallery folders and synchronize the catalog
+        :return: identity name -> (image paths, npy paths)
+        """
+        ids_dict, dirs = self._scan()
+        self._catalog.sync(ids_dict, dirs)
+        self._catalog.set_folders(self._folders())
         return ids_dict
 
+    def parse(self):
+        """
+        parse Gallery set from the catalog
+        :return: identity name -> (image paths, npy paths)
+        """
+        return self._catalog.identities()
+
     def _parse_npy(self):
         """
-        extract npy file from folders
+        extract npy file of identities from the catalog
         :return:
         """
-        base = pathlib.Path(self._db_path)
-        ids_dict = dict()
-        for ch in base.glob('**'):
-            if ch.stem != base.stem:
-                ids_dict[ch.stem] = str(list(ch.glob('**/*.npy'))[0])
-        return ids_dict
+        return self._catalog.npy_paths()
 
     def _load_npy(self):
         ids = self._parse_npy()
@@ -249,62 +346,45 @@ class ImageDatabase:
         except ValueError:
             return np.empty((0, 512)),labels
 
-    def _gen_json_filename(self):
-        base = pathlib.Path(self._db_path)
-        return base.joinpath('conf.json')
-
-    def initiate_conf_file(self):
-        temp = dict()
-        temp['data'] = dict()
-        temp['commit'] = False
-        self._write_json_file(temp)
-
-    def load_json_file(self):
-        with open(self._db_json_path, 'r') as infile:
-            conf_file = json.load(infile)
-        return conf_file
-
-    def _write_json_file(self, conf_dic: dict):
-        with open(self._db_json_path, 'w') as outfile:
-            json.dump(conf_dic, outfile)
-
     def check(self):
-        conf_file = self.load_json_file()
-        if conf_file.get('commit'):
+        if self._catalog.get_meta('commit') == '1':
             return self.COMMITTED
         else:
             return self.MODIFIED
 
-    def update(self):
-        if self.check() == self.MODIFIED:
-            conf_data = dict()
-            conf_data['data'] = self.parse()
-            conf_data['commit'] = True
-            self._write_json_file(conf_data)
-            self._in_memory_load()
-        else:
-            self._in_memory_load()
+    @staticmethod
+    def _changed(ids_dict, cataloged):
+        """
+        :param ids_dict: scanned identity name -> (image paths, npy paths)
+        :param cataloged: identity name -> (image paths, npy paths) of the catalog
+        :return: identities whose images or embedding file differ
+        """
+        changed = set(ids_dict).symmetric_difference(cataloged)
+        for name in set(ids_dict).intersection(cataloged):
+            images, nps = ids_dict[name]
+            c_images, c_nps = cataloged[name]
+            if set(images) != set(c_images) or bool(nps) != bool(c_nps) or not set(c_nps).issubset(nps):
+                changed.add(name)
+        return sorted(changed)
 
-    def _in_memory_load(self):
-        conf_data = self.load_json_file()
-        data = conf_data.get('data')
+    def update(self):
+        """
+        synchronize the catalog when a gallery folder changed, only the folders are checked on start and
+        the gallery is modified when the images or embedding files of an identity differ from the catalog
+        :return: None
+        """
+        if self._catalog.get_meta('commit') is not None and self._catalog.folders() == self._folders():
+            return
 
-        for key, value in data.items():
-            tm_id = Identity.create(key)
-            if tm_id is not None:
-                for im_path in chain(value):
-                    tm_id.add_image(im_path)
-                self._identities.append(tm_id)
+        cataloged = self._catalog.identities()
+        ids_dict = self.rescan()
+        if self._catalog.get_meta('commit') is None:
+            self.commit()
+        elif self._changed(ids_dict, cataloged):
+            self.modify()
 
     def is_db_stable(self):
-        status = True
-        has_min_person = False
-        for key, value in self.parse().items():
-            has_min_person = True
-            if not value[1]:
-                status = False
-                break
-        return status and has_min_person
+        return self._catalog.is_stable()
 
     def save_clusters(self, clusters, faces, cluster_name):
         """
@@ -318,11 +398,15 @@ class ImageDatabase:
         if not os.path.exists(base_path):
             os.makedirs(base_path)
 
+        saved = []
         for key, value in clusters.items():
             idx = np.random.choice(value)
             post = create_random_name(max_length=6)
             save_path = os.path.join(base_path, f"image_{key}_{idx}_{post}.jpg")
             faces[idx].save(save_path)
+            saved.append(os.path.join(self._db_path, cluster_name, os.path.basename(save_path)))
+        self._catalog.add_images(cluster_name, os.path.join(self._db_path, cluster_name), saved)
+        self._catalog.set_folders(self._folders())
         self.modify()
         print(f"$ Images saved at {base_path}")
 
@@ -344,24 +428,20 @@ class ImageDatabase:
 
         return images_list, labels, label_encoder
 
-    @staticmethod
-    def check_name_exists(name) -> bool:
+    def check_name_exists(self, name) -> bool:
         """
         check a new identity name
         :param name:
         :return:
         """
-        return True if name in Identity.identities_name else False
+        return self._catalog.has_identity(name)
 
     def modify(self):
-        data = self.load_json_file()
-        data['commit'] = False
-        self._write_json_file(data)
+        self._catalog.set_meta('commit', 0)
 
     def commit(self):
-        data = self.load_json_file()
-        data['commit'] = True
-        self._write_json_file(data)
+        self._catalog.set_meta('revision', int(self._catalog.get_meta('revision', '0')) + 1)
+        self._catalog.set_meta('commit', 1)
 
 
 def inference_db(args):
@@ -373,7 +453,10 @@ def inference_db(args):
         tabulate_print(db.parse())
 
     elif args.db_build_npy:
-        db.build_npy()
+        db.build_npy(full=args.db_full_build)
+
+    elif args.db_rescan:
+        print(f"$ {len(db.rescan())} identities had been indexed in {db.catalog.path}")
 
 
 def parse_test_dir(dir_path):
@@ -0,0 +1,188 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import hashlib
+import pathlib
+from typing import Dict, List, Union
+
+import numpy as np
+
+HASH_CHUNK = 1 << 20
+
+
+def file_hash(path) -> str:
+    """
+    sha1 of a file content, a directory (e.g. a checkpoint) is hashed file by file in sorted order
+    :param path: file or directory path
+    :return: hex digest
+    """
+    path = pathlib.Path(path)
+    sha = hashlib.sha1()
+    files = sorted(p for p in path.glob('**/*') if p.is_file()) if path.is_dir() else [path]
+    for p in files:
+        with open(p, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(HASH_CHUNK), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+class IdentityPlan:
+    """
+        rebuild plan of one identity, rows of the previous matrix which are kept and images which
+        have to be embedded again
+    """
+    __slots__ = ['_name', '_npy', '_keep_rows', '_changed', '_order', '_images', '_deleted']
+
+    def __init__(self, name: str, npy: str, keep_rows: List[int], changed: list, order: List[str],
+                 images: Dict[str, dict], deleted: int):
+        self._name = name
+        self._npy = npy
+        self._keep_rows = keep_rows
+        self._changed = changed
+        self._order = order
+        self._images = images
+        self._deleted = deleted
+
+    def __repr__(self):
+        return f"IdentityPlan: {self._name} keep {len(self._keep_rows)} embed {len(self._changed)} " \
+               f"drop {self._deleted}"
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def npy(self) -> str:
+        return self._npy
+
+    @property
+    def changed(self) -> list:
+        return self._changed
+
+    @property
+    def order(self) -> List[str]:
+        return self._order
+
+    @property
+    def images(self) -> Dict[str, dict]:
+        return self._images
+
+    @property
+    def is_clean(self) -> bool:
+        return not self._changed and not self._deleted and self._keep_rows == list(range(len(self._keep_rows))) \
+            and os.path.isfile(self._npy)
+
+    def merge(self, embedded: Union[np.ndarray, None]) -> np.ndarray:
+        """
+        kept rows of the previous matrix followed by the new embeddings, in the order of plan.order
+        :param embedded: embeddings of the changed images in shape (c,m)
+        :return: matrix in shape (n,m)
+        """
+        parts = []
+        if os.path.isfile(self._npy):
+            parts.append(np.load(self._npy)[np.array(self._keep_rows, dtype=np.int64)])
+        if embedded is not None and len(embedded):
+            parts.append(np.asarray(embedded))
+        return np.concatenate(parts, axis=0)
+
+
+class BuildManifest:
+    """
+        content hashes of the embedded gallery images and the hash of the model which embedded them,
+        the row i of an identity npy file belongs to the i-th image of its order list
+    """
+    FILENAME = 'manifest.json'
+
+    def __init__(self, db_path, model_path, reset: bool = False):
+        """
+        :param db_path: gallery directory
+        :param model_path: embedding model file or directory
+        :param reset: forget the previous build so every identity is embedded again
+        """
+        self._path = pathlib.Path(db_path).joinpath(self.FILENAME)
+        self._data = {"model": None, "identities": dict()} if reset else self._load()
+        self._model_hash = file_hash(model_path)
+
+    def _load(self) -> dict:
+        if not self._path.is_file():
+            return {"model": None, "identities": dict()}
+        with open(self._path, 'r') as infile:
+            return json.load(infile)
+
+    @property
+    def model_changed(self) -> bool:
+        return self._data.get("model") != self._model_hash
+
+    def _image_record(self, im_path: str, previous: Union[dict, None]) -> dict:
+        """
+        hash record of an image, the previous hash is reused when size and mtime did not change
+        :param im_path: image path
+        :param previous: previous record
+        :return: record dictionary
+        """
+        stat = os.stat(im_path)
+        if previous is not None and previous.get("size") == stat.st_size and \
+                previous.get("mtime") == stat.st_mtime_ns:
+            return previous
+        return {"hash": file_hash(im_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def plan(self, identity: dict) -> IdentityPlan:
+        """
+        compare the images of an identity with the manifest
+        :param identity: dictionary with name, npy and images keys like the builder input
+        :return: IdentityPlan
+        """
+        base = os.path.dirname(identity['npy'])
+        previous = self._data["identities"].get(identity['name'])
+        if previous is None or self.model_changed or not os.path.isfile(identity['npy']):
+            previous = {"order": [], "images": dict()}
+
+        prev_rows = {key: i for i, key in enumerate(previous["order"])}
+        images = dict()
+        keep_rows, order, changed = [], [], []
+        for im in identity['images']:
+            key = pathlib.Path(os.path.relpath(im.image_path, base)).as_posix()
+            record = self._image_record(im.image_path, previous["images"].get(key))
+            images[key] = record
+            if key in prev_rows and previous["images"][key].get("hash") == record["hash"]:
+                keep_rows.append(prev_rows[key])
+                order.append(key)
+            else:
+                changed.append(im)
+
+        order += [pathlib.Path(os.path.relpath(im.image_path, base)).as_posix() for im in changed]
+        deleted = len(previous["order"]) - len(keep_rows)
+        return IdentityPlan(identity['name'], identity['npy'], keep_rows, changed, order, images, deleted)
+
+    def image_hashes(self, name: str, base: str) -> Dict[str, str]:
+        """
+        content hashes of the embedded images of an identity
+        :param name: identity name
+        :param base: identity folder
+        :return: image path -> hash
+        """
+        images = self._data["identities"].get(name, dict()).get("images", dict())
+        return {str(pathlib.Path(base).joinpath(key)): record.get("hash") for key, record in images.items()}
+
+    def update(self, plan: IdentityPlan) -> None:
+        self._data["identities"][plan.name] = {"order": plan.order, "images": plan.images}
+
+    def prune(self, names: List[str]) -> None:
+        """
+        drop identities which are not in the gallery any more
+        :param names: current identity names
+        :return: None
+        """
+        names = set(names)
+        for name in [n for n in self._data["identities"] if n not in names]:
+            del self._data["identities"][name]
+
+    def save(self) -> None:
+        self._data["model"] = self._model_hash
+        tmp_path = self._path.with_name(self.FILENAME + '.tmp')
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self._data, outfile)
+        os.replace(str(tmp_path), str(self._path))
@@ -6,34 +6,115 @@ import os
 import configparser
 from settings import BASE_DIR
 from itertools import chain
-from .utils import load_images
+from .pipeline import EmbeddingPipeline
 import numpy as np
+from typing import Callable, List, Union
 from settings import MODEL_CONF
+from .manifest import BuildManifest, IdentityPlan
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 import tensorflow as tf
-from recognition.utils import load_model
-
-
-def builder(ids):
-    physical_devices = tf.config.list_physical_devices('GPU')
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
-
-    with tf.Graph().as_default():
-        with tf.compat.v1.Session() as sess:
-            print(f"$ Initializing computation graph with {MODEL_CONF.get('facenet')} pretrained model.")
-            load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
-            print("$ Model has been loaded.")
-
-            input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
-            embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
-            phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
-
-            for a in chain(ids):
-                images = load_images(a["images"])
-                images = np.array(list(images))
-                feed_dic = {phase_train: False, input_plc: images}
-                embedded_array = sess.run(embeddings, feed_dic)
-                np.save(a['npy'], embedded_array)
-                print(f"$ [OK] {a['name']} -> {a['npy']}")
\ No newline at end of file
+from recognition.utils import load_model, load_lite_facenet
+from v2.tools import inference_device
+
+
+def builder(ids, manifest: Union[BuildManifest, None] = None):
+    """
+    embed identity images into npy files, with a manifest only the new or modified images are
+    embedded and only the affected identity files are rewritten
+    :param ids: list of dictionaries with name, npy and images keys
+    :param manifest: BuildManifest of the gallery or None for a full rebuild
+    :return: None
+    """
+    if manifest is not None:
+        if manifest.model_changed:
+            print("$ model has been changed, every identity is stale.")
+        manifest.prune([a['name'] for a in ids])
+        plans = [manifest.plan(a) for a in ids]
+        stale = [p for p in plans if not p.is_clean]
+        print(f"$ {len(plans) - len(stale)} identities are up to date, {len(stale)} identities are stale.")
+    else:
+        stale = None
+
+    if stale is not None and not any(p.changed for p in stale):
+        # nothing to embed, the model is not loaded
+        _rewrite(stale, manifest, None)
+        return
+
+    # cpu backend, no session is needed
+    lite = load_lite_facenet()
+    if lite is not None:
+        print(f"$ {MODEL_CONF.get('facenet_backend')} lite model has been loaded.")
+        _embed_identities(EmbeddingPipeline(None, None, None, None, model=lite), ids, stale, manifest)
+        return
+
+    device = inference_device(MODEL_CONF.get("device"))
+
+    with tf.device(device):
+        with tf.Graph().as_default():
+            with tf.compat.v1.Session() as sess:
+                print(f"$ Initializing computation graph with {MODEL_CONF.get('facenet')} pretrained model.")
+                load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
+                print("$ Model has been loaded.")
+
+                input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
+                embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
+                phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
+
+                pipeline = EmbeddingPipeline(sess, input_plc, embeddings, phase_train)
+                _embed_identities(pipeline, ids, stale, manifest)
+
+
+def _embed_identities(pipeline: EmbeddingPipeline, ids, stale: Union[List[IdentityPlan], None],
+                      manifest: Union[BuildManifest, None]) -> None:
+    """
+    :param pipeline: EmbeddingPipeline of the loaded model
+    :param ids: list of dictionaries with name, npy and images keys
+    :param stale: plans of the stale identities or None for a full rebuild
+    :param manifest: BuildManifest of the gallery or None
+    :return: None
+    """
+
+    def embed(images):
+        return pipeline.embed(images, loader=lambda im: im.read_image_file())
+
+    if stale is not None:
+        _rewrite(stale, manifest, embed)
+        return
+
+    # every identity is embedded in one stream of batches and split afterwards
+    ids = list(chain(ids))
+    embedded_array = embed([im for a in ids for im in a["images"]])
+    splits = np.cumsum([len(a["images"]) for a in ids])[:-1]
+    for a, vectors in zip(ids, np.split(embedded_array, splits)):
+        np.save(a['npy'], vectors)
+        print(f"$ [OK] {a['name']} -> {a['npy']}")
+
+
+def _rewrite(plans: List[IdentityPlan], manifest: BuildManifest, embed: Union[Callable, None]) -> None:
+    """
+    rewrite stale identity files and save the manifest
+    :param plans: plans of the stale identities
+    :param manifest: BuildManifest
+    :param embed: callable(images) which returns embeddings
+    :return: None
+    """
+    changed = [im for plan in plans for im in plan.changed]
+    embedded_array = embed(changed) if changed else None
+    offset = 0
+
+    for plan in plans:
+        if not plan.order:
+            # every image is deleted, an empty matrix keeps the identity folder parsable
+            if os.path.isfile(plan.npy):
+                np.save(plan.npy, np.load(plan.npy)[:0])
+            manifest.update(plan)
+            print(f"$ [EMPTY] {plan.name}")
+            continue
+        vectors = embedded_array[offset:offset + len(plan.changed)] if plan.changed else None
+        offset += len(plan.changed)
+        np.save(plan.npy, plan.merge(vectors))
+        manifest.update(plan)
+        print(f"$ [OK] {plan.name} -> {plan.npy} ({len(plan.changed)} embedded)")
+    manifest.save()
@@ -0,0 +1,121 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Union
+
+import numpy as np
+from settings import GALLERY_CONF
+
+_END = object()
+
+
+class EmbeddingPipeline:
+    """
+        batched embedding of a large image set, images are decoded and prewhitened by a thread pool
+        into a bounded queue of fixed size batches so inference of a batch overlaps with decoding
+        of the next ones
+    """
+
+    def __init__(self, sess, input_plc, embeddings, phase_train, batch_size: Union[int, None] = None,
+                 workers: Union[int, None] = None, prefetch: Union[int, None] = None, model=None):
+        """
+        :param sess: tensorflow session
+        :param input_plc: input placeholder of the embedding model
+        :param embeddings: embedding tensor
+        :param phase_train: phase train placeholder
+        :param batch_size: images per sess.run, embed_batch_size of the gallery config by default
+        :param workers: decode threads, embed_workers of the gallery config by default
+        :param prefetch: decoded batches waiting for inference, embed_prefetch of the gallery config by default
+        :param model: LiteFaceNetModel which replaces the session, the tensors are not used then
+        """
+        self._model = model
+        self._sess = sess
+        self._input_plc = input_plc
+        self._embeddings = embeddings
+        self._phase_train = phase_train
+        self._batch_size = int(GALLERY_CONF.get("embed_batch_size")) if batch_size is None else batch_size
+        self._workers = int(GALLERY_CONF.get("embed_workers")) if workers is None else workers
+        self._prefetch = int(GALLERY_CONF.get("embed_prefetch")) if prefetch is None else prefetch
+        self._rate = 0.
+
+    @property
+    def rate(self) -> float:
+        """
+        images per second of the last embed call
+        """
+        return self._rate
+
+    @staticmethod
+    def _put(batches: queue.Queue, item, stop: threading.Event) -> bool:
+        # a timed put, so the producer gives up once the consumer has stopped
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, items: list, loader: Union[Callable, None], batches: queue.Queue,
+                 stop: threading.Event) -> None:
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers) as pool:
+                for start in range(0, len(items), self._batch_size):
+                    chunk = items[start:start + self._batch_size]
+                    batch = list(pool.map(loader, chunk)) if loader is not None else chunk
+                    if not self._put(batches, np.stack(batch), stop):
+                        return
+        except Exception as e:
+            if not self._put(batches, e, stop):
+                return
+        self._put(batches, _END, stop)
+
+    def embed(self, items: List, loader: Union[Callable, None] = None) -> np.ndarray:
+        """
+        embed items batch by batch
+        :param items: images, or already preprocessed arrays when loader is None
+        :param loader: callable(item) which returns a preprocessed image array
+        :return: matrix in shape (n,m)
+        """
+        items = list(items)
+        if self._model is not None:
+            dim = self._model.embedding_size
+        else:
+            dim = self._embeddings.get_shape().as_list()[-1] or 0
+        if not items:
+            return np.empty((0, dim), dtype=np.float32)
+
+        start = time.perf_counter()
+        batches = queue.Queue(maxsize=max(1, self._prefetch))
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(items, loader, batches, stop), daemon=True)
+        producer.start()
+
+        embedded = []
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if self._model is not None:
+                    embedded.append(self._model.embed(batch))
+                    continue
+                feed_dic = {self._phase_train: False, self._input_plc: batch}
+                embedded.append(self._sess.run(self._embeddings, feed_dic))
+        finally:
+            # the producer may wait on a full queue when the inference failed
+            stop.set()
+            while not batches.empty():
+                batches.get_nowait()
+            producer.join()
+
+        self._rate = len(items) / max(time.perf_counter() - start, 1e-9)
+        print(f"$ {len(items)} images embedded at {self._rate:.1f} images/sec")
+        return np.concatenate(embedded, axis=0)
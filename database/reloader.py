@@ -0,0 +1,115 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import logging
+import threading
+from typing import Callable, Union
+
+import numpy as np
+from sklearn import preprocessing
+from settings import GALLERY_CONF
+
+
+class GalleryState:
+    """
+        immutable view of one gallery version, a frame reads every field from the same state
+    """
+    __slots__ = ['_version', '_embeddings', '_labels', '_label_encoder', '_matcher']
+
+    def __init__(self, version, embeddings: np.ndarray, labels: np.ndarray,
+                 label_encoder: preprocessing.LabelEncoder, matcher=None):
+        self._version = version
+        self._embeddings = embeddings
+        self._labels = np.asarray(labels)
+        self._label_encoder = label_encoder
+        self._matcher = matcher
+
+    def __repr__(self):
+        return f"GalleryState: {self._version} {self._embeddings.shape}"
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self._embeddings
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._labels
+
+    @property
+    def label_encoder(self) -> preprocessing.LabelEncoder:
+        return self._label_encoder
+
+    @property
+    def matcher(self):
+        return self._matcher
+
+
+class GalleryReloader(threading.Thread):
+    """
+        watch the gallery version of a database and rebuild the gallery state on this background
+        thread, the new state is published by a single reference assignment so a frame never sees
+        a half loaded gallery
+    """
+
+    def __init__(self, database, interval: Union[float, None] = None, build_matcher: Union[Callable, None] = None,
+                 on_reload: Union[Callable, None] = None, logger: Union[logging.Logger, None] = None):
+        """
+        :param database: ImageDatabase
+        :param interval: polling interval in seconds, reload_interval of the gallery config by default,
+                         0 disables reloading
+        :param build_matcher: callable(embeddings, labels) which returns a fitted matcher
+        :param on_reload: callable(GalleryState) called after a new state is published
+        :param logger: logger of the service which receives the failed reloads, a module logger by default
+        """
+        super(GalleryReloader, self).__init__(daemon=True)
+        self._database = database
+        self._interval = float(GALLERY_CONF.get("reload_interval")) if interval is None else interval
+        self._build_matcher = build_matcher
+        self._on_reload = on_reload
+        self._logger = logging.getLogger(__name__) if logger is None else logger
+        self._stop_event = threading.Event()
+        self._state = self._load(self._database.gallery_version())
+
+    def _load(self, version) -> GalleryState:
+        embeds, labels, encoder = self._database.load_gallery()
+        matcher = self._build_matcher(embeds, labels) if self._build_matcher is not None else None
+        return GalleryState(version, embeds, labels, encoder, matcher)
+
+    @property
+    def state(self) -> GalleryState:
+        return self._state
+
+    def check(self) -> bool:
+        """
+        reload the gallery when a new committed version exists
+        :return: True if a new state is published
+        """
+        version = self._database.gallery_version()
+        if version is None or version == self._state.version:
+            return False
+        state = self._load(version)
+        self._state = state
+        if self._on_reload is not None:
+            self._on_reload(state)
+        return True
+
+    def start(self) -> None:
+        if self._interval > 0:
+            super(GalleryReloader, self).start()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self._interval):
+            try:
+                self.check()
+            except Exception as e:
+                # e.g. the gallery is being written or the matcher can not be fitted, the current state
+                # is kept and the next poll tries again
+                self._logger.warning(f"[Reload] gallery reload failed, keeping {self._state.version}: {e!r}")
+
+    def stop(self) -> None:
+        self._stop_event.set()
@@ -0,0 +1,198 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import shutil
+import pathlib
+from datetime import datetime
+from typing import List, Union
+
+import numpy as np
+from sklearn import preprocessing
+
+
+class GallerySnapshot:
+    """
+        versioned and consolidated gallery, the embedding matrix and the label array are opened
+        as memory maps so several server processes on one box share the same pages
+    """
+    MANIFEST = 'snapshot.json'
+    EMBEDDINGS = 'embeddings.npy'
+    LABELS = 'labels.npy'
+    IDENTITIES = 'identities.json'
+    INDEX = 'ivf'
+    QUANTIZED = 'quantized'
+
+    def __init__(self, root_path, version: int, embeddings: np.ndarray, labels: np.ndarray, identities: List[str]):
+        self._root_path = pathlib.Path(root_path)
+        self._version = version
+        self._embeddings = embeddings
+        self._labels = labels
+        self._identities = np.array(identities)
+
+    def __repr__(self):
+        return f"GallerySnapshot: v{self._version} {self._embeddings.shape}"
+
+    @staticmethod
+    def _version_dir(root_path: pathlib.Path, version: int) -> pathlib.Path:
+        return root_path.joinpath(f"v{version:06d}")
+
+    @classmethod
+    def read_manifest(cls, root_path) -> Union[dict, None]:
+        """
+        read the manifest of the current snapshot
+        :param root_path: snapshot root directory
+        :return: manifest dictionary or None if there is no snapshot
+        """
+        manifest_path = pathlib.Path(root_path).joinpath(cls.MANIFEST)
+        if not manifest_path.is_file():
+            return None
+        with open(manifest_path, 'r') as infile:
+            return json.load(infile)
+
+    @classmethod
+    def current_index_path(cls, root_path) -> Union[pathlib.Path, None]:
+        """
+        path of the approximate nearest neighbour index of the current snapshot
+        :param root_path: snapshot root directory
+        :return: path or None if there is no snapshot
+        """
+        manifest = cls.read_manifest(root_path)
+        if manifest is None:
+            return None
+        return pathlib.Path(root_path).joinpath(manifest.get('path'), cls.INDEX)
+
+    @classmethod
+    def current_quantized_path(cls, root_path) -> Union[pathlib.Path, None]:
+        """
+        path of the compressed gallery of the current snapshot
+        :param root_path: snapshot root directory
+        :return: path or None if there is no snapshot
+        """
+        manifest = cls.read_manifest(root_path)
+        if manifest is None:
+            return None
+        return pathlib.Path(root_path).joinpath(manifest.get('path'), cls.QUANTIZED)
+
+    @classmethod
+    def current_version(cls, root_path) -> int:
+        manifest = cls.read_manifest(root_path)
+        return 0 if manifest is None else int(manifest.get('version'))
+
+    @classmethod
+    def write(cls, root_path, embeds: np.ndarray, names: List[str], keep: int = 2) -> int:
+        """
+        write a new snapshot version, the manifest is swapped after all files are on the disk
+        :param root_path: snapshot root directory
+        :param embeds: matrix in shape (n,m)
+        :param names: identity name of each row in shape (n,)
+        :param keep: number of previous versions kept for processes that still map them
+        :return: new version
+        """
+        root_path = pathlib.Path(root_path)
+        root_path.mkdir(parents=True, exist_ok=True)
+        version = cls.current_version(root_path) + 1
+        version_dir = cls._version_dir(root_path, version)
+        version_dir.mkdir(parents=True, exist_ok=True)
+
+        # identities are sorted to stay compatible with sklearn LabelEncoder
+        encoder = preprocessing.LabelEncoder()
+        encoder.fit(names)
+        labels = encoder.transform(names).astype(np.int32) if len(names) else np.empty((0,), dtype=np.int32)
+
+        embeds = np.asarray(embeds, dtype=np.float32)
+        norm = np.linalg.norm(embeds, axis=1, keepdims=True)
+        embeds = np.divide(embeds, np.maximum(norm, np.finfo(np.float32).tiny))
+
+        np.save(str(version_dir.joinpath(cls.EMBEDDINGS)), np.ascontiguousarray(embeds))
+        np.save(str(version_dir.joinpath(cls.LABELS)), labels)
+        with open(version_dir.joinpath(cls.IDENTITIES), 'w') as outfile:
+            json.dump({"data": [str(c) for c in encoder.classes_]}, outfile)
+
+        manifest = {
+            "version": version,
+            "path": version_dir.name,
+            "size": int(embeds.shape[0]),
+            "dim": int(embeds.shape[1]),
+            "identities": int(len(encoder.classes_)),
+            "created": datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
+        }
+        tmp_path = root_path.joinpath(cls.MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as outfile:
+            json.dump(manifest, outfile)
+        os.replace(str(tmp_path), str(root_path.joinpath(cls.MANIFEST)))
+
+        cls._prune(root_path, version, keep)
+        return version
+
+    @classmethod
+    def _prune(cls, root_path: pathlib.Path, version: int, keep: int) -> None:
+        for ch in root_path.glob('v*'):
+            try:
+                if ch.is_dir() and int(ch.name[1:]) < version - keep:
+                    shutil.rmtree(str(ch))
+            except (ValueError, OSError):
+                # a mapped version can not be removed on some platforms, it is removed next time
+                pass
+
+    @classmethod
+    def open(cls, root_path) -> Union["GallerySnapshot", None]:
+        """
+        open the current snapshot as read only memory maps
+        :param root_path: snapshot root directory
+        :return: GallerySnapshot or None if there is no snapshot
+        """
+        root_path = pathlib.Path(root_path)
+        manifest = cls.read_manifest(root_path)
+        if manifest is None:
+            return None
+
+        version_dir = root_path.joinpath(manifest.get('path'))
+        if manifest.get('size'):
+            embeds = np.load(str(version_dir.joinpath(cls.EMBEDDINGS)), mmap_mode='r')
+            labels = np.load(str(version_dir.joinpath(cls.LABELS)), mmap_mode='r')
+        else:
+            # empty arrays can not be memory mapped
+            embeds = np.empty((0, int(manifest.get('dim'))), dtype=np.float32)
+            labels = np.empty((0,), dtype=np.int32)
+
+        with open(version_dir.joinpath(cls.IDENTITIES), 'r') as infile:
+            identities = json.load(infile).get('data')
+
+        return cls(root_path, int(manifest.get('version')), embeds, labels, identities)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def index_path(self) -> pathlib.Path:
+        return self._version_dir(self._root_path, self._version).joinpath(self.INDEX)
+
+    @property
+    def quantized_path(self) -> pathlib.Path:
+        return self._version_dir(self._root_path, self._version).joinpath(self.QUANTIZED)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self._embeddings
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self._labels
+
+    @property
+    def identities(self) -> np.ndarray:
+        return self._identities
+
+    @property
+    def label_encoder(self) -> preprocessing.LabelEncoder:
+        """
+        label encoder restored from the identity table without fitting again
+        :return: LabelEncoder
+        """
+        encoder = preprocessing.LabelEncoder()
+        encoder.classes_ = self._identities
+        return encoder
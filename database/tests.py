@@ -2,10 +2,19 @@ import os
 import configparser
 from settings import BASE_DIR
 import unittest
-from component import Image, Identity
+from component import Image, Identity, ImageDatabase
+from snapshot import GallerySnapshot
+from reloader import GalleryReloader
+from manifest import BuildManifest
+from pipeline import EmbeddingPipeline
+from catalog import GalleryCatalog
 import utils
+from recognition.utils import facenet_model_path, lite_facenet_path
 from itertools import chain
 import random
+import tempfile
+import time
+import numpy as np
 
 
 class DatabaseModule(unittest.TestCase):
@@ -57,7 +66,7 @@ class DatabaseModule(unittest.TestCase):
         for iden in chain(identities):
             iden.add_image(random.choice(images))
 
-        self.assertEqual(Identity.identities_name, names)
+        self.assertEqual(Identity.identities_name, set(names))
 
         self.assertEqual(Identity.create(names[0]), None)
 
@@ -67,7 +76,292 @@ class DatabaseModule(unittest.TestCase):
 
         del identities[0]
 
-        self.assertNotEqual(Identity.identities_name, names)
+        self.assertNotEqual(Identity.identities_name, set(names))
+
+
+class ImageDatabaseTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = os.path.join(tempfile.mkdtemp(), "gallery")
+        os.makedirs(os.path.join(self.root, "reza"))
+        self._touch(os.path.join(self.root, "reza", "1.jpg"))
+
+    @staticmethod
+    def _touch(path):
+        with open(path, 'wb') as outfile:
+            outfile.write(b'')
+
+    def test_reopen_committed_gallery(self):
+        db = ImageDatabase(db_path=self.root)
+        self.assertEqual(db.check(), ImageDatabase.COMMITTED)
+        db.commit()
+        db.catalog.close()
+        self.assertFalse(os.path.exists(os.path.join(self.root, GalleryCatalog.FILENAME)))
+
+        db = ImageDatabase(db_path=self.root)
+        self.assertEqual(db.check(), ImageDatabase.COMMITTED)
+        db.catalog.close()
+
+    def test_image_of_existing_identity_modifies(self):
+        ImageDatabase(db_path=self.root).catalog.close()
+        self._touch(os.path.join(self.root, "reza", "2.jpg"))
+        db = ImageDatabase(db_path=self.root)
+        self.assertEqual(db.check(), ImageDatabase.MODIFIED)
+        self.assertEqual(len(db.parse()["reza"][0]), 2)
+        db.catalog.close()
+
+
+class GallerySnapshotTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.embeds = np.random.random((6, 512))
+        self.names = ['reza', 'armin', 'reza', 'alireza', 'armin', 'reza']
+
+    def test_open_without_snapshot(self):
+        self.assertEqual(GallerySnapshot.open(self.root), None)
+        self.assertEqual(GallerySnapshot.current_version(self.root), 0)
+
+    def test_write_and_open_snapshot(self):
+        version = GallerySnapshot.write(self.root, self.embeds, self.names)
+        snapshot = GallerySnapshot.open(self.root)
+        self.assertEqual(snapshot.version, version)
+        self.assertTrue(isinstance(snapshot.embeddings, np.memmap))
+        self.assertEqual(snapshot.embeddings.shape, (6, 512))
+        self.assertEqual(snapshot.embeddings.dtype, np.float32)
+        np.testing.assert_allclose(np.linalg.norm(snapshot.embeddings, axis=1), 1., atol=1e-5)
+        self.assertEqual(list(snapshot.label_encoder.inverse_transform(snapshot.labels)), self.names)
+
+    def test_write_increase_version(self):
+        first = GallerySnapshot.write(self.root, self.embeds, self.names)
+        second = GallerySnapshot.write(self.root, self.embeds[:2], self.names[:2])
+        self.assertEqual(second, first + 1)
+        self.assertEqual(GallerySnapshot.open(self.root).embeddings.shape, (2, 512))
+
+    def test_write_empty_snapshot(self):
+        GallerySnapshot.write(self.root, np.empty((0, 512)), [])
+        snapshot = GallerySnapshot.open(self.root)
+        self.assertEqual(snapshot.embeddings.shape, (0, 512))
+        self.assertEqual(snapshot.labels.shape, (0,))
+
+
+class SnapshotDatabase:
+    """
+        database double which serves the gallery from a snapshot root
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def gallery_version(self):
+        version = GallerySnapshot.current_version(self.root)
+        return f"snapshot:{version}" if version else None
+
+    def load_gallery(self):
+        snapshot = GallerySnapshot.open(self.root)
+        return snapshot.embeddings, snapshot.labels, snapshot.label_encoder
+
+
+class GalleryReloaderTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.embeds = np.random.random((6, 512))
+        self.names = ['reza', 'armin', 'reza', 'alireza', 'armin', 'reza']
+        GallerySnapshot.write(self.root, self.embeds, self.names)
+
+    def test_reload_new_version(self):
+        reloaded = []
+        reloader = GalleryReloader(SnapshotDatabase(self.root), interval=0,
+                                   build_matcher=lambda embeds, labels: (embeds.shape[0], len(labels)),
+                                   on_reload=reloaded.append)
+        first = reloader.state
+        self.assertEqual(first.matcher, (6, 6))
+        self.assertFalse(reloader.check())
+
+        GallerySnapshot.write(self.root, self.embeds[:2], self.names[:2])
+        self.assertTrue(reloader.check())
+        self.assertEqual(reloader.state.version, "snapshot:2")
+        self.assertEqual(reloader.state.matcher, (2, 2))
+        self.assertEqual(reloaded, [reloader.state])
+        # a state which is held by a frame is not modified by the swap
+        self.assertEqual(first.embeddings.shape, (6, 512))
+
+    def test_failed_reload_keeps_polling(self):
+        calls = []
+
+        def build_matcher(embeds, labels):
+            calls.append(embeds.shape[0])
+            if len(calls) == 2:
+                raise KeyError("broken gallery")
+            return embeds.shape[0]
+
+        reloader = GalleryReloader(SnapshotDatabase(self.root), interval=0.05, build_matcher=build_matcher)
+        reloader.start()
+        GallerySnapshot.write(self.root, self.embeds[:3], self.names[:3])
+        for _ in range(100):
+            if reloader.state.matcher == 3:
+                break
+            time.sleep(0.05)
+        reloader.stop()
+        self.assertEqual(reloader.state.matcher, 3)
+        self.assertGreaterEqual(len(calls), 3)
+
+    def test_background_thread(self):
+        reloader = GalleryReloader(SnapshotDatabase(self.root), interval=0.05)
+        reloader.start()
+        GallerySnapshot.write(self.root, self.embeds[:3], self.names[:3])
+        for _ in range(100):
+            if reloader.state.version == "snapshot:2":
+                break
+            time.sleep(0.05)
+        reloader.stop()
+        self.assertEqual(list(reloader.state.label_encoder.inverse_transform(reloader.state.labels)),
+                         self.names[:3])
+
+
+class BuildManifestTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.model = os.path.join(self.root, "model.pb")
+        with open(self.model, 'wb') as outfile:
+            outfile.write(b"model-v1")
+        self.id_dir = os.path.join(self.root, "reza")
+        os.makedirs(self.id_dir)
+        for i in range(3):
+            self._write_image(i, b"image-%d" % i)
+
+    def _write_image(self, i, content):
+        with open(os.path.join(self.id_dir, f"{i}.jpg"), 'wb') as outfile:
+            outfile.write(content)
+
+    def _identity(self):
+        images = [Image(im_path=os.path.join(self.id_dir, f)) for f in sorted(os.listdir(self.id_dir))
+                  if f.endswith('.jpg')]
+        return {"name": "reza", "npy": os.path.join(self.id_dir, "reza.npy"), "images": images}
+
+    def _build(self, manifest):
+        """
+        fake embedding, the first value of a row is the image index
+        """
+        plan = manifest.plan(self._identity())
+        embedded = np.array([[float(os.path.basename(im.image_path)[0])] * 4 for im in plan.changed])
+        np.save(plan.npy, plan.merge(embedded))
+        manifest.update(plan)
+        manifest.save()
+        return plan
+
+    def test_only_changed_images_are_embedded(self):
+        plan = self._build(BuildManifest(self.root, self.model))
+        self.assertEqual(len(plan.changed), 3)
+        self.assertTrue(BuildManifest(self.root, self.model).plan(self._identity()).is_clean)
+
+        self._write_image(1, b"image-1-modified")
+        self._write_image(3, b"image-3")
+        os.remove(os.path.join(self.id_dir, "0.jpg"))
+        plan = self._build(BuildManifest(self.root, self.model))
+        self.assertEqual(sorted(os.path.basename(im.image_path) for im in plan.changed), ["1.jpg", "3.jpg"])
+        self.assertEqual(plan.order, ["2.jpg", "1.jpg", "3.jpg"])
+        np.testing.assert_array_equal(np.load(plan.npy)[:, 0], [2., 1., 3.])
+
+    def test_model_change_marks_everything_stale(self):
+        self._build(BuildManifest(self.root, self.model))
+        with open(self.model, 'wb') as outfile:
+            outfile.write(b"model-v2")
+        manifest = BuildManifest(self.root, self.model)
+        self.assertTrue(manifest.model_changed)
+        self.assertEqual(len(manifest.plan(self._identity()).changed), 3)
+
+    def test_backend_switch_marks_everything_stale(self):
+        self.assertEqual(facenet_model_path("int8"), lite_facenet_path("int8"))
+        self.assertNotEqual(facenet_model_path("pb"), facenet_model_path("int8"))
+        self._build(BuildManifest(self.root, self.model))
+        lite = os.path.join(self.root, "facenet_int8.tflite")
+        with open(lite, 'wb') as outfile:
+            outfile.write(b"tflite-int8")
+        manifest = BuildManifest(self.root, lite)
+        self.assertTrue(manifest.model_changed)
+        self.assertEqual(len(manifest.plan(self._identity()).changed), 3)
+
+
+class EmbeddingPipelineTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        import tensorflow as tf
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.input_plc = tf.compat.v1.placeholder(tf.float32, shape=(None, 4), name="input")
+            self.phase_train = tf.compat.v1.placeholder(tf.bool, shape=(), name="phase_train")
+            self.embeddings = tf.multiply(self.input_plc, 2., name="embeddings")
+        self.sess = tf.compat.v1.Session(graph=self.graph)
+
+    def tearDown(self) -> None:
+        self.sess.close()
+
+    def test_embed_in_fixed_batches(self):
+        pipeline = EmbeddingPipeline(self.sess, self.input_plc, self.embeddings, self.phase_train,
+                                     batch_size=3, workers=2, prefetch=1)
+        items = list(range(10))
+        embedded = pipeline.embed(items, loader=lambda i: np.full((4,), i, dtype=np.float32))
+        np.testing.assert_array_equal(embedded[:, 0], np.arange(10) * 2.)
+        self.assertGreater(pipeline.rate, 0.)
+
+    def test_embed_empty_and_failing_loader(self):
+        pipeline = EmbeddingPipeline(self.sess, self.input_plc, self.embeddings, self.phase_train,
+                                     batch_size=3, workers=2, prefetch=1)
+        self.assertEqual(pipeline.embed([]).shape, (0, 4))
+
+        def loader(i):
+            raise IOError("broken image")
+        with self.assertRaises(IOError):
+            _ = pipeline.embed([1, 2], loader=loader)
+
+    def test_failing_inference_stops_producer(self):
+        class Model:
+            embedding_size = 4
+
+            def embed(self, batch):
+                raise RuntimeError("inference failed")
+        pipeline = EmbeddingPipeline(None, None, None, None, batch_size=1, workers=1, prefetch=1, model=Model())
+        with self.assertRaises(RuntimeError):
+            _ = pipeline.embed([np.zeros((4,), dtype=np.float32)] * 10)
+
+
+class GalleryCatalogTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.catalog = GalleryCatalog(self.root)
+        self.ids_dict = {
+            'reza': (['reza/1.jpg', 'reza/2.jpg'], ['reza/reza.npy']),
+            'armin': (['armin/1.jpg'], [])
+        }
+        self.catalog.sync(self.ids_dict, {'reza': 'reza', 'armin': 'armin'})
+
+    def tearDown(self) -> None:
+        self.catalog.close()
+
+    def test_sync_and_query(self):
+        self.assertEqual(self.catalog.identities(), self.ids_dict)
+        self.assertEqual(self.catalog.npy_paths(), {'reza': 'reza/reza.npy'})
+        self.assertTrue(self.catalog.has_identity('armin'))
+        self.assertFalse(self.catalog.is_stable())
+        self.catalog.set_npy('armin', 'armin/armin.npy')
+        self.assertTrue(self.catalog.is_stable())
+
+    def test_add_images_and_keep_hashes(self):
+        self.catalog.set_hashes({'reza/1.jpg': 'abc'})
+        self.catalog.add_images('ali', 'ali', ['ali/1.jpg'])
+        self.assertEqual(self.catalog.identities()['ali'], (['ali/1.jpg'], []))
+        self.assertEqual(self.catalog.dirs()['ali'], 'ali')
+
+        self.catalog.sync(self.ids_dict, {'reza': 'reza', 'armin': 'armin'})
+        self.assertFalse(self.catalog.has_identity('ali'))
+        with self.catalog._conn:
+            row = self.catalog._conn.execute("SELECT hash FROM images WHERE path = 'reza/1.jpg'").fetchone()
+        self.assertEqual(row[0], 'abc')
+
+    def test_meta_and_wal_mode(self):
+        self.assertEqual(self.catalog.get_meta('commit'), None)
+        self.catalog.set_meta('commit', 1)
+        reader = GalleryCatalog(self.root)
+        self.assertEqual(reader.get_meta('commit'), '1')
+        self.assertEqual(reader._conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        reader.close()
 
 
 if __name__ == "__main__":
@@ -3,12 +3,16 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import time
+import threading
 
 import cv2
 import numpy as np
 import tensorflow as tf
 from six import string_types, iteritems
 
+from v2.tools import non_max_suppression
+
 
 def layer(op):
     def layer_decorated(self, *args, **kwargs):
@@ -251,21 +255,28 @@ class ONet(Network):
          .fc(10, relu=False, name='conv6-3'))
 
 
-def create_mtcnn(sess):
+def create_mtcnn(sess, graph_path=None):
     model_path, _ = os.path.split(os.path.realpath(__file__))
 
-    with tf.compat.v1.variable_scope('pnet'):
-        data = tf.compat.v1.placeholder(tf.float32, (None, None, None, 3), 'input')
-        pnet = PNet({'data': data})
-        pnet.load(os.path.join(model_path, 'det1.npy'), sess)
-    with tf.compat.v1.variable_scope('rnet'):
-        data = tf.compat.v1.placeholder(tf.float32, (None, 24, 24, 3), 'input')
-        rnet = RNet({'data': data})
-        rnet.load(os.path.join(model_path, 'det2.npy'), sess)
-    with tf.compat.v1.variable_scope('onet'):
-        data = tf.compat.v1.placeholder(tf.float32, (None, 48, 48, 3), 'input')
-        onet = ONet({'data': data})
-        onet.load(os.path.join(model_path, 'det3.npy'), sess)
+    if graph_path is not None and os.path.isfile(graph_path):
+        # frozen stages of the optimized graph keep the tensor names of the built ones
+        with tf.compat.v1.gfile.GFile(graph_path, 'rb') as f:
+            graph_def = tf.compat.v1.GraphDef()
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name='')
+    else:
+        with tf.compat.v1.variable_scope('pnet'):
+            data = tf.compat.v1.placeholder(tf.float32, (None, None, None, 3), 'input')
+            pnet = PNet({'data': data})
+            pnet.load(os.path.join(model_path, 'det1.npy'), sess)
+        with tf.compat.v1.variable_scope('rnet'):
+            data = tf.compat.v1.placeholder(tf.float32, (None, 24, 24, 3), 'input')
+            rnet = RNet({'data': data})
+            rnet.load(os.path.join(model_path, 'det2.npy'), sess)
+        with tf.compat.v1.variable_scope('onet'):
+            data = tf.compat.v1.placeholder(tf.float32, (None, 48, 48, 3), 'input')
+            onet = ONet({'data': data})
+            onet.load(os.path.join(model_path, 'det3.npy'), sess)
 
     pnet_fun = lambda img: sess.run(('pnet/conv4-2/BiasAdd:0', 'pnet/prob1:0'), feed_dict={'pnet/input:0': img})
     rnet_fun = lambda img: sess.run(('rnet/conv5-2/conv5-2:0', 'rnet/prob1:0'), feed_dict={'rnet/input:0': img})
@@ -274,30 +285,65 @@ def create_mtcnn(sess):
     return pnet_fun, rnet_fun, onet_fun
 
 
-def detect_face(img, minsize, pnet, rnet, onet, threshold, factor):
-    # im: input image
-    # minsize: minimum of faces' size
-    # pnet, rnet, onet: caffemodel
-    # threshold: threshold=[th1 th2 th3], th1-3 are three steps's threshold
-    # fastresize: resize img from last scale (using in high-resolution images) if fastresize==true
+def pyramid_scales(h, w, minsize, factor):
+    """
+    scales of the P-Net pyramid of a frame
+    :param h: frame height
+    :param w: frame width
+    :param minsize: minimum of faces' size
+    :param factor: scale factor
+    :return: list of scales, P-Net sees (1, ceil(w*scale), ceil(h*scale), 3) at each one
+    """
     factor_count = 0
-    total_boxes = np.empty((0, 9))
-    points = np.empty(0)
-    h = img.shape[0]
-    w = img.shape[1]
     minl = np.amin([h, w])
     m = 12.0 / minsize
     minl = minl * m
-    # creat scale pyramid
     scales = []
     while minl >= 12:
         scales += [m * np.power(factor, factor_count)]
         minl = minl * factor
         factor_count += 1
+    return scales
 
-    # first stage
-    for j in range(len(scales)):
-        scale = scales[j]
+
+def pyramid_canvas(h, w, scales):
+    """
+    pack the scaled frames of the pyramid into one canvas, shelf by shelf from the largest scale
+    :param h: frame height
+    :param w: frame width
+    :param scales: pyramid_scales of the frame
+    :return: (height, width) of the canvas and (y, x, hs, ws) of each scale inside it, offsets are even
+    so the stride 2 cells of P-Net on a scale land on the cells of the canvas
+    """
+    sizes = [(int(np.ceil(h * scale)), int(np.ceil(w * scale))) for scale in scales]
+    if not sizes:
+        return (0, 0), []
+
+    _even = lambda n: n + (n & 1)
+    width = _even(sizes[0][1]) + (_even(sizes[1][1]) if len(sizes) > 1 else 0)
+    regions = []
+    y, x, shelf = 0, 0, 0
+    for hs, ws in sizes:
+        if x > 0 and x + ws > width:
+            y, x, shelf = y + shelf, 0, 0
+        regions.append((y, x, hs, ws))
+        x += _even(ws)
+        shelf = max(shelf, _even(hs))
+    return (y + shelf, width), regions
+
+
+def _pnet_cells(n):
+    # P-Net cells of a side of n pixels, 3x3 conv, 2x2 pool with stride 2 and two 3x3 convs
+    return (n - 1) // 2 - 4
+
+
+def pnet_scales(img, scales, pnet):
+    """
+    run P-Net once per scale
+    :return: (regression, probability) maps of each scale
+    """
+    h, w = img.shape[0], img.shape[1]
+    for scale in scales:
         hs = int(np.ceil(h * scale))
         ws = int(np.ceil(w * scale))
         im_data = imresample(img, (hs, ws))
@@ -307,18 +353,129 @@ def detect_face(img, minsize, pnet, rnet, onet, threshold, factor):
         out = pnet(img_y)
         out0 = np.transpose(out[0], (0, 2, 1, 3))
         out1 = np.transpose(out[1], (0, 2, 1, 3))
+        yield out0[0, :, :, :].copy(), out1[0, :, :, 1].copy()
+
+
+def pnet_packed(img, scales, pnet):
+    """
+    run P-Net once on the pyramid packed by pyramid_canvas and split its maps back per scale, a cell
+    only sees its own scale, apart from the last row and column of a scale whose side is odd where the
+    pool reads the canvas next to it instead of the padding
+    :return: (regression, probability) maps of each scale
+    """
+    h, w = img.shape[0], img.shape[1]
+    (ch, cw), regions = pyramid_canvas(h, w, scales)
+    canvas = np.zeros((ch, cw, 3), dtype=np.float32)
+    for y, x, hs, ws in regions:
+        canvas[y:y + hs, x:x + ws, :] = (imresample(img, (hs, ws)) - 127.5) * 0.0078125
+
+    out = pnet(np.transpose(np.expand_dims(canvas, 0), (0, 2, 1, 3)))
+    out0 = np.transpose(out[0], (0, 2, 1, 3))
+    out1 = np.transpose(out[1], (0, 2, 1, 3))
+    for y, x, hs, ws in regions:
+        cy, cx, rh, rw = y // 2, x // 2, _pnet_cells(hs), _pnet_cells(ws)
+        yield out0[0, cy:cy + rh, cx:cx + rw, :].copy(), out1[0, cy:cy + rh, cx:cx + rw, 1].copy()
+
+
+_crop_buffers = threading.local()
+
+
+def _timed(timings, stage, fn, *args):
+    if timings is None:
+        return fn(*args)
+    start = time.perf_counter()
+    out = fn(*args)
+    timings[stage] = timings.get(stage, 0.) + time.perf_counter() - start
+    return out
+
+
+def crop_boxes_loop(img, total_boxes, w, h, size):
+    """
+    crop and resize every candidate box on its own, zero padded where the box leaves the frame
+    :return: normalized crops in shape (n,size,size,3), transposed like the input of P-Net
+    """
+    numbox = total_boxes.shape[0]
+    dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(total_boxes.copy(), w, h)
+    tempimg = np.zeros((size, size, 3, numbox))
+    for k in range(0, numbox):
+        tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
+        tmp[dy[k] - 1:edy[k], dx[k] - 1:edx[k], :] = img[y[k] - 1:ey[k], x[k] - 1:ex[k], :]
+        if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
+            tempimg[:, :, :, k] = imresample(tmp, (size, size))
+        else:
+            raise ValueError(f"candidate box {k} is empty on one side")
+    tempimg = (tempimg - 127.5) * 0.0078125
+    return np.transpose(tempimg, (3, 1, 0, 2))
+
+
+def _crop_buffer(size, numbox):
+    # float32 crops of the calling thread, grown on demand and reused by the next call
+    buffers = getattr(_crop_buffers, "buffers", None)
+    if buffers is None:
+        buffers = _crop_buffers.buffers = {}
+    buf = buffers.get(size)
+    if buf is None or buf.shape[0] < numbox:
+        buf = buffers[size] = np.empty((max(numbox, 2 * (0 if buf is None else buf.shape[0])), size, size, 3),
+                                       dtype=np.float32)
+    return buf[:numbox]
+
+
+def crop_boxes(img, total_boxes, w, h, size, out=None):
+    """
+    crop_boxes_loop on a frame converted to float32 and padded once, every box is a slice of it which is resized
+    straight into a float32 buffer of the calling thread, the buffer is reused by the next call
+    :param out: float32 array in shape (n,size,size,3) which receives the crops instead of the buffer
+    :return: normalized crops in shape (n,size,size,3), transposed like the input of P-Net
+    """
+    numbox = total_boxes.shape[0]
+    x1, y1, x2, y2 = [total_boxes[:, i].astype(np.int32) for i in range(4)]
+    if np.any((x2 < x1) ^ (y2 < y1)):
+        raise ValueError("a candidate box is empty on one side")
+
+    # the part of a box outside the frame reads the zero border, every side is padded by its own overhang
+    top, left = int(max(0, 1 - y1.min())), int(max(0, 1 - x1.min()))
+    bottom, right = int(max(0, y2.max() - h)), int(max(0, x2.max() - w))
+    frame = np.asarray(img, dtype=np.float32)
+    if top or bottom or left or right:
+        frame = cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)
+
+    crops = _crop_buffer(size, numbox) if out is None else out
+    for k in range(numbox):
+        tmp = frame[y1[k] - 1 + top:y2[k] + top, x1[k] - 1 + left:x2[k] + left]
+        if tmp.size == 0:
+            crops[k] = 0.
+        else:
+            cv2.resize(tmp, (size, size), dst=crops[k], interpolation=cv2.INTER_AREA)
+    crops -= 127.5
+    crops *= 0.0078125
+    return np.transpose(crops, (0, 2, 1, 3))
+
+
+def _proposals(img, minsize, pnet, threshold, factor, packed, max_candidates=None):
+    """
+    first stage, P-Net candidates of a frame merged over the pyramid and squared, the nms of each
+    scale and the merged one only see the max_candidates best candidates
+    :return: boxes in shape (n,5)
+    """
+    total_boxes = np.empty((0, 9))
+    h = img.shape[0]
+    w = img.shape[1]
+    # creat scale pyramid
+    scales = pyramid_scales(h, w, minsize, factor)
 
-        boxes, _ = generateBoundingBox(out1[0, :, :, 1].copy(), out0[0, :, :, :].copy(), scale, threshold[0])
+    maps = pnet_packed(img, scales, pnet) if packed else pnet_scales(img, scales, pnet)
+    for scale, (reg, prob) in zip(scales, maps):
+        boxes, _ = generateBoundingBox(prob, reg, scale, threshold)
 
         # inter-scale nms
-        pick = nms(boxes.copy(), 0.5, 'Union')
+        pick = nms(boxes.copy(), 0.5, 'Union', max_candidates)
         if boxes.size > 0 and pick.size > 0:
             boxes = boxes[pick, :]
             total_boxes = np.append(total_boxes, boxes, axis=0)
 
     numbox = total_boxes.shape[0]
     if numbox > 0:
-        pick = nms(total_boxes.copy(), 0.7, 'Union')
+        pick = nms(total_boxes.copy(), 0.7, 'Union', max_candidates)
         total_boxes = total_boxes[pick, :]
         regw = total_boxes[:, 2] - total_boxes[:, 0]
         regh = total_boxes[:, 3] - total_boxes[:, 1]
@@ -329,73 +486,182 @@ def detect_face(img, minsize, pnet, rnet, onet, threshold, factor):
         total_boxes = np.transpose(np.vstack([qq1, qq2, qq3, qq4, total_boxes[:, 4]]))
         total_boxes = rerec(total_boxes.copy())
         total_boxes[:, 0:4] = np.fix(total_boxes[:, 0:4]).astype(np.int32)
-        dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(total_boxes.copy(), w, h)
+    return total_boxes
+
+
+def _refine(total_boxes, reg, prob, threshold):
+    """
+    second stage, R-Net outputs of the candidates of a frame
+    :return: boxes in shape (n,5)
+    """
+    out0 = np.transpose(reg)
+    out1 = np.transpose(prob)
+    score = out1[1, :]
+    ipass = np.where(score > threshold)
+    total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)])
+    mv = out0[:, ipass[0]]
+    if total_boxes.shape[0] > 0:
+        pick = nms(total_boxes, 0.7, 'Union')
+        total_boxes = total_boxes[pick, :]
+        total_boxes = bbreg(total_boxes.copy(), np.transpose(mv[:, pick]))
+        total_boxes = rerec(total_boxes.copy())
+    return total_boxes
+
+
+def _output(total_boxes, reg, landmarks, prob, threshold):
+    """
+    third stage, O-Net outputs of the candidates of a frame
+    :return: boxes in shape (n,5) and landmarks in shape (10,n)
+    """
+    out0 = np.transpose(reg)
+    out1 = np.transpose(landmarks)
+    out2 = np.transpose(prob)
+    score = out2[1, :]
+    points = out1
+    ipass = np.where(score > threshold)
+    points = points[:, ipass[0]]
+    total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)])
+    mv = out0[:, ipass[0]]
+
+    w = total_boxes[:, 2] - total_boxes[:, 0] + 1
+    h = total_boxes[:, 3] - total_boxes[:, 1] + 1
+    points[0:5, :] = np.tile(w, (5, 1)) * points[0:5, :] + np.tile(total_boxes[:, 0], (5, 1)) - 1
+    points[5:10, :] = np.tile(h, (5, 1)) * points[5:10, :] + np.tile(total_boxes[:, 1], (5, 1)) - 1
+    if total_boxes.shape[0] > 0:
+        total_boxes = bbreg(total_boxes.copy(), np.transpose(mv))
+        pick = nms(total_boxes.copy(), 0.7, 'Min')
+        total_boxes = total_boxes[pick, :]
+        points = points[:, pick]
+    return total_boxes, points
+
+
+def detect_face(img, minsize, pnet, rnet, onet, threshold, factor, packed=False, batched_crops=True,
+                timings=None, max_candidates=None):
+    # im: input image
+    # minsize: minimum of faces' size
+    # pnet, rnet, onet: caffemodel
+    # threshold: threshold=[th1 th2 th3], th1-3 are three steps's threshold
+    # packed: run P-Net once on the packed pyramid instead of once per scale, see pnet_packed
+    # batched_crops: crop the R-Net and O-Net candidates by crop_boxes instead of crop_boxes_loop
+    # timings: dict which accumulates the seconds of each stage
+    # max_candidates: P-Net candidates given to each nms of the first stage, None for all of them
+    crop = crop_boxes if batched_crops else crop_boxes_loop
+    points = np.empty(0)
+    h = img.shape[0]
+    w = img.shape[1]
+
+    # first stage
+    if timings is not None:
+        pnet = lambda im, _pnet=pnet: _timed(timings, "pnet", _pnet, im)
+    total_boxes = _proposals(img, minsize, pnet, threshold[0], factor, packed, max_candidates)
 
     numbox = total_boxes.shape[0]
     if numbox > 0:
         # second stage
-        tempimg = np.zeros((24, 24, 3, numbox))
-        for k in range(0, numbox):
-            tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
-            tmp[dy[k] - 1:edy[k], dx[k] - 1:edx[k], :] = img[y[k] - 1:ey[k], x[k] - 1:ex[k], :]
-            if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
-                tempimg[:, :, :, k] = imresample(tmp, (24, 24))
-            else:
-                return np.empty()
-        tempimg = (tempimg - 127.5) * 0.0078125
-        tempimg1 = np.transpose(tempimg, (3, 1, 0, 2))
-        out = rnet(tempimg1)
-        out0 = np.transpose(out[0])
-        out1 = np.transpose(out[1])
-        score = out1[1, :]
-        ipass = np.where(score > threshold[1])
-        total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)])
-        mv = out0[:, ipass[0]]
-        if total_boxes.shape[0] > 0:
-            pick = nms(total_boxes, 0.7, 'Union')
-            total_boxes = total_boxes[pick, :]
-            total_boxes = bbreg(total_boxes.copy(), np.transpose(mv[:, pick]))
-            total_boxes = rerec(total_boxes.copy())
+        tempimg1 = _timed(timings, "crop24", crop, img, total_boxes, w, h, 24)
+        out = _timed(timings, "rnet", rnet, tempimg1)
+        total_boxes = _refine(total_boxes, out[0], out[1], threshold[1])
 
     numbox = total_boxes.shape[0]
     if numbox > 0:
         # third stage
         total_boxes = np.fix(total_boxes).astype(np.int32)
-        dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph = pad(total_boxes.copy(), w, h)
-        tempimg = np.zeros((48, 48, 3, numbox))
-        for k in range(0, numbox):
-            tmp = np.zeros((int(tmph[k]), int(tmpw[k]), 3))
-            tmp[dy[k] - 1:edy[k], dx[k] - 1:edx[k], :] = img[y[k] - 1:ey[k], x[k] - 1:ex[k], :]
-            if tmp.shape[0] > 0 and tmp.shape[1] > 0 or tmp.shape[0] == 0 and tmp.shape[1] == 0:
-                tempimg[:, :, :, k] = imresample(tmp, (48, 48))
-            else:
-                return np.empty()
-        tempimg = (tempimg - 127.5) * 0.0078125
-        tempimg1 = np.transpose(tempimg, (3, 1, 0, 2))
-        out = onet(tempimg1)
-        out0 = np.transpose(out[0])
-        out1 = np.transpose(out[1])
-        out2 = np.transpose(out[2])
-        score = out2[1, :]
-        points = out1
-        ipass = np.where(score > threshold[2])
-        points = points[:, ipass[0]]
-        total_boxes = np.hstack([total_boxes[ipass[0], 0:4].copy(), np.expand_dims(score[ipass].copy(), 1)])
-        mv = out0[:, ipass[0]]
-
-        w = total_boxes[:, 2] - total_boxes[:, 0] + 1
-        h = total_boxes[:, 3] - total_boxes[:, 1] + 1
-        points[0:5, :] = np.tile(w, (5, 1)) * points[0:5, :] + np.tile(total_boxes[:, 0], (5, 1)) - 1
-        points[5:10, :] = np.tile(h, (5, 1)) * points[5:10, :] + np.tile(total_boxes[:, 1], (5, 1)) - 1
-        if total_boxes.shape[0] > 0:
-            total_boxes = bbreg(total_boxes.copy(), np.transpose(mv))
-            pick = nms(total_boxes.copy(), 0.7, 'Min')
-            total_boxes = total_boxes[pick, :]
-            points = points[:, pick]
+        tempimg1 = _timed(timings, "crop48", crop, img, total_boxes, w, h, 48)
+        out = _timed(timings, "onet", onet, tempimg1)
+        total_boxes, points = _output(total_boxes, out[0], out[1], out[2], threshold[2])
 
     return total_boxes, points
 
 
+def _crop_frames(images, frame_boxes, size, batched_crops):
+    """
+    crops of the candidates of every frame, one after another in the order of the frames
+    :return: normalized crops in shape (sum n,size,size,3), transposed like the input of P-Net
+    """
+    if not batched_crops:
+        return np.concatenate([crop_boxes_loop(img, boxes, img.shape[1], img.shape[0], size)
+                               for img, boxes in zip(images, frame_boxes) if boxes.shape[0] > 0])
+    crops = _crop_buffer(size, sum(boxes.shape[0] for boxes in frame_boxes))
+    start = 0
+    for img, boxes in zip(images, frame_boxes):
+        if boxes.shape[0] > 0:
+            crop_boxes(img, boxes, img.shape[1], img.shape[0], size, out=crops[start:start + boxes.shape[0]])
+            start += boxes.shape[0]
+    return np.transpose(crops, (0, 2, 1, 3))
+
+
+def _split(out, frame_boxes):
+    # rows of a stage output for each frame
+    offsets = np.cumsum([0] + [boxes.shape[0] for boxes in frame_boxes])
+    return [[o[offsets[i]:offsets[i + 1]] for o in out] for i in range(len(frame_boxes))]
+
+
+def detect_faces(images, minsize, pnet, rnet, onet, threshold, factor, packed=False, batched_crops=True,
+                 timings=None, max_candidates=None):
+    """
+    detect_face on several frames, P-Net runs per frame while R-Net and O-Net see the candidates of
+    all the frames in one batch, the frames may have different sizes
+    :param images: list of frames
+    :return: (boxes, landmarks) of each frame like detect_face
+    """
+    if timings is not None:
+        pnet = lambda im, _pnet=pnet: _timed(timings, "pnet", _pnet, im)
+    frame_boxes = [_proposals(img, minsize, pnet, threshold[0], factor, packed, max_candidates) for img in images]
+    points = [np.empty(0) for _ in images]
+
+    if any(boxes.shape[0] > 0 for boxes in frame_boxes):
+        # second stage
+        crops = _timed(timings, "crop24", _crop_frames, images, frame_boxes, 24, batched_crops)
+        out = _timed(timings, "rnet", rnet, crops)
+        frame_boxes = [boxes if boxes.shape[0] == 0 else _refine(boxes, reg, prob, threshold[1])
+                       for boxes, (reg, prob) in zip(frame_boxes, _split(out, frame_boxes))]
+
+    if any(boxes.shape[0] > 0 for boxes in frame_boxes):
+        # third stage
+        frame_boxes = [np.fix(boxes).astype(np.int32) if boxes.shape[0] > 0 else boxes for boxes in frame_boxes]
+        crops = _timed(timings, "crop48", _crop_frames, images, frame_boxes, 48, batched_crops)
+        out = _timed(timings, "onet", onet, crops)
+        for i, (boxes, (reg, landmarks, prob)) in enumerate(zip(frame_boxes, _split(out, frame_boxes))):
+            if boxes.shape[0] > 0:
+                frame_boxes[i], points[i] = _output(boxes, reg, landmarks, prob, threshold[2])
+
+    return list(zip(frame_boxes, points))
+
+
+def detect_face_rois(img, rois, minsize, pnet, rnet, onet, threshold, factor, packed=False, batched_crops=True,
+                     timings=None, max_candidates=None):
+    """
+    detect_face inside regions of a frame, the regions go through detect_faces so R-Net and O-Net see
+    the candidates of all of them in one batch
+    :param rois: regions in shape (n,4) as (x_min, y_min, x_max, y_max) in pixels of img, they should not overlap
+    :return: (boxes, landmarks) in the coordinates of img like detect_face
+    """
+    rois = np.asarray(rois, dtype=np.int32).reshape(-1, 4)
+    crops = [np.ascontiguousarray(img[y1:y2, x1:x2]) for x1, y1, x2, y2 in rois]
+    detections = detect_faces(crops, minsize, pnet, rnet, onet, threshold, factor, packed=packed,
+                              batched_crops=batched_crops, timings=timings, max_candidates=max_candidates)
+
+    total_boxes, points = [], []
+    for (x1, y1, _, _), (boxes, landmarks) in zip(rois, detections):
+        if boxes.shape[0] > 0:
+            boxes, landmarks = boxes.copy(), landmarks.copy()
+            boxes[:, [0, 2]] += x1
+            boxes[:, [1, 3]] += y1
+            landmarks[0:5, :] += x1
+            landmarks[5:10, :] += y1
+            total_boxes.append(boxes)
+            points.append(landmarks)
+
+    if not total_boxes:
+        return np.empty((0, 5)), np.empty(0)
+    if len(total_boxes) == 1:
+        return total_boxes[0], points[0]
+    # a face on the border of two regions may be found in both
+    total_boxes, points = np.concatenate(total_boxes), np.concatenate(points, axis=1)
+    pick = nms(total_boxes.copy(), 0.7, 'Min')
+    return total_boxes[pick, :], points[:, pick]
+
+
 def bulk_detect_face(images, detection_window_size_ratio, pnet, rnet, onet, threshold, factor):
     # im: input image
     # minsize: minimum of faces' size
@@ -662,37 +928,9 @@ def generateBoundingBox(imap, reg, scale, t):
 
 
 # function pick = nms(boxes,threshold,type)
-def nms(boxes, threshold, method):
-    if boxes.size == 0:
-        return np.empty((0, 3))
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-    s = boxes[:, 4]
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    I = np.argsort(s)
-    pick = np.zeros_like(s, dtype=np.int16)
-    counter = 0
-    while I.size > 0:
-        i = I[-1]
-        pick[counter] = i
-        counter += 1
-        idx = I[0:-1]
-        xx1 = np.maximum(x1[i], x1[idx])
-        yy1 = np.maximum(y1[i], y1[idx])
-        xx2 = np.minimum(x2[i], x2[idx])
-        yy2 = np.minimum(y2[i], y2[idx])
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        if method is 'Min':
-            o = inter / np.minimum(area[i], area[idx])
-        else:
-            o = inter / (area[i] + area[idx] - inter)
-        I = I[np.where(o <= threshold)]
-    pick = pick[0:counter]
-    return pick
+def nms(boxes, threshold, method, max_candidates=None):
+    # pixel inclusive boxes, the scores are the fifth column
+    return non_max_suppression(boxes, boxes[:, 4], threshold, method, offset=1., max_candidates=max_candidates)
 
 
 # function [dy edy dx edx y ey x ex tmpw tmph] = pad(total_boxes,w,h)
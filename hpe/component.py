@@ -94,6 +94,23 @@ class HPE:
         else:
             return np.empty((0, 2))
 
+    def predict_with(self, sess: tf.compat.v1.Session, img: np.ndarray, input_tensor: Tensor, output_tensor: Tensor,
+                     fetches, feed_dict: dict):
+        """
+        predict the tilt and pan together with other fetches of the same graph in one sess.run
+        :param sess: tensorflow session
+        :param img: tensor in shape (m,64,64,1)
+        :param input_tensor:
+        :param output_tensor:
+        :param fetches: other tensors to fetch, e.g. the embeddings
+        :param feed_dict: feed of the other fetches
+        :return: poses in shape (m,2) and the values of fetches
+        """
+        feed_dic = dict(feed_dict)
+        feed_dic[input_tensor] = self.normalize_images(img)
+        poses, values = sess.run([output_tensor, fetches], feed_dict=feed_dic)
+        return self.normalize_pose(poses), values
+
     def get_cropped_pics(self, img: np.ndarray, boxes: np.ndarray, offset_perc: int, cropping: str = '',
                          interpolation=cv2.INTER_LINEAR) -> np.ndarray:
 
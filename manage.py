@@ -4,19 +4,26 @@ import os
 import sys
 from recognition.recognition import face_recognition, face_recognition_on_keras, test_recognition, cluster_faces
 from recognition.recognition import face_recognition_kalman
-from recognition.utils import convert_computation_graph_to_keras_model
+from recognition.utils import convert_computation_graph_to_keras_model, convert_facenet_to_lite
 from server.server import recognition_serv_2, recognition_track_let_serv
 from database.component import inference_db
 from database.sync import generate_id
 from tools.system import system_status
 from tools.download import download_models
 from gui.main import *
-from tools.computation_graph import computation_graph_inspect, pb_to_tensorboard
+from tools.computation_graph import computation_graph_inspect, pb_to_tensorboard, optimize_inference_graphs
 from tools.shadow import add_shadow
-from settings import BASE_DIR
+from tools.benchmark import ann_benchmark, lite_benchmark, threads_benchmark, keras_benchmark, pyramid_benchmark, \
+    detection_benchmark, nms_benchmark, roi_benchmark
+from settings import BASE_DIR, THREADS_CONF
+from v2.tools import ThreadBudget
 
 
 def main(args):
+    # thread pools of tensorflow, opencv and the BLAS of this worker process
+    if args.bench != "threads":
+        ThreadBudget.from_config(THREADS_CONF).apply(worker=args.worker)
+
     if (args.realtime or args.video) and args.server:
         recognition_track_let_serv(args)
     elif (args.realtime or args.video) and args.kalman_tracker:
@@ -31,7 +38,7 @@ def main(args):
     elif (args.realtime or args.video or args.cluster) and args.keras:
         face_recognition_on_keras(args)
 
-    elif args.db_check or args.db_inspect or args.db_build_npy:
+    elif args.db_check or args.db_inspect or args.db_build_npy or args.db_rescan:
         inference_db(args)
 
     elif args.cnv_to_keras:
@@ -42,11 +49,16 @@ def main(args):
         convert_computation_graph_to_keras_model(model_dir=m_path.parent, save_dir=m_path.parent.parent,
                                                  lite=args.cnv_to_lite)
 
+    elif args.cnv_to_lite:
+        convert_facenet_to_lite()
+
     elif args.test:
         test_recognition(args)
 
     elif args.cg:
-        if args.cg_inspect_ops or args.cg_inspect_nodes or args.cg_inspect_vars or args.cg_inspect_tensors or args.cg_inspect_placeholders:
+        if args.cg_optimize:
+            optimize_inference_graphs(args.cg_models or None, repeat=args.bench_repeat)
+        elif args.cg_inspect_ops or args.cg_inspect_nodes or args.cg_inspect_vars or args.cg_inspect_tensors or args.cg_inspect_placeholders:
             flags = {
                 "node": args.cg_inspect_nodes,
                 "ops": args.cg_inspect_ops,
@@ -76,6 +88,30 @@ def main(args):
     elif args.generate_id:
         generate_id(args)
 
+    elif args.bench == "ann":
+        ann_benchmark(args)
+
+    elif args.bench == "lite":
+        lite_benchmark(args)
+
+    elif args.bench == "threads":
+        threads_benchmark(args)
+
+    elif args.bench == "keras":
+        keras_benchmark(args)
+
+    elif args.bench == "pyramid":
+        pyramid_benchmark(args)
+
+    elif args.bench == "detect":
+        detection_benchmark(args)
+
+    elif args.bench == "nms":
+        nms_benchmark(args)
+
+    elif args.bench == "roi":
+        roi_benchmark(args)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -86,7 +122,7 @@ if __name__ == "__main__":
     parser.add_argument('--kalman_tracker', help='use kalman tracker', action='store_true')
     parser.add_argument('--video', help="video recognition flag", action='store_true')
     parser.add_argument('--video_file', help='video filename for recognition', type=str, default="")
-    parser.add_argument('--eval_method', help='evaluation method', choices=['cosine', 'svm', 'euclidean', "cosine_v2"],
+    parser.add_argument('--eval_method', help='evaluation method', choices=['cosine', 'svm', 'euclidean', "cosine_v2", "ann", "prototype", "quantized", "knn"],
                         default='cosine')
     parser.add_argument('--cluster', help="cluster video frame", action='store_true')
     parser.add_argument('--cluster_name', help="cluster name for saving images", type=str, default='')
@@ -97,6 +133,8 @@ if __name__ == "__main__":
     parser.add_argument('--db_check', help='check gallery status', action='store_true')
     parser.add_argument('--db_inspect', help="inspect database status", action='store_true')
     parser.add_argument('--db_build_npy', help='build npy embedding', action='store_true')
+    parser.add_argument('--db_full_build', help='embed every image again with --db_build_npy', action='store_true')
+    parser.add_argument('--db_rescan', help='walk the gallery folders and rebuild the catalog', action='store_true')
     parser.add_argument('--cnv_to_keras', help='convert computation graph to keras', action='store_true')
     parser.add_argument('--cnv_to_lite', help='convert keras to lite', action='store_true')
     parser.add_argument('--test', help="test a prob set on the gallery set", action='store_true')
@@ -109,6 +147,9 @@ if __name__ == "__main__":
     parser.add_argument('--cg_inspect_vars', help="variables in computation graph", action='store_true')
     parser.add_argument('--cg_inspect_tensors', help="tensors in computation graph", action='store_true')
     parser.add_argument('--cg_inspect_placeholders', help="placeholders in computation graph", action='store_true')
+    parser.add_argument('--cg_optimize', help="write pruned and folded inference graphs", action='store_true')
+    parser.add_argument('--cg_models', help="graphs to optimize, all by default", nargs='*',
+                        choices=['facenet', 'hpe', 'mtcnn'], default=None)
     parser.add_argument('--im_mani', help="image manipulation", action='store_true')
     parser.add_argument('--im_darker', help="darker images", action='store_true')
     parser.add_argument('--im_brighter', help="brighter images", action='store_true')
@@ -119,6 +160,18 @@ if __name__ == "__main__":
     parser.add_argument("--scene", help="scenario detail", type=str, default='')
     parser.add_argument("--generate_id", help="generate id", action="store_true")
     parser.add_argument("--debug", help="debug mode or not", action="store_true")
+    parser.add_argument("--fused", help="run head pose and embedding models by one session call",
+                        action="store_true")
+    parser.add_argument("--graph_match", help="match embeddings against the gallery inside the recognition graph",
+                        action="store_true")
+    parser.add_argument("--bench", help="run a benchmark", choices=['ann', 'lite', 'threads', 'keras', 'pyramid',
+                                                                    'detect', 'nms', 'roi'],
+                        default=None)
+    parser.add_argument("--bench_size", help="synthetic gallery size for benchmark", type=int, default=100000)
+    parser.add_argument("--bench_batch", help="probe batch size for benchmark", type=int, default=16)
+    parser.add_argument("--bench_repeat", help="repeat of each benchmark call", type=int, default=20)
+    parser.add_argument("--bench_frames", help="frames of the clip for the threads benchmark", type=int, default=100)
+    parser.add_argument("--worker", help="worker index of this process for the cpu affinity", type=int, default=0)
 
     args = parser.parse_args()
 
@@ -2,18 +2,26 @@ import tensorflow as tf
 from tensorflow.python.framework.ops import Tensor
 from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
 import cv2
+import weakref
 import numpy as np
 from typing import Tuple
 
+from v2.core.network import KerasInference
+from v2.tools import non_max_suppression, NMS_UNION
+
 
 class MaskDetector:
     INPUT_SHAPE = None
 
-    def __init__(self, score_threshold: float, input_shape: Tuple[int, int]):
+    def __init__(self, score_threshold: float, input_shape: Tuple[int, int], keras_inference: str = "traced"):
         self.INPUT_SHAPE = input_shape
         self._score_threshold = score_threshold
+        self._keras_inference = keras_inference
+        # traced call of every model given to predict
+        self._inference = weakref.WeakKeyDictionary()
 
-    def single_class_non_max_suppression(self, bboxes, confidences, conf_thresh=0.2, iou_thresh=0.5, keep_top_k=-1):
+    def single_class_non_max_suppression(self, bboxes, confidences, conf_thresh=0.2, iou_thresh=0.5, keep_top_k=-1,
+                                         max_candidates=None):
         if len(bboxes) == 0: return []
 
         conf_keep_idx = np.where(confidences > conf_thresh)[0]
@@ -21,36 +29,8 @@ class MaskDetector:
         bboxes = bboxes[conf_keep_idx]
         confidences = confidences[conf_keep_idx]
 
-        pick = []
-        xmin = bboxes[:, 0]
-        ymin = bboxes[:, 1]
-        xmax = bboxes[:, 2]
-        ymax = bboxes[:, 3]
-
-        area = (xmax - xmin + 1e-3) * (ymax - ymin + 1e-3)
-        idxs = np.argsort(confidences)
-
-        while len(idxs) > 0:
-            last = len(idxs) - 1
-            i = idxs[last]
-            pick.append(i)
-
-            # keep top k
-            if keep_top_k != -1:
-                if len(pick) >= keep_top_k:
-                    break
-
-            overlap_xmin = np.maximum(xmin[i], xmin[idxs[:last]])
-            overlap_ymin = np.maximum(ymin[i], ymin[idxs[:last]])
-            overlap_xmax = np.minimum(xmax[i], xmax[idxs[:last]])
-            overlap_ymax = np.minimum(ymax[i], ymax[idxs[:last]])
-            overlap_w = np.maximum(0, overlap_xmax - overlap_xmin)
-            overlap_h = np.maximum(0, overlap_ymax - overlap_ymin)
-            overlap_area = overlap_w * overlap_h
-            overlap_ratio = overlap_area / (area[idxs[:last]] + area[i] - overlap_area)
-
-            need_to_be_deleted_idx = np.concatenate(([last], np.where(overlap_ratio > iou_thresh)[0]))
-            idxs = np.delete(idxs, need_to_be_deleted_idx)
+        pick = non_max_suppression(bboxes, confidences, iou_thresh, NMS_UNION, offset=0., eps=1e-3,
+                                   top_k=keep_top_k, max_candidates=max_candidates)
 
         return conf_keep_idx[pick]
 
@@ -60,11 +40,19 @@ class MaskDetector:
 
         return im_mask
 
+    def inference(self, model) -> KerasInference:
+        if isinstance(model, KerasInference):
+            return model
+        infer = self._inference.get(model)
+        if infer is None:
+            infer = self._inference[model] = KerasInference(model, self._keras_inference)
+        return infer
+
     def predict(self, model, img: np.ndarray) -> np.ndarray:
 
         if img.shape[0] > 0:
             img = preprocess_input(img)
-            _pred = model.predict(img)
+            _pred = self.inference(model)(img)
             return _pred
         else:
             return np.empty((0, 1))
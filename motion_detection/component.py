@@ -33,7 +33,12 @@ class BSMotionDetection(BaseMotionDetection, ABC):
         self._counter = Counter(int(MOTION_CONF.get("bg_change_step")))
         self._backgournd = None
 
-    def _run(self, im_frame):
+    def motion_regions(self, im_frame):
+        """
+        bounding rectangles of every moving region
+        :param im_frame: BGR frame
+        :return: list of (x, y, w, h), None when the background is taken from this frame
+        """
         im_frame = cv2.cvtColor(im_frame, cv2.COLOR_BGR2GRAY)
         im_frame = cv2.GaussianBlur(im_frame, (21, 21), 0)
 
@@ -57,23 +62,16 @@ class BSMotionDetection(BaseMotionDetection, ABC):
         elif len(cnts) == 3:
             cnts = cnts[1]
 
-        maximum = -1
-        box = None
-        for c in cnts:
-            # if cv2.contourArea(c) < 100:
-            #     continue
-
-            # (x, y, w, h) = cv2.boundingRect(c)
-            # cv2.rectangle(im_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-            (x, y, w, h) = cv2.boundingRect(c)
-            if w * h > maximum:
-                box = (x, y, w, h)
-
-        if box is not None:
-            return box
-        else:
+        return [cv2.boundingRect(c) for c in cnts]
+
+    def _run(self, im_frame):
+        boxes = self.motion_regions(im_frame)
+        if not boxes:
             return None
 
+        # the largest moving region
+        return max(boxes, key=lambda box: box[2] * box[3])
+
 
 class SsimMotionDetection(BaseMotionDetection):
     """
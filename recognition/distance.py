@@ -6,6 +6,7 @@ import numpy as np
 import tensorflow as tf
 from sklearn.metrics.pairwise import cosine_similarity as sk_cosine
 from sklearn.metrics.pairwise import cosine_distances
+from v2.core.distance import IdentityLayout, identity_reduce
 
 
 def cosine_similarity(embedding_1, embedding_2):
@@ -41,11 +42,10 @@ def bulk_cosine_similarity(embeddings_1, embeddings_2):
     :param embeddings_2:
     :return:
     """
-    dists = list()
-    for idx in range(embeddings_1.shape[0]):
-        vec = np.expand_dims(embeddings_1[idx], axis=0)
-        dists.append(cosine_similarity_1_k(vec, embeddings_2))
-    return np.array(dists)
+    dot = np.dot(embeddings_1, embeddings_2.T)
+    norm = np.outer(np.linalg.norm(embeddings_1, axis=1), np.linalg.norm(embeddings_2, axis=1))
+    dist = np.arccos(np.clip(dot / norm, -1., 1.)) / np.pi
+    return dist
 
 
 def euclidean_distance(embedding, embeddings):
@@ -78,14 +78,15 @@ def bulk_cosine_similarity_v2(embeddings_1, embeddings_2):
     return cosine_distances(embeddings_1, embeddings_2)
 
 
-def score(probabilities, distances, db_labels):
+def score(distances, db_labels, k=3):
     """
-
-    :param probabilities: matrix in shape (n_faces,classes)
+    aggregate gallery distances per identity without a loop over identities
     :param distances: matrix in shape (n_faces, n_gallery_image)
     :param db_labels: (n_gallery_image)
-    :return:
+    :param k: number of neighbours for the top k mean and the vote
+    :return: identities in shape (classes,), min distance, mean of top k distances and vote count
+             in shape (n_faces, classes)
     """
-    scores = np.zeros((probabilities.shape[0],))
-    for idx in range(distances.shape[0]):
-        pass
+    layout = IdentityLayout(db_labels)
+    d_min, d_mean, votes, _ = identity_reduce(np.asarray(distances), layout, k)
+    return layout.identities, d_min, d_mean, votes
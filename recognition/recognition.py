@@ -12,7 +12,7 @@ import time
 import configparser
 import cv2
 import numpy as np
-from .utils import load_model, parse_status, FPS, Timer
+from .utils import load_model, load_lite_facenet, parse_status, FPS, Timer
 from .preprocessing import normalize_input, cvt_to_gray
 from .cluster import k_mean_clustering
 from .distance import bulk_cosine_similarity, bulk_cosine_similarity_v2
@@ -23,6 +23,7 @@ import tensorflow as tf
 from tensorflow.keras.models import load_model as h5_load
 from database.component import ImageDatabase, parse_test_dir
 from database.component import inference_db
+from database.pipeline import EmbeddingPipeline
 from motion_detection.component import BSMotionDetection
 from face_detection.tracker import Tracker, KalmanFaceTracker
 from face_detection.utils import draw_face
@@ -31,11 +32,14 @@ from settings import BASE_DIR, GALLERY_CONF, DEFAULT_CONF, MODEL_CONF, GALLERY_R
 from PIL import Image
 from sklearn import preprocessing
 from datetime import datetime
-from tqdm import tqdm
+from tabulate import tabulate
 from tools.system import system_status
 from tools.logger import Logger
 from tools.logger.logger import ExeLogger
 from stream.source import OpencvSource
+from v2.core.distance import QuantizedEngine
+from v2.core.network import KerasInference
+from v2.tools import inference_device
 from settings import (COLOR_WARN,
                       COLOR_DANG,
                       COLOR_SUCCESS,
@@ -56,9 +60,8 @@ def face_recognition(args):
     if not log_subdir.exists():
         log_subdir.mkdir(parents=True)
 
-    physical_devices = tf.config.list_physical_devices('GPU')
-    logger.info("$ On {}".format(physical_devices[0].name))
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    device = inference_device(MODEL_CONF.get("device"))
+    logger.info("$ On {}".format(device))
 
     logger.info(f"$ {parse_status(args)} recognition mode ...")
 
@@ -97,7 +100,7 @@ def face_recognition(args):
         conf=hpe_conf
     )
 
-    with tf.device('/device:gpu:0'):
+    with tf.device(device):
         with tf.Graph().as_default():
             with tf.compat.v1.Session() as sess:
                 logger.info(f"$ Initializing computation graph with {MODEL_CONF.get('facenet')} pretrained model.")
@@ -292,8 +295,7 @@ def face_recognition(args):
 
 
 def face_recognition_on_keras(args):
-    physical_devices = tf.config.list_physical_devices('GPU')
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    device = inference_device(MODEL_CONF.get("device"))
 
     print(f"$ {parse_status(args)} recognition mode ...")
 
@@ -311,7 +313,8 @@ def face_recognition_on_keras(args):
         encoded_labels.fit(list(set(labels)))
         labels = encoded_labels.transform(labels)
 
-    model = h5_load(MODEL_CONF.get("facenet_keras"))
+    with tf.device(device):
+        model = KerasInference(h5_load(MODEL_CONF.get("facenet_keras")), MODEL_CONF.get("keras_inference"))
 
     detector = FaceDetector(sess=None)
     print("$ MTCNN face detector has been loaded.")
@@ -365,7 +368,8 @@ def face_recognition_on_keras(args):
                 faces = np.array(faces)
 
             if (args.video or args.realtime) and (faces.shape[0] > 0):
-                embedded_array = model.predict(faces)
+                with tf.device(device):
+                    embedded_array = model(faces)
 
                 if args.eval_method == 'cosine':
                     dists = bulk_cosine_similarity_v2(embedded_array, embeds)
@@ -400,7 +404,8 @@ def face_recognition_on_keras(args):
         faces = np.array(faces)
         print(faces)
         if faces.shape[0] > 0:
-            embedded_array = model.predict(faces)
+            with tf.device(device):
+                embedded_array = model(faces)
             clusters = k_mean_clustering(embeddings=embedded_array,
                                          n_cluster=int(GALLERY_CONF['n_clusters']))
             database.save_clusters(clusters, faces_, args.cluster_name)
@@ -415,12 +420,10 @@ def test_recognition(args):
     :param args:
     :return: None
     """
-    # memory growth
+    # inference device, cpu when the box has no gpu
     tf.compat.v1.disable_eager_execution()
-    physical_devices = tf.config.list_physical_devices('GPU')
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
-    if physical_devices:
-        print(f"$ {len(physical_devices)} Devices has been detected.")
+    device = inference_device(MODEL_CONF.get("device"))
+    print(f"$ Inference on {device}")
 
     test_dir = args.test_dir
 
@@ -443,41 +446,58 @@ def test_recognition(args):
     encoded_labels.fit(list(set(gallery_labels)))
     gallery_labels = encoded_labels.transform(gallery_labels)
 
-    print("$ loading images in memory")
-    test_images_memory = list()
-    for im in tqdm(test_images):
-        test_images_memory.append(im.read_image_file(grayscale=False, resize=True))
-
-    test_images_memory = np.array(test_images_memory)
-
     timer = Timer()
-    with tf.device('/device:gpu:0'):
-        with tf.Graph().as_default():
-            with tf.compat.v1.Session() as sess:
-                print(f"$ Initializing computation graph with {MODEL_CONF.get('facenet')} pretrained model.")
-                load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
-                print("$ Model has been loaded.")
-
-                input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
-                embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
-                phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
-
-                feed_dic = {phase_train: False, input_plc: test_images_memory}
-                timer.start()
-                test_embeddings = sess.run(embeddings, feed_dic)
-                print(f"$ embeddings created at {timer.end()}")
-
-                test_embeddings = np.array(test_embeddings)
-                timer.start()
-                dists = bulk_cosine_similarity(test_embeddings, gallery_embeds)
-                print(f"$ distances created at {timer.end()}")
-
-                dists = np.array(dists)
-                bs_similarity_idx = np.argmin(dists, axis=1)
-
-                accuracy = np.mean(
-                    np.equal(test_label_encoder.transform(test_labels), np.array(gallery_labels)[bs_similarity_idx]))
-                print(f"$ accuracy {accuracy * 100}")
+    lite = load_lite_facenet()
+    if lite is not None:
+        # cpu backend, no session is needed
+        print(f"$ {MODEL_CONF.get('facenet_backend')} lite model has been loaded.")
+        pipeline = EmbeddingPipeline(None, None, None, None, model=lite)
+        timer.start()
+        test_embeddings = pipeline.embed(test_images,
+                                         loader=lambda im: im.read_image_file(grayscale=False, resize=True))
+        print(f"$ embeddings created at {timer.end()}")
+    else:
+        with tf.device(device):
+            with tf.Graph().as_default():
+                with tf.compat.v1.Session() as sess:
+                    print(f"$ Initializing computation graph with {MODEL_CONF.get('facenet')} pretrained model.")
+                    load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
+                    print("$ Model has been loaded.")
+
+                    input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
+                    embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
+                    phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
+
+                    pipeline = EmbeddingPipeline(sess, input_plc, embeddings, phase_train)
+                    timer.start()
+                    test_embeddings = pipeline.embed(test_images,
+                                                     loader=lambda im: im.read_image_file(grayscale=False, resize=True))
+                    print(f"$ embeddings created at {timer.end()}")
+
+    test_embeddings = np.array(test_embeddings)
+    timer.start()
+    dists = bulk_cosine_similarity(test_embeddings, gallery_embeds)
+    print(f"$ distances created at {timer.end()}")
+
+    dists = np.array(dists)
+    bs_similarity_idx = np.argmin(dists, axis=1)
+
+    accuracy = np.mean(
+        np.equal(test_label_encoder.transform(test_labels), np.array(gallery_labels)[bs_similarity_idx]))
+    print(f"$ accuracy {accuracy * 100}")
+
+    # accuracy delta of compressed galleries
+    rows = [["float32", gallery_embeds.shape[0] * gallery_embeds.shape[1] * 4, accuracy * 100, 0.]]
+    for codec in [QuantizedEngine.CODEC_FLOAT16, QuantizedEngine.CODEC_INT8, QuantizedEngine.CODEC_PQ]:
+        quantized = QuantizedEngine(similarity_threshold=float(DEFAULT_CONF.get("similarity_threshold")),
+                                    codec=codec,
+                                    pq_subspaces=int(GALLERY_CONF.get("pq_subspaces")))
+        quantized.fit(gallery_embeds)
+        q_idx, _ = quantized.top_k(test_embeddings, k=1)
+        q_accuracy = np.mean(np.equal(test_label_encoder.transform(test_labels),
+                                      np.array(gallery_labels)[q_idx[:, 0]]))
+        rows.append([codec, quantized.nbytes, q_accuracy * 100, (q_accuracy - accuracy) * 100])
+    print(tabulate(rows, headers=["gallery", "bytes", "accuracy", "delta"]))
 
 
 def cluster_faces(args) -> None:
@@ -487,9 +507,8 @@ def cluster_faces(args) -> None:
     :return:
     """
     logger = Logger()
-    physical_devices = tf.config.list_physical_devices('GPU')
-    logger.info("$ On {}".format(physical_devices[0].name))
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    device = inference_device(MODEL_CONF.get("device"))
+    logger.info("$ On {}".format(device))
 
     database = ImageDatabase(db_path=GALLERY_ROOT)
     ids = list(database.get_identity_image_paths().keys())
@@ -531,6 +550,7 @@ def cluster_faces(args) -> None:
             input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
             embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
             phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
+            pipeline = EmbeddingPipeline(sess, input_plc, embeddings, phase_train)
 
             for v_path in ls_video.glob("*.avi"):
 
@@ -584,8 +604,7 @@ def cluster_faces(args) -> None:
                         # update
                         n_faces = n_faces[right_pose_idx, :, :, :]
 
-                        feed_dic = {phase_train: False, input_plc: n_faces}
-                        embedded_array = sess.run(embeddings, feed_dic)
+                        embedded_array = pipeline.embed(n_faces)
                         clusters = k_mean_clustering(embeddings=embedded_array,
                                                      n_cluster=int(GALLERY_CONF.get("n_clusters")))
                         database.save_clusters(clusters, faces_filtered, filename.title())
@@ -607,9 +626,8 @@ def face_recognition_kalman(args):
     :param args:
     :return:
     """
-    physical_devices = tf.config.list_physical_devices('GPU')
-    print("$ On {}".format(physical_devices[0].name))
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    device = inference_device(MODEL_CONF.get("device"))
+    print("$ On {}".format(device))
 
     print(f"$ {parse_status(args)} recognition mode ...")
 
@@ -623,7 +641,7 @@ def face_recognition_kalman(args):
         labels = encoded_labels.transform(labels)
     motion_detection = BSMotionDetection()
 
-    with tf.device('/device:gpu:0'):
+    with tf.device(device):
         with tf.Graph().as_default():
             with tf.compat.v1.Session() as sess:
                 print(f"$ Initializing computation graph with {MODEL_CONF.get('facenet')} pretrained model.")
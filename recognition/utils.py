@@ -11,8 +11,15 @@ import re
 import numpy as np
 import string
 import random
+import pathlib
+from typing import Union
 from PIL import Image
 from .model import *
+from settings import BASE_DIR, MODEL_CONF
+from v2.core.network import LiteFaceNetModel, convert_to_lite
+
+BACKEND_PB = "pb"
+LITE_PRECISIONS = ["float16", "int8"]
 
 
 def get_model_filenames(model_dir):
@@ -169,6 +176,78 @@ def convert_computation_graph_to_keras_model(model_dir, save_dir, lite: bool = T
         print(f"$ lite tensorflow model created {os.path.join(o_model_dir, lite_model_filename)}")
 
 
+def lite_facenet_path(precision: str) -> pathlib.Path:
+    """
+    :param precision: float16 or int8
+    :return: path of the tflite FaceNet model of a precision
+    """
+    return pathlib.Path(BASE_DIR).joinpath(MODEL_CONF.get("facenet_lite_dir"), f"facenet_{precision}.tflite")
+
+
+def facenet_model_path(backend: Union[str, None] = None) -> pathlib.Path:
+    """
+    model file which embeds the gallery with a FaceNet backend
+    :param backend: pb, float16 or int8, facenet_backend of the model config by default
+    :return: frozen graph for pb and the tflite model of the precision otherwise
+    """
+    backend = MODEL_CONF.get("facenet_backend") if backend is None else backend
+    if backend == BACKEND_PB:
+        return pathlib.Path(BASE_DIR).joinpath(MODEL_CONF.get("facenet"))
+    if backend not in LITE_PRECISIONS:
+        raise ValueError(f"facenet backend {backend} is unknown")
+    return lite_facenet_path(backend)
+
+
+def convert_facenet_to_lite() -> None:
+    """
+    convert the keras FaceNet model into every tflite precision
+    :return: None
+    """
+    keras_path = pathlib.Path(BASE_DIR).joinpath(MODEL_CONF.get("facenet_keras"))
+    for precision in LITE_PRECISIONS:
+        path = convert_to_lite(keras_path, lite_facenet_path(precision), precision)
+        print(f"$ {precision} lite model created {path} ({path.stat().st_size / 2 ** 20:.1f} MB)")
+
+
+def load_lite_facenet(backend: Union[str, None] = None) -> Union[LiteFaceNetModel, None]:
+    """
+    cpu FaceNet backend of the configuration
+    :param backend: pb, float16 or int8, facenet_backend of the model config by default
+    :return: loaded LiteFaceNetModel or None for the reference pb graph
+    """
+    backend = MODEL_CONF.get("facenet_backend") if backend is None else backend
+    if backend == BACKEND_PB:
+        return None
+    if backend not in LITE_PRECISIONS:
+        raise ValueError(f"facenet backend {backend} is unknown")
+
+    path = lite_facenet_path(backend)
+    if not path.is_file():
+        raise FileNotFoundError(f"{path} does not exist, convert the model with --cnv_to_lite")
+    model = LiteFaceNetModel(path, num_threads=int(MODEL_CONF.get("lite_threads")) or None)
+    model.load_model()
+    return model
+
+
+def optimized_graph_path(name: str) -> pathlib.Path:
+    """
+    :param name: facenet, hpe or mtcnn
+    :return: path of the inference only graph written by --cg_optimize
+    """
+    return pathlib.Path(BASE_DIR).joinpath(MODEL_CONF.get("optimized_dir"), f"{name}.pb")
+
+
+def inference_graph(name: str, model_path) -> str:
+    """
+    prefer the optimized graph of a model when it has been generated
+    :param name: facenet, hpe or mtcnn
+    :param model_path: original frozen graph
+    :return: path of the graph to load
+    """
+    path = optimized_graph_path(name)
+    return str(path) if path.is_file() else str(model_path)
+
+
 class FPS:
     def __init__(self):
         self._start = None
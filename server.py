@@ -15,6 +15,7 @@ if __name__ == "__main__":
     parser.add_argument('--rtsp', help="rtsp camera stream", action="store_true")
     parser.add_argument('--port', help="server port", type=int, default="8080")
     parser.add_argument('--host', help="server hostname", type=str, default="127.0.0.1")
+    parser.add_argument('--worker', help="worker index of this process for the cpu affinity", type=int, default=0)
 
     args = parser.parse_args()
 
@@ -21,12 +21,12 @@ import socket
 import tensorflow as tf
 from uuid import uuid1
 from datetime import datetime
-from sklearn import preprocessing
 
 # recognition
-from recognition.utils import load_model, parse_status, Timer
+from recognition.utils import load_model, load_lite_facenet, parse_status, Timer
+from recognition.utils import inference_graph, optimized_graph_path
 from recognition.preprocessing import normalize_input, cvt_to_gray
-from recognition.distance import bulk_cosine_similarity, bulk_cosine_similarity_v2
+from recognition.distance import bulk_cosine_similarity
 from recognition.utils import reshape_image
 
 # face detection
@@ -36,6 +36,7 @@ from face_detection.mtcnn import detect_face
 # database
 from database.sync import parse_person_id_dictionary
 from database.component import ImageDatabase
+from database.reloader import GalleryReloader
 
 # motion
 from motion_detection.component import BSMotionDetection
@@ -67,14 +68,26 @@ from settings import (BASE_DIR,
                       CAMERA_MODEL_CONF,
                       DETECTOR_CONF,
                       SERVER_CONF,
-                      IMAGE_CONF)
+                      IMAGE_CONF,
+                      THREADS_CONF)
 
 # serializer
 from .serializer import face_serializer
+from .warmup import warmup_mtcnn, warmup_batches, warmup_log
 
 # logs
 from v2.tools.logger import LOG_Path, FileLogger
+from v2.tools import inference_device, ThreadBudget
 
+# matching
+from v2.core.distance import DistanceFactory, IVFIndex, QuantizedEngine, GraphMatcher, MatchingEngine
+
+# engine
+from v2.core.engine import Readiness, RoiPlanner
+
+
+# thread pools of the sessions, the process wide part is applied by manage.py
+thread_budget = ThreadBudget.from_config(THREADS_CONF)
 
 # signal
 # from .signals import control_c_signal_handler
@@ -91,9 +104,8 @@ def recognition_serve(args):
     if not log_subdir.exists():
         log_subdir.mkdir(parents=True)
 
-    physical_devices = tf.config.list_physical_devices('GPU')
-    logger.info("$ On {}".format(physical_devices[0].name))
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    device = inference_device(MODEL_CONF.get("device"))
+    logger.info("$ On {}".format(device))
 
     logger.info(f"$ {parse_status(args)} recognition mode ...")
 
@@ -113,17 +125,14 @@ def recognition_serve(args):
         else:
             logger.info("$ database is stable")
         logger.info("$ loading embeddings ...")
-        embeds, labels = database.bulk_embeddings()
-        encoded_labels = preprocessing.LabelEncoder()
-        encoded_labels.fit(list(set(labels)))
-        labels = encoded_labels.transform(labels)
+        embeds, labels, encoded_labels = database.load_gallery()
     motion_detection = BSMotionDetection()
 
-    with tf.device('/device:gpu:0'):
+    with tf.device(device):
         with tf.Graph().as_default():
-            with tf.compat.v1.Session() as sess:
+            with tf.compat.v1.Session(config=thread_budget.session_config()) as sess:
                 logger.info(f"$ Initializing computation graph with {model_conf.get('facenet')} pretrained model.")
-                load_model(os.path.join(BASE_DIR, model_conf.get('facenet')))
+                load_model(inference_graph("facenet", os.path.join(BASE_DIR, model_conf.get('facenet'))))
                 logger.info("$ Model has been loaded.")
                 input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
                 embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
@@ -185,7 +194,7 @@ def recognition_serve(args):
                                 dists = bulk_cosine_similarity(embedded_array, embeds)
                                 bs_similarity_idx = np.argmin(dists, axis=1)
                                 bs_similarity = dists[np.arange(len(bs_similarity_idx)), bs_similarity_idx]
-                                pred_labels = np.array(labels)[bs_similarity_idx]
+                                pred_labels = np.asarray(labels)[bs_similarity_idx]
                                 for i in range(len(pred_labels)):
                                     x, y, w, h = boxes[i]
                                     status = encoded_labels.inverse_transform([pred_labels[i]]) if bs_similarity[
@@ -208,18 +217,60 @@ def recognition_serve(args):
                             tk.modify()
 
 
+def create_matcher(args, database: ImageDatabase, embeds: np.ndarray, labels: np.ndarray):
+    """
+    create the matching backend of an evaluation method, a saved index of the current snapshot is
+    loaded instead of fitting when there is one
+    :param args: argument from arg parser
+    :param database: ImageDatabase
+    :param embeds: gallery embeddings
+    :param labels: encoded gallery labels
+    :return: fitted matcher
+    """
+    codec = GALLERY_CONF.get("quantization")
+    matcher = DistanceFactory(args.eval_method,
+                              similarity_threshold=float(DEFAULT_CONF.get("similarity_threshold")),
+                              n_probe=int(GALLERY_CONF.get("ann_n_probe")),
+                              n_prototypes=int(GALLERY_CONF.get("prototype_n")),
+                              shortlist=int(GALLERY_CONF.get("prototype_shortlist")),
+                              codec=None if codec == "none" else codec,
+                              pq_subspaces=int(GALLERY_CONF.get("pq_subspaces")),
+                              knn_k=int(GALLERY_CONF.get("knn_k")),
+                              aggregate=GALLERY_CONF.get("knn_aggregate"))
+
+    if isinstance(matcher, IVFIndex) and database.index_path is not None and IVFIndex.exists(database.index_path):
+        matcher.load(database.index_path)
+    elif isinstance(matcher, QuantizedEngine) and database.quantized_path is not None and \
+            QuantizedEngine.exists(database.quantized_path):
+        matcher.load(database.quantized_path)
+    else:
+        matcher.fit(embeds, labels)
+    return matcher
+
+
+def create_graph_matcher(args, embeddings) -> GraphMatcher:
+    """
+    exact matching head on the embedding tensor, only the exact evaluation methods are supported
+    :param args: arguments with eval_method
+    :param embeddings: embedding tensor
+    :return: GraphMatcher, the gallery is assigned by the frame loop
+    """
+    metrics = {"cosine": MatchingEngine.METRIC_ANGULAR, "cosine_v2": MatchingEngine.METRIC_COSINE}
+    if args.eval_method not in metrics:
+        raise ValueError(f"graph matching supports {list(metrics.keys())} evaluation methods")
+    return GraphMatcher(embeddings, similarity_threshold=float(DEFAULT_CONF.get("similarity_threshold")),
+                        metric=metrics[args.eval_method], k=1, name="graph_matcher")
+
+
 def recognition_serv_2(args):
     # database
     database = ImageDatabase(db_path=GALLERY_CONF.get("database_path"))
-    embeds, labels = database.bulk_embeddings()
-    encoded_labels = preprocessing.LabelEncoder()
-    encoded_labels.fit(list(set(labels)))
-    labels = encoded_labels.transform(labels)
+    reloader = GalleryReloader(database, on_reload=lambda state: print(f"$ gallery {state.version} is loaded"))
+    reloader.start()
     person_ids = parse_person_id_dictionary()
 
-    # memory growth
-    physical_devices = tf.config.list_physical_devices('GPU')
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    # inference device, cpu when the box has no gpu
+    device = inference_device(MODEL_CONF.get("device"))
 
     tracker = PolicyTracker(max_life_time=float(TRACKER_CONF.get("max_modify_time")),
                             max_conf=int(TRACKER_CONF.get("max_frame_conf")))
@@ -235,10 +286,10 @@ def recognition_serv_2(args):
         face_save_path.mkdir(parents=True)
 
     # computation graph
-    with tf.device('/device:gpu:0'):
+    with tf.device(device):
         with tf.Graph().as_default():
-            with tf.compat.v1.Session() as sess:
-                load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
+            with tf.compat.v1.Session(config=thread_budget.session_config()) as sess:
+                load_model(inference_graph("facenet", os.path.join(BASE_DIR, MODEL_CONF.get('facenet'))))
                 input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
                 embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
                 phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
@@ -268,6 +319,10 @@ def recognition_serv_2(args):
                     if delta_time > 1. / float(DETECTOR_CONF['fps']):
                         prev = cur
 
+                        # the whole frame is matched against one gallery state
+                        gallery = reloader.state
+                        embeds, labels, encoded_labels = gallery.embeddings, gallery.labels, gallery.label_encoder
+
                         serial_event = []
 
                         frame_ = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -290,7 +345,7 @@ def recognition_serv_2(args):
                             dists = bulk_cosine_similarity(embedded_array, embeds)
                             bs_similarity_idx = np.argmin(dists, axis=1)
                             bs_similarity = dists[np.arange(len(bs_similarity_idx)), bs_similarity_idx]
-                            pred_labels = np.array(labels)[bs_similarity_idx]
+                            pred_labels = np.asarray(labels)[bs_similarity_idx]
                             for i in range(len(pred_labels)):
                                 uu_ = uuid1()
                                 file_name_ = uu_.hex + ".jpg"
@@ -368,15 +423,24 @@ def recognition_track_let_serv(args):
 
     # database
     database = ImageDatabase(db_path=GALLERY_CONF.get("database_path"))
-    embeds, labels = database.bulk_embeddings()
-    encoded_labels = preprocessing.LabelEncoder()
-    encoded_labels.fit(list(set(labels)))
-    labels = encoded_labels.transform(labels)
     person_ids = parse_person_id_dictionary()
 
-    # memory growth
-    physical_devices = tf.config.list_physical_devices('GPU')
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    # matching engine, it is rebuilt on a background thread when a new gallery is committed
+    try:
+        reloader = GalleryReloader(database,
+                                   build_matcher=lambda embeds, labels: create_matcher(args, database, embeds, labels),
+                                   on_reload=lambda state: file_logger.info(f"[Reload] Gallery {state.version} "
+                                                                            f"with {state.embeddings.shape[0]} "
+                                                                            f"embeddings"),
+                                   logger=file_logger)
+    except ValueError:
+        logger.dang("[Invalid] Invalid metric")
+        time.sleep(2)
+        sys.exit(0)
+    reloader.start()
+
+    # inference device, cpu when the box has no gpu
+    device = inference_device(MODEL_CONF.get("device"))
 
     # sender
     address = (SERVER_CONF.get("UDP_HOST"), int(SERVER_CONF.get("UDP_PORT")))
@@ -405,6 +469,16 @@ def recognition_track_let_serv(args):
     tracker_min_conf = int(TRACKER_CONF.get("min_conf_frame"))
     tracker_container = TrackerContainer(max_track_id=int(TRACKER_CONF.get("min_tracked_id")))
 
+    # detection inside the motion regions and the predicted boxes of the tracks, the whole frame is scanned
+    # every roi_full_scan detections
+    roi_planner = None
+    motion_detection = None
+    if DETECTOR_CONF.getboolean("roi_detection"):
+        roi_planner = RoiPlanner(full_scan=int(DETECTOR_CONF.get("roi_full_scan")),
+                                 padding=float(DETECTOR_CONF.get("roi_padding")),
+                                 min_side=2 * int(DETECTOR_CONF.get("min_face_size")), name="track_let_roi")
+        motion_detection = BSMotionDetection()
+
     # HPE
 
     hpe_conf = (
@@ -435,21 +509,27 @@ def recognition_track_let_serv(args):
         logger.dang(msg)
         stable_mode = False
 
+    # cpu FaceNet backend, the embeddings are not a tensor of the session then
+    lite = load_lite_facenet()
+    if lite is not None and (args.fused or args.graph_match):
+        raise ValueError(f"--fused and --graph_match need the pb FaceNet backend, "
+                         f"not {MODEL_CONF.get('facenet_backend')}")
+
     # computation graph
-    with tf.device('/device:gpu:0'):
+    with tf.device(device):
         with tf.Graph().as_default():
-            with tf.compat.v1.Session() as sess:
+            with tf.compat.v1.Session(config=thread_budget.session_config()) as sess:
 
                 # recognition computation graph
-                load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
+                load_model(inference_graph("facenet", os.path.join(BASE_DIR, MODEL_CONF.get('facenet'))))
                 input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
                 embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
                 phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
 
-                pnet, rnet, onet = detect_face.create_mtcnn(sess)
+                pnet, rnet, onet = detect_face.create_mtcnn(sess, str(optimized_graph_path("mtcnn")))
 
                 # hpe computation graph
-                load_model(os.path.join(BASE_DIR, HPE_CONF.get("model")))
+                load_model(inference_graph("hpe", os.path.join(BASE_DIR, HPE_CONF.get("model"))))
 
                 hpe_input = tf.compat.v1.get_default_graph().get_tensor_by_name("x:0")
                 hpe_output = tf.compat.v1.get_default_graph().get_tensor_by_name("Identity:0")
@@ -462,6 +542,8 @@ def recognition_track_let_serv(args):
                     float(DETECTOR_CONF.get("step2_threshold")),
                     float(DETECTOR_CONF.get("step3_threshold"))]
                 factor = float(DETECTOR_CONF.get("scale_factor"))
+                packed = DETECTOR_CONF.getboolean("packed_pyramid")
+                max_candidates = int(DETECTOR_CONF.get("nms_max_candidates")) or None
 
                 x_margin = int(DETECTOR_CONF.get("x_margin"))
                 y_margin = int(DETECTOR_CONF.get("y_margin"))
@@ -475,6 +557,23 @@ def recognition_track_let_serv(args):
                 cap = MultiSource(src=_source, name=_source_name, width=int(CAMERA_MODEL_CONF.get("width")),
                                   height=int(CAMERA_MODEL_CONF.get("height")))
 
+                # matching head inside the graph, the gallery variable is reassigned on reload
+                graph_matcher = None
+                if args.graph_match:
+                    graph_matcher = create_graph_matcher(args, embeddings)
+
+                # every network sees its serving shapes once before the first frame
+                readiness = Readiness(name="track_let_server")
+                warmup_mtcnn(readiness, pnet, rnet, onet, (int(CAMERA_MODEL_CONF.get("height")),
+                                                           int(CAMERA_MODEL_CONF.get("width"))), minsize, factor,
+                             packed=packed)
+                warmup_batches(readiness, "hpe", lambda b: hpe.predict(sess, b, hpe_input, hpe_output), (64, 64, 1))
+                warmup_batches(readiness, "facenet", lite.embed if lite is not None else
+                               lambda b: sess.run(embeddings, {phase_train: False, input_plc: b}), (160, 160, 3))
+                for msg in warmup_log(readiness):
+                    file_logger.info(msg)
+                readiness.set_ready()
+
                 watch_list = []
                 msg = "[OK] Ready to start"
                 file_logger.info(msg)
@@ -490,6 +589,15 @@ def recognition_track_let_serv(args):
                             logger.dang(msg)
                             continue
 
+                        # the whole frame is matched against one gallery state
+                        gallery = reloader.state
+                        matcher, labels, encoded_labels = gallery.matcher, gallery.labels, gallery.label_encoder
+                        # a gallery with fewer than k vectors is not matched, its tracks stay unrecognised
+                        matchable = stable_mode and gallery.embeddings.shape[0] >= (
+                            1 if graph_matcher is None else graph_matcher.k)
+                        if graph_matcher is not None and matchable and graph_matcher.version != gallery.version:
+                            graph_matcher.assign(sess, gallery.embeddings, gallery.version)
+
                         serial_event = []
 
                         frame_ = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -500,8 +608,18 @@ def recognition_track_let_serv(args):
                         points = []
 
                         if cnt % interval == 0:
-                            faces, points = detect_face.detect_face(frame_, minsize, pnet, rnet, onet, threshold,
-                                                                    factor)
+                            rois = None
+                            if roi_planner is not None:
+                                rois = roi_planner.plan(frame.shape[:2], motion_detection.motion_regions(frame),
+                                                        track_let.predicted_boxes())
+                            if rois is None:
+                                faces, points = detect_face.detect_face(frame_, minsize, pnet, rnet, onet, threshold,
+                                                                        factor, packed=packed,
+                                                                        max_candidates=max_candidates)
+                            elif len(rois) > 0:
+                                faces, points = detect_face.detect_face_rois(frame_, rois, minsize, pnet, rnet, onet,
+                                                                             threshold, factor, packed=packed,
+                                                                             max_candidates=max_candidates)
 
                         # expiration deletion ( recognized )
                         ex_lists = list(tracker.get_expires())
@@ -749,7 +867,16 @@ def recognition_track_let_serv(args):
                         # HPE
 
                         cropped_images = hpe.get_cropped_pics(ch1_fr, tracks_bounding_box_to, 0, "large")
-                        poses = hpe.predict(sess, cropped_images, hpe_input, hpe_output)
+                        fused_out = None
+                        if args.fused and matchable and tracks_face_to.shape[0] > 0:
+                            # poses and embeddings (or matches) of every candidate by one sess.run, the
+                            # pose filter is applied to the returned values afterwards
+                            poses, fused_out = hpe.predict_with(sess, cropped_images, hpe_input, hpe_output,
+                                                                embeddings if graph_matcher is None
+                                                                else graph_matcher.fetches,
+                                                                {phase_train: False, input_plc: tracks_face_to})
+                        else:
+                            poses = hpe.predict(sess, cropped_images, hpe_input, hpe_output)
                         right_pose_idx = hpe.validate_angle_bulk(po=poses)
                         com_pos_idx = hpe.validate_angle_bulk_complement(po=poses)
 
@@ -770,21 +897,24 @@ def recognition_track_let_serv(args):
                             tracks_status_to = tracks_status_to[right_pose_idx]
                             poses = poses[right_pose_idx, :]
 
-                            if stable_mode:
-                                feed_dic = {phase_train: False, input_plc: tracks_face_to}
-                                embedded_array = sess.run(embeddings, feed_dic)
-                                if args.eval_method == "cosine":
-                                    dists = bulk_cosine_similarity(embedded_array, embeds)
-                                elif args.eval_method == "cosine_v2":
-                                    dists = bulk_cosine_similarity_v2(embedded_array, embeds)
+                            if matchable:
+                                if graph_matcher is not None:
+                                    if fused_out is not None:
+                                        bs_similarity_idx, bs_similarity = fused_out[0][right_pose_idx], \
+                                                                           fused_out[1][right_pose_idx]
+                                    else:
+                                        bs_similarity_idx, bs_similarity = graph_matcher.top_k(
+                                            sess, {phase_train: False, input_plc: tracks_face_to})
                                 else:
-                                    logger.dang("[Invalid] Invalid metric")
-                                    time.sleep(2)
-                                    sys.exit(0)
+                                    if fused_out is not None:
+                                        embedded_array = fused_out[right_pose_idx, :]
+                                    else:
+                                        embedded_array = lite.embed(tracks_face_to) if lite is not None else \
+                                            sess.run(embeddings, {phase_train: False, input_plc: tracks_face_to})
+                                    bs_similarity_idx, bs_similarity = matcher.top_k(embedded_array, k=1)
+                                bs_similarity_idx, bs_similarity = bs_similarity_idx[:, 0], bs_similarity[:, 0]
 
-                                bs_similarity_idx = np.argmin(dists, axis=1)
-                                bs_similarity = dists[np.arange(len(bs_similarity_idx)), bs_similarity_idx]
-                                pred_labels = np.array(labels)[bs_similarity_idx]
+                                pred_labels = np.asarray(labels)[bs_similarity_idx]
                                 for i in range(len(pred_labels)):
                                     uu_ = uuid1()
                                     file_name_ = uu_.hex + ".jpg"
@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+
+from face_detection.mtcnn import detect_face
+from v2.core.engine import Readiness
+from settings import MODEL_CONF
+
+
+def batch_buckets() -> List[int]:
+    """
+    :return: batch sizes of the model config which are warmed up
+    """
+    return sorted(int(b) for b in MODEL_CONF.get("batch_buckets").split(","))
+
+
+def warmup_batches(readiness: Readiness, model: str, fn: Callable, sample_shape: Sequence[int],
+                   buckets: Sequence[int] = None) -> None:
+    """
+    run a model once for every batch size with zeros
+    :param readiness: Readiness which records the timings
+    :param model: name of the model
+    :param fn: callable which takes (b,...)
+    :param sample_shape: shape of one sample
+    :param buckets: batch sizes, batch_buckets of the model config by default
+    :return: None
+    """
+    for b in batch_buckets() if buckets is None else buckets:
+        readiness.timed(model, fn, np.zeros((b,) + tuple(sample_shape), dtype=np.float32))
+
+
+def warmup_mtcnn(readiness: Readiness, pnet: Callable, rnet: Callable, onet: Callable, frame_shape: Tuple[int, int],
+                 minsize: int, factor: float, buckets: Sequence[int] = None, packed: bool = False) -> None:
+    """
+    run P-Net at every pyramid scale of a frame size, or on the packed pyramid, and R-Net, O-Net at every
+    batch size
+    :param readiness: Readiness which records the timings
+    :param pnet: stage functions of create_mtcnn
+    :param rnet:
+    :param onet:
+    :param frame_shape: (height, width) of the frames given to detect_face
+    :param minsize: minimum of faces' size
+    :param factor: scale factor
+    :param buckets: batch sizes, batch_buckets of the model config by default
+    :param packed: detect_face runs P-Net on the packed pyramid
+    :return: None
+    """
+    h, w = frame_shape
+    scales = detect_face.pyramid_scales(h, w, minsize, factor)
+    if packed:
+        (ch, cw), _ = detect_face.pyramid_canvas(h, w, scales)
+        shapes = [(1, cw, ch, 3)]
+    else:
+        # P-Net sees the transposed image, see detect_face
+        shapes = [(1, int(np.ceil(w * scale)), int(np.ceil(h * scale)), 3) for scale in scales]
+    for shape in shapes:
+        readiness.timed("pnet", pnet, np.zeros(shape, dtype=np.float32))
+    warmup_batches(readiness, "rnet", rnet, (24, 24, 3), buckets)
+    warmup_batches(readiness, "onet", onet, (48, 48, 3), buckets)
+
+
+def warmup_log(readiness: Readiness) -> List[str]:
+    """
+    :param readiness: warmed up Readiness
+    :return: one log line per warmup call and a total
+    """
+    lines = [f"[Warmup] {c.model} {c.shape} {c.seconds * 1000.:.1f} ms" for c in readiness.calls]
+    lines.append(f"[Warmup] {len(lines)} calls in {readiness.warmup_seconds:.2f}s")
+    return lines
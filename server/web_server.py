@@ -15,8 +15,8 @@ import socketio
 import threading
 import cv2
 from datetime import datetime
-from sklearn import preprocessing
 import tensorflow as tf
+from v2.tools import inference_device, ThreadBudget
 import numpy as np
 import time
 import json
@@ -29,8 +29,9 @@ from face_detection.detector import FaceDetector
 from face_detection.utils import draw_face
 from recognition.distance import bulk_cosine_similarity
 from recognition.preprocessing import normalize_input, cvt_to_gray
-from recognition.utils import load_model
+from recognition.utils import load_model, inference_graph
 from database.component import ImageDatabase
+from database.reloader import GalleryReloader
 from tracker.policy import Policy, PolicyTracker
 from database.sync import parse_person_id_dictionary
 
@@ -44,6 +45,7 @@ from settings import DEFAULT_CONF
 from settings import SOURCE_CONF
 from settings import SERVER_CONF
 from settings import TRACKER_CONF
+from settings import THREADS_CONF
 
 # colors
 from settings import COLOR_DANG
@@ -51,11 +53,19 @@ from settings import COLOR_SUCCESS
 
 # serializer
 from .serializer import face_serializer
+from .warmup import warmup_batches, warmup_log
+from v2.core.engine import Readiness
 
 output_frame = None
 output_box_frame = None
 lock = threading.Lock()
 
+# set by the recognition thread once its models are warmed up
+readiness = Readiness(name="web_recognition")
+
+# thread pools of the sessions, the process wide part is applied by run
+thread_budget = ThreadBudget.from_config(THREADS_CONF)
+
 app = Flask(__name__)
 
 app.config['SECRET_KEY'] = 'secret!'
@@ -103,15 +113,12 @@ def recognition():
 
     # database
     database = ImageDatabase(db_path=GALLERY_CONF.get("database_path"))
-    embeds, labels = database.bulk_embeddings()
-    encoded_labels = preprocessing.LabelEncoder()
-    encoded_labels.fit(list(set(labels)))
-    labels = encoded_labels.transform(labels)
+    reloader = GalleryReloader(database, on_reload=lambda state: print(f"$ gallery {state.version} is loaded"))
+    reloader.start()
     person_ids = parse_person_id_dictionary()
 
-    # memory growth
-    physical_devices = tf.config.list_physical_devices('GPU')
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    # inference device, cpu when the box has no gpu
+    device = inference_device(MODEL_CONF.get("device"))
 
     tracker = PolicyTracker(max_life_time=float(TRACKER_CONF.get("max_modify_time")),
                             max_conf=int(TRACKER_CONF.get("max_frame_conf")))
@@ -119,10 +126,10 @@ def recognition():
     global_unrecognized_cnt = 0
 
     # computation graph
-    with tf.device('/device:gpu:0'):
+    with tf.device(device):
         with tf.Graph().as_default():
-            with tf.compat.v1.Session() as sess:
-                load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
+            with tf.compat.v1.Session(config=thread_budget.session_config()) as sess:
+                load_model(inference_graph("facenet", os.path.join(BASE_DIR, MODEL_CONF.get('facenet'))))
                 input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
                 embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
                 phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
@@ -130,6 +137,17 @@ def recognition():
                 # face detector
                 detector = FaceDetector(sess=sess)
 
+                # every network sees its serving shapes once before the first frame
+                width, height = int(CAMERA_MODEL_CONF.get("width")), int(CAMERA_MODEL_CONF.get("height"))
+                readiness.timed("mtcnn", lambda f: list(detector.extract_faces(f, width, height)),
+                                np.zeros((height, width, 3), dtype=np.uint8))
+                warmup_batches(readiness, "facenet",
+                               lambda b: sess.run(embeddings, {phase_train: False, input_plc: b}), (160, 160, 3))
+                for msg in warmup_log(readiness):
+                    print(f"$ {msg}")
+                readiness.set_ready()
+                print("$ [OK] Ready to start")
+
                 prev = 1
                 while True:
                     cur = time.time()
@@ -138,6 +156,10 @@ def recognition():
                     if delta_time > 1. / float(DETECTOR_CONF['fps']):
                         prev = cur
 
+                        # the whole frame is matched against one gallery state
+                        gallery = reloader.state
+                        embeds, labels, encoded_labels = gallery.embeddings, gallery.labels, gallery.label_encoder
+
                         serial_event = []
 
                         with lock:
@@ -165,7 +187,7 @@ def recognition():
                                 dists = bulk_cosine_similarity(embedded_array, embeds)
                                 bs_similarity_idx = np.argmin(dists, axis=1)
                                 bs_similarity = dists[np.arange(len(bs_similarity_idx)), bs_similarity_idx]
-                                pred_labels = np.array(labels)[bs_similarity_idx]
+                                pred_labels = np.asarray(labels)[bs_similarity_idx]
                                 for i in range(len(pred_labels)):
                                     uu_ = uuid1()
                                     file_name_ = uu_.hex + ".jpg"
@@ -269,6 +291,15 @@ def index():
     return jsonify(data)
 
 
+@app.route("/api/ready/")
+def ready_handler():
+    """
+    readiness of the recognition models and the timing of their warmup calls
+    :return:
+    """
+    return jsonify(readiness.as_dict()), 200 if readiness.ready else 503
+
+
 @app.route("/api/createUUID/")
 def create_uuid_handler():
     u_id = uuid1()
@@ -335,20 +366,16 @@ def face_event_handler(data):
 
     # database
     database = ImageDatabase(db_path=GALLERY_CONF.get("database_path"))
-    embeds, labels = database.bulk_embeddings()
-    encoded_labels = preprocessing.LabelEncoder()
-    encoded_labels.fit(list(set(labels)))
-    labels = encoded_labels.transform(labels)
+    embeds, labels, encoded_labels = database.load_gallery()
 
-    # memory growth
-    physical_devices = tf.config.list_physical_devices('GPU')
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
+    # inference device, cpu when the box has no gpu
+    device = inference_device(MODEL_CONF.get("device"))
 
     # computation graph
-    with tf.device('/device:gpu:0'):
+    with tf.device(device):
         with tf.Graph().as_default():
-            with tf.compat.v1.Session() as sess:
-                load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
+            with tf.compat.v1.Session(config=thread_budget.session_config()) as sess:
+                load_model(inference_graph("facenet", os.path.join(BASE_DIR, MODEL_CONF.get('facenet'))))
                 input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
                 embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
                 phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
@@ -389,7 +416,7 @@ def face_event_handler(data):
                                 dists = bulk_cosine_similarity(embedded_array, embeds)
                                 bs_similarity_idx = np.argmin(dists, axis=1)
                                 bs_similarity = dists[np.arange(len(bs_similarity_idx)), bs_similarity_idx]
-                                pred_labels = np.array(labels)[bs_similarity_idx]
+                                pred_labels = np.asarray(labels)[bs_similarity_idx]
                                 for i in range(len(pred_labels)):
                                     x, y, w, h = boxes[i]
                                     status = encoded_labels.inverse_transform([pred_labels[i]]) if bs_similarity[
@@ -414,6 +441,8 @@ def face_event_handler(data):
 def run(args):
     global src, camera_src_name
 
+    thread_budget.apply(worker=args.worker)
+
     if args.rtsp:
         camera_src_name = "rtsp_camera_1"
         src = OpencvSource(SOURCE_CONF.get("cam_1"), camera_src_name, 640, 480)
@@ -38,6 +38,7 @@ HPE_CONF = conf["HPE"]
 PROJECT_CONF = conf["Project"]
 MASK_CONF = conf["Mask"]
 LOG_CONF = conf["Log"]
+THREADS_CONF = conf["Threads"]
 
 SETTINGS_HEADER = ["Default",
                    "Image",
@@ -51,7 +52,8 @@ SETTINGS_HEADER = ["Default",
                    "HPE",
                    "Project",
                    "Mask",
-                   "Log"]
+                   "Log",
+                   "Threads"]
 
 COLOR_SUCCESS = (0, 255, 0)
 COLOR_DANG = (243, 32, 19)
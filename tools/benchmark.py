@@ -0,0 +1,448 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+from itertools import product
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from tabulate import tabulate
+
+from v2.core.distance import MatchingEngine, IVFIndex, PrototypeIndex
+from database.component import ImageDatabase, parse_test_dir
+from database.pipeline import EmbeddingPipeline
+from recognition.utils import load_model, load_lite_facenet, LITE_PRECISIONS, inference_graph, optimized_graph_path
+from recognition.preprocessing import normalize_input
+from face_detection.mtcnn import detect_face
+from v2.tools import ThreadBudget, non_max_suppression, non_max_suppression_loop, NMS_UNION, NMS_MIN
+from v2.core.network import KerasInference, INFERENCE_MODES
+from v2.core.engine import RoiPlanner
+from motion_detection.component import BSMotionDetection
+from tracker.tracklet.component import TrackLet
+from settings import BASE_DIR, MODEL_CONF, GALLERY_CONF, DEFAULT_CONF, DETECTOR_CONF, CAMERA_MODEL_CONF, MASK_CONF
+
+
+def synthetic_gallery(n_identities: int, n_clusters: int, dim: int = 512, noise: float = 0.35, seed: int = 0):
+    """
+    generate a clustered gallery like the one produced by face clustering
+    :param n_identities: number of identities
+    :param n_clusters: embeddings per identity
+    :param dim: embedding dimension
+    :param noise: intra identity noise
+    :param seed:
+    :return: identity centers, gallery matrix, gallery labels
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(n_identities, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    labels = np.repeat(np.arange(n_identities), n_clusters)
+    gallery = centers[labels] + noise * rng.normal(size=(labels.shape[0], dim)).astype(np.float32) / np.sqrt(dim)
+    return centers, gallery, labels
+
+
+def synthetic_probes(centers: np.ndarray, n_probes: int, noise: float = 0.35, seed: int = 1):
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, centers.shape[0], size=n_probes)
+    dim = centers.shape[1]
+    probes = centers[labels] + noise * rng.normal(size=(n_probes, dim)).astype(np.float32) / np.sqrt(dim)
+    return probes, labels
+
+
+def _latency(fn, repeat: int) -> float:
+    """
+    median latency of a call in milliseconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000.
+
+
+def ann_benchmark(args) -> None:
+    """
+    compare recall@1 and latency of the ivf and prototype indexes against the exact matching engine
+    :param args:
+    :return: None
+    """
+    n_identities = max(1, args.bench_size // 40)
+    centers, gallery, labels = synthetic_gallery(n_identities=n_identities, n_clusters=40)
+    probes, _ = synthetic_probes(centers, n_probes=args.bench_batch)
+
+    print(f"$ synthetic gallery {gallery.shape}, probe batch {probes.shape}")
+
+    exact = MatchingEngine(similarity_threshold=0.3).fit(gallery)
+    exact_idx, _ = exact.top_k(probes, k=1)
+    rows = [["exact", "-", "-", 1.0, round(_latency(lambda: exact.top_k(probes, k=1), args.bench_repeat), 3)]]
+
+    start = time.perf_counter()
+    index = IVFIndex(similarity_threshold=0.3).fit(gallery)
+    build_time = time.perf_counter() - start
+    print(f"$ ivf index with {index.n_lists} lists built in {build_time:.2f}s")
+
+    for n_probe in [1, 2, 4, 8, 16, 32, 64]:
+        if n_probe > index.n_lists:
+            break
+        index.n_probe = n_probe
+        idx, _ = index.top_k(probes, k=1)
+        recall = float(np.mean(idx[:, 0] == exact_idx[:, 0]))
+        latency = _latency(lambda: index.top_k(probes, k=1), args.bench_repeat)
+        rows.append(["ivf", index.n_lists, n_probe, round(recall, 4), round(latency, 3)])
+
+    prototype = PrototypeIndex(similarity_threshold=0.3).fit(gallery, labels)
+    for shortlist in [1, 2, 5, 10]:
+        prototype.shortlist = shortlist
+        idx, _ = prototype.top_k(probes, k=1)
+        recall = float(np.mean(idx[:, 0] == exact_idx[:, 0]))
+        latency = _latency(lambda: prototype.top_k(probes, k=1), args.bench_repeat)
+        rows.append(["prototype", prototype.n_identities, shortlist, round(recall, 4), round(latency, 3)])
+
+    print(tabulate(rows, headers=["engine", "lists", "n_probe/shortlist", "recall@1", "latency (ms)"]))
+
+
+def lite_benchmark(args) -> None:
+    """
+    compare the tflite FaceNet backends with the pb graph on the faces of the test directory, cosine
+    agreement with the pb embeddings, per crop latency on cpu and top-1 accuracy against the gallery
+    :param args:
+    :return: None
+    """
+    test_images, test_labels, _ = parse_test_dir(args.test_dir)
+    faces = [im.read_image_file(grayscale=False, resize=True) for im in test_images]
+    test_labels = np.array(test_labels)
+    print(f"$ {len(faces)} test faces")
+
+    # the gallery is embedded by the pb graph, a lite backend has to agree with it
+    database = ImageDatabase(db_path=GALLERY_CONF.get("database_path"))
+    gallery_embeds, gallery_labels = database.bulk_embeddings()
+    gallery_labels = np.array(gallery_labels)
+    engine = MatchingEngine(similarity_threshold=float(DEFAULT_CONF.get("similarity_threshold"))).fit(gallery_embeds)
+
+    def _batch(size: int) -> np.ndarray:
+        return np.stack([faces[i % len(faces)] for i in range(size)])
+
+    def _row(backend: str, pipeline: EmbeddingPipeline, embed_fn, reference: np.ndarray) -> list:
+        vectors = pipeline.embed(faces)
+        agreement = np.sum(MatchingEngine._l2_normalize(vectors) * MatchingEngine._l2_normalize(reference), axis=1)
+        idx, _ = engine.top_k(vectors, k=1)
+        accuracy = float(np.mean(gallery_labels[idx[:, 0]] == test_labels))
+        latency = [_latency(lambda: embed_fn(_batch(size)), args.bench_repeat) / size for size in [1, 16]]
+        return [backend, round(float(agreement.mean()), 5), round(float(agreement.min()), 5),
+                round(latency[0], 3), round(latency[1], 3), round(accuracy * 100, 2)]
+
+    rows = []
+    with tf.device("/device:cpu:0"):
+        with tf.Graph().as_default():
+            with tf.compat.v1.Session() as sess:
+                load_model(os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
+                input_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("input:0")
+                embeddings = tf.compat.v1.get_default_graph().get_tensor_by_name("embeddings:0")
+                phase_train = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
+
+                pipeline = EmbeddingPipeline(sess, input_plc, embeddings, phase_train)
+                reference = pipeline.embed(faces)
+                rows.append(_row("pb", pipeline,
+                                 lambda batch: sess.run(embeddings, {phase_train: False, input_plc: batch}),
+                                 reference))
+
+    for precision in LITE_PRECISIONS:
+        lite = load_lite_facenet(precision)
+        rows.append(_row(precision, EmbeddingPipeline(None, None, None, None, model=lite), lite.embed, reference))
+
+    print(tabulate(rows, headers=["backend", "cosine (mean)", "cosine (min)", "ms/crop b1", "ms/crop b16",
+                                  "accuracy"]))
+
+
+def keras_benchmark(args) -> None:
+    """
+    per call latency of the mask classifier by keras predict, the traced call and the frozen call at
+    the batch sizes of a frame, the outputs of every mode are compared with predict
+    :param args:
+    :return: None
+    """
+    model = tf.keras.models.load_model(os.path.join(BASE_DIR, MASK_CONF.get("model")), compile=False)
+    calls = {mode: KerasInference(model, mode) for mode in INFERENCE_MODES}
+    sample_shape = tuple(model.inputs[0].shape[1:])
+
+    rows = []
+    for size in [1, 2, 4, 8, 16]:
+        batch = np.random.RandomState(size).uniform(-1., 1., (size,) + sample_shape).astype(np.float32)
+        reference = calls["predict"](batch)
+        row = [size]
+        for mode, call in calls.items():
+            call(batch)
+            row.append(round(_latency(lambda: call(batch), args.bench_repeat), 3))
+        row.append(max(float(np.abs(calls[mode](batch) - reference).max()) for mode in calls))
+        rows.append(row)
+
+    print(tabulate(rows, headers=["batch"] + [f"{mode} ms" for mode in calls] + ["max abs diff"]))
+
+
+def _read_clip(path: str, n_frames: int) -> list:
+    """
+    :param path: recorded clip
+    :param n_frames: frames to read from the beginning
+    :return: frames resized to the camera model size
+    """
+    size = (int(CAMERA_MODEL_CONF.get("width")), int(CAMERA_MODEL_CONF.get("height")))
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < n_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.resize(frame, size))
+    cap.release()
+    return frames
+
+
+def _clip_throughput(budget: ThreadBudget, frames: list, engine: MatchingEngine, warmup: int = 3) -> float:
+    """
+    frames per second of detection, cropping, embedding and matching under a thread budget
+    """
+    minsize = int(DETECTOR_CONF.get("min_face_size"))
+    threshold = [float(DETECTOR_CONF.get("step1_threshold")),
+                 float(DETECTOR_CONF.get("step2_threshold")),
+                 float(DETECTOR_CONF.get("step3_threshold"))]
+    factor = float(DETECTOR_CONF.get("scale_factor"))
+    facenet = inference_graph("facenet", os.path.join(BASE_DIR, MODEL_CONF.get('facenet')))
+
+    budget.apply()
+    with tf.Graph().as_default() as graph:
+        with tf.compat.v1.Session(config=budget.session_config()) as sess:
+            pnet, rnet, onet = detect_face.create_mtcnn(sess, str(optimized_graph_path("mtcnn")))
+            embed = None
+            if os.path.isfile(facenet):
+                load_model(facenet)
+                input_plc = graph.get_tensor_by_name("input:0")
+                embeddings = graph.get_tensor_by_name("embeddings:0")
+                phase_train = graph.get_tensor_by_name("phase_train:0")
+                embed = lambda batch: sess.run(embeddings, {phase_train: False, input_plc: batch})
+
+            def _frame(frame):
+                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                boxes, _ = detect_face.detect_face(rgb, minsize, pnet, rnet, onet, threshold, factor)
+                faces = []
+                for x_min, y_min, x_max, y_max in boxes[:, :4].astype(int):
+                    face = rgb[max(y_min, 0):max(y_max, 0), max(x_min, 0):max(x_max, 0)]
+                    if face.size:
+                        faces.append(normalize_input(cv2.resize(face, (160, 160))))
+                if faces and embed is not None:
+                    engine.top_k(embed(np.array(faces)), k=1)
+
+            for frame in frames[:warmup]:
+                _frame(frame)
+            start = time.perf_counter()
+            for frame in frames[warmup:]:
+                _frame(frame)
+            return (len(frames) - warmup) / (time.perf_counter() - start)
+
+
+def threads_benchmark(args) -> None:
+    """
+    sweep thread budgets of tensorflow, opencv and the BLAS on a recorded clip and print the one with
+    the best throughput for this machine, every budget runs on a fresh session
+    :param args:
+    :return: None
+    """
+    frames = _read_clip(args.video_file, args.bench_frames)
+    if len(frames) < 4:
+        raise ValueError(f"{args.video_file} should have at least 4 frames")
+
+    # the embeddings are matched against a gallery of the benchmark size, which loads the BLAS
+    _, gallery, _ = synthetic_gallery(n_identities=max(1, args.bench_size // 40), n_clusters=40)
+    engine = MatchingEngine(similarity_threshold=float(DEFAULT_CONF.get("similarity_threshold"))).fit(gallery)
+
+    n = os.cpu_count() or 1
+    counts = sorted({1, max(1, n // 4), max(1, n // 2), n})
+    print(f"$ {len(frames)} frames of {args.video_file}, {n} cpus, gallery {gallery.shape}")
+
+    rows = []
+    for intra, inter, opencv, blas in product(counts, [1, 2], [0, max(1, n // 4)], [1, max(1, n // 2)]):
+        budget = ThreadBudget(tf_intra_op=intra, tf_inter_op=inter, opencv=opencv, blas=blas)
+        rows.append([intra, inter, opencv, blas, round(_clip_throughput(budget, frames, engine), 2)])
+        print(f"$ {budget} -> {rows[-1][-1]} fps")
+
+    rows.sort(key=lambda r: -r[-1])
+    print(tabulate(rows, headers=["tf_intra_op", "tf_inter_op", "opencv", "blas", "fps"]))
+    intra, inter, opencv, blas, fps = rows[0]
+    print(f"$ best {fps} fps, [Threads] tf_intra_op = {intra}, tf_inter_op = {inter}, opencv = {opencv}, "
+          f"blas = {blas}")
+
+
+def pyramid_benchmark(args) -> None:
+    """
+    frames/sec of MTCNN on a recorded clip with P-Net once per pyramid scale and once on the packed
+    pyramid, the detections of the packed run are compared with the per scale run frame by frame
+    :param args:
+    :return: None
+    """
+    frames = [cv2.cvtColor(f, cv2.COLOR_BGR2RGB) for f in _read_clip(args.video_file, args.bench_frames)]
+    if not frames:
+        raise ValueError(f"{args.video_file} has no frames")
+    minsize = int(DETECTOR_CONF.get("min_face_size"))
+    threshold = [float(DETECTOR_CONF.get("step1_threshold")),
+                 float(DETECTOR_CONF.get("step2_threshold")),
+                 float(DETECTOR_CONF.get("step3_threshold"))]
+    factor = float(DETECTOR_CONF.get("scale_factor"))
+
+    with tf.Graph().as_default():
+        with tf.compat.v1.Session() as sess:
+            pnet, rnet, onet = detect_face.create_mtcnn(sess, str(optimized_graph_path("mtcnn")))
+            calls = []
+            counted_pnet = lambda img: calls.append(img.shape) or pnet(img)
+
+            rows, boxes = [], {}
+            for packed in [False, True]:
+                detect_face.detect_face(frames[0], minsize, counted_pnet, rnet, onet, threshold, factor, packed)
+                calls.clear()
+                start = time.perf_counter()
+                boxes[packed] = [detect_face.detect_face(f, minsize, counted_pnet, rnet, onet, threshold, factor,
+                                                         packed)[0] for f in frames]
+                elapsed = time.perf_counter() - start
+                rows.append(["packed" if packed else "per scale", round(len(calls) / len(frames), 2),
+                             round(len(frames) / elapsed, 2)])
+
+    same = [a.shape == b.shape and np.allclose(a, b, atol=1.) for a, b in zip(boxes[False], boxes[True])]
+    print(f"$ {len(frames)} frames of {frames[0].shape[:2]}, {sum(same)} with the same detections")
+    print(tabulate(rows, headers=["P-Net", "P-Net calls/frame", "fps"]))
+
+
+def detection_benchmark(args) -> None:
+    """
+    profile the stages of MTCNN on a recorded clip, a dense crowd gives R-Net and O-Net hundreds of
+    candidates, with the candidates cropped box by box and by the batched crop
+    :param args:
+    :return: None
+    """
+    frames = [cv2.cvtColor(f, cv2.COLOR_BGR2RGB) for f in _read_clip(args.video_file, args.bench_frames)]
+    if not frames:
+        raise ValueError(f"{args.video_file} has no frames")
+    minsize = int(DETECTOR_CONF.get("min_face_size"))
+    threshold = [float(DETECTOR_CONF.get("step1_threshold")),
+                 float(DETECTOR_CONF.get("step2_threshold")),
+                 float(DETECTOR_CONF.get("step3_threshold"))]
+    factor = float(DETECTOR_CONF.get("scale_factor"))
+    stages = ["pnet", "crop24", "rnet", "crop48", "onet"]
+
+    rows = []
+    with tf.Graph().as_default():
+        with tf.compat.v1.Session() as sess:
+            pnet, rnet, onet = detect_face.create_mtcnn(sess, str(optimized_graph_path("mtcnn")))
+            candidates = []
+            counted_rnet = lambda batch: candidates.append(batch.shape[0]) or rnet(batch)
+
+            for batched in [False, True]:
+                detect_face.detect_face(frames[0], minsize, pnet, rnet, onet, threshold, factor,
+                                        batched_crops=batched)
+                timings, candidates[:] = {}, []
+                start = time.perf_counter()
+                for frame in frames:
+                    detect_face.detect_face(frame, minsize, pnet, counted_rnet, onet, threshold, factor,
+                                            batched_crops=batched, timings=timings)
+                elapsed = time.perf_counter() - start
+                rows.append(["batched" if batched else "box by box"] +
+                            [round(timings.get(stage, 0.) * 1000. / len(frames), 3) for stage in stages] +
+                            [round(elapsed * 1000. / len(frames), 3), round(len(frames) / elapsed, 2)])
+
+    print(f"$ {len(frames)} frames, {np.mean(candidates) if candidates else 0:.1f} R-Net candidates per frame")
+    print(tabulate(rows, headers=["crops"] + [f"{stage} ms" for stage in stages] + ["frame ms", "fps"]))
+
+
+def roi_benchmark(args) -> None:
+    """
+    milliseconds/frame of MTCNN on a recorded clip scanning the whole frame against scanning the motion
+    regions and the predicted boxes of the tracks, like the track-let server with roi_detection, the
+    motion detection and tracking are counted in the roi run
+    :param args:
+    :return: None
+    """
+    frames = _read_clip(args.video_file, args.bench_frames)
+    if not frames:
+        raise ValueError(f"{args.video_file} has no frames")
+    minsize = int(DETECTOR_CONF.get("min_face_size"))
+    threshold = [float(DETECTOR_CONF.get("step1_threshold")),
+                 float(DETECTOR_CONF.get("step2_threshold")),
+                 float(DETECTOR_CONF.get("step3_threshold"))]
+    factor = float(DETECTOR_CONF.get("scale_factor"))
+
+    rows = []
+    with tf.Graph().as_default():
+        with tf.compat.v1.Session() as sess:
+            pnet, rnet, onet = detect_face.create_mtcnn(sess, str(optimized_graph_path("mtcnn")))
+            detect_face.detect_face(cv2.cvtColor(frames[0], cv2.COLOR_BGR2RGB), minsize, pnet, rnet, onet,
+                                    threshold, factor)
+
+            for roi in [False, True]:
+                planner = RoiPlanner(full_scan=int(DETECTOR_CONF.get("roi_full_scan")),
+                                     padding=float(DETECTOR_CONF.get("roi_padding")), min_side=2 * minsize)
+                motion, track_let = BSMotionDetection(), TrackLet(0.9, 1)
+                faces, area = 0, 0.
+                start = time.perf_counter()
+                for frame in frames:
+                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                    rois = planner.plan(frame.shape[:2], motion.motion_regions(frame),
+                                        track_let.predicted_boxes()) if roi else None
+                    if rois is None:
+                        boxes, points = detect_face.detect_face(rgb, minsize, pnet, rnet, onet, threshold, factor)
+                        area += 1.
+                    else:
+                        boxes, points = detect_face.detect_face_rois(rgb, rois, minsize, pnet, rnet, onet,
+                                                                     threshold, factor)
+                        area += np.sum((rois[:, 2] - rois[:, 0]) * (rois[:, 3] - rois[:, 1])) / \
+                            float(frame.shape[0] * frame.shape[1])
+                    faces += len(boxes)
+                    if roi:
+                        track_let.detect(boxes, frame, points, frame.shape)
+                elapsed = time.perf_counter() - start
+                rows.append(["roi" if roi else "full frame", planner.full_scans if roi else len(frames),
+                             round(area / len(frames), 3), round(faces / len(frames), 2),
+                             round(elapsed * 1000. / len(frames), 3)])
+
+    print(f"$ {len(frames)} frames of {frames[0].shape[:2]}")
+    print(tabulate(rows, headers=["scan", "full scans", "scanned area", "faces/frame", "frame ms"]))
+
+
+def synthetic_boxes(n_boxes: int, n_clusters: int = 20, size: int = 640, seed: int = 0) -> np.ndarray:
+    """
+    P-Net like candidates, jittered boxes around a few faces with random scores
+    :param n_boxes: number of boxes
+    :param n_clusters: number of faces
+    :param size: side of the frame
+    :param seed:
+    :return: boxes in shape (n_boxes,5) as (x_min, y_min, x_max, y_max, score)
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0., size, (n_clusters, 2))
+    sides = rng.uniform(20., 120., n_clusters)
+    cluster = rng.randint(0, n_clusters, n_boxes)
+    center = centers[cluster] + rng.normal(scale=0.15, size=(n_boxes, 2)) * sides[cluster, None]
+    half = (sides[cluster] * rng.uniform(0.8, 1.2, n_boxes))[:, None] / 2.
+    return np.hstack([np.fix(center - half), np.fix(center + half), rng.uniform(0.6, 1., (n_boxes, 1))])
+
+
+def nms_benchmark(args) -> None:
+    """
+    latency of the one box at a time nms against the blocked kernel on clustered candidates, the picks
+    of both should be equal
+    :param args:
+    :return: None
+    """
+    rows = []
+    for n_boxes in [100, 1000, 3000, 10000]:
+        boxes = synthetic_boxes(n_boxes)
+        for method in [NMS_UNION, NMS_MIN]:
+            loop = non_max_suppression_loop(boxes, boxes[:, 4], 0.7, method)
+            blocked = non_max_suppression(boxes, boxes[:, 4], 0.7, method)
+            rows.append([n_boxes, method, loop.size,
+                         round(_latency(lambda: non_max_suppression_loop(boxes, boxes[:, 4], 0.7, method),
+                                        args.bench_repeat), 3),
+                         round(_latency(lambda: non_max_suppression(boxes, boxes[:, 4], 0.7, method),
+                                        args.bench_repeat), 3),
+                         np.array_equal(loop, blocked)])
+
+    print(tabulate(rows, headers=["boxes", "method", "kept", "loop ms", "blocked ms", "equal"]))
@@ -1,5 +1,19 @@
+import os
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
 import tensorflow as tf
+from tabulate import tabulate
+from tensorflow.core.framework import node_def_pb2
+from tensorflow.core.protobuf import config_pb2, meta_graph_pb2, rewriter_config_pb2
+from tensorflow.python.grappler import tf_optimizer
 from tensorflow.python.platform import gfile
+from tensorflow.python.tools import optimize_for_inference_lib
+
+from face_detection.mtcnn import detect_face
+from recognition.utils import optimized_graph_path
+from settings import BASE_DIR, MODEL_CONF, HPE_CONF
 
 
 def pb_to_tensorboard(log_dir, model_dir):
@@ -46,3 +60,171 @@ def computation_graph_inspect(model_dir,flags ):
                 all_placeholders = [placeholder for op in tf.compat.v1.get_default_graph().get_operations() if
                                     op.type == 'Placeholder' for placeholder in op.values()]
                 print(all_placeholders)
+
+
+# placeholders which only select the training branches, they are frozen to these values
+INFERENCE_CONSTANTS = {"phase_train": False}
+
+# fetched tensors of create_mtcnn
+MTCNN_OUTPUTS = ["pnet/conv4-2/BiasAdd", "pnet/prob1", "rnet/conv5-2/conv5-2", "rnet/prob1",
+                 "onet/conv6-2/conv6-2", "onet/conv6-3/conv6-3", "onet/prob1"]
+
+
+def read_graph_def(model_path) -> tf.compat.v1.GraphDef:
+    """
+    :param model_path: frozen graph (.pb)
+    :return: GraphDef
+    """
+    with tf.compat.v1.gfile.GFile(str(model_path), 'rb') as f:
+        graph_def = tf.compat.v1.GraphDef()
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def freeze_mtcnn() -> tf.compat.v1.GraphDef:
+    """
+    build the three MTCNN stages from their npy weights and freeze them into one graph
+    :return: GraphDef which keeps the pnet, rnet and onet tensor names of create_mtcnn
+    """
+    with tf.Graph().as_default() as graph:
+        with tf.compat.v1.Session() as sess:
+            detect_face.create_mtcnn(sess)
+            return tf.compat.v1.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(),
+                                                                          MTCNN_OUTPUTS)
+
+
+def optimize_graph_def(graph_def: tf.compat.v1.GraphDef, outputs: List[str],
+                       constants: Optional[Dict[str, bool]] = None) -> tf.compat.v1.GraphDef:
+    """
+    inference only graph, the training placeholders are frozen so the training branches of every
+    cond are dead, then constants are folded, batch norms are folded into the convolutions and the
+    nodes which do not reach an output are dropped
+    :param graph_def: frozen graph
+    :param outputs: output node names
+    :param constants: bool placeholders and their inference value, INFERENCE_CONSTANTS by default
+    :return: GraphDef
+    """
+    constants = INFERENCE_CONSTANTS if constants is None else constants
+
+    frozen = tf.compat.v1.GraphDef()
+    frozen.versions.CopyFrom(graph_def.versions)
+    frozen.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.name in constants and node.op in ["Placeholder", "PlaceholderWithDefault"]:
+            frozen.node.append(_bool_const(node.name, constants[node.name]))
+        else:
+            frozen.node.add().CopyFrom(node)
+    frozen = tf.compat.v1.graph_util.extract_sub_graph(frozen, outputs)
+
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(frozen, name='')
+        meta_graph = tf.compat.v1.train.export_meta_graph(graph=graph)
+    fetch = meta_graph_pb2.CollectionDef()
+    fetch.node_list.value.extend(outputs)
+    meta_graph.collection_def["train_op"].CopyFrom(fetch)
+
+    config = config_pb2.ConfigProto()
+    rewrite = config.graph_options.rewrite_options
+    rewrite.optimizers.extend(["pruning", "constfold", "arithmetic", "dependency", "loop", "debug_stripper"])
+    rewrite.meta_optimizer_iterations = rewriter_config_pb2.RewriterConfig.TWO
+    optimized = tf_optimizer.OptimizeGraph(config, meta_graph)
+    optimized = tf.compat.v1.graph_util.extract_sub_graph(optimize_for_inference_lib.fold_batch_norms(optimized),
+                                                          outputs)
+
+    # callers keep feeding the training placeholders, they are left in the graph without consumers
+    names = {node.name for node in optimized.node}
+    for name, value in constants.items():
+        if name in {node.name for node in graph_def.node} and name not in names:
+            default = _bool_const(f"{name}/default", value)
+            placeholder = node_def_pb2.NodeDef(op="PlaceholderWithDefault", name=name, input=[default.name])
+            placeholder.attr["dtype"].type = tf.bool.as_datatype_enum
+            placeholder.attr["shape"].shape.CopyFrom(tf.TensorShape([]).as_proto())
+            optimized.node.extend([default, placeholder])
+    return optimized
+
+
+def _bool_const(name: str, value: bool) -> node_def_pb2.NodeDef:
+    node = node_def_pb2.NodeDef(op="Const", name=name)
+    node.attr["dtype"].type = tf.bool.as_datatype_enum
+    node.attr["value"].tensor.CopyFrom(tf.compat.v1.make_tensor_proto(value, dtype=tf.bool))
+    return node
+
+
+def op_profile(graph_def: tf.compat.v1.GraphDef, feed: Dict[str, np.ndarray], outputs: List[str],
+               repeat: int = 10) -> Dict[str, Tuple[int, float]]:
+    """
+    count and mean latency of every op type over traced runs of a graph
+    :param graph_def: frozen graph
+    :param feed: tensor name to sample input
+    :param outputs: output node names
+    :param repeat: traced runs after one warm up run
+    :return: op type to (number of nodes, milliseconds per run)
+    """
+    op_types = {node.name: node.op for node in graph_def.node}
+    counts = Counter(op_types.values())
+    micros = Counter()
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        fetches = [graph.get_tensor_by_name(f"{name}:0") for name in outputs]
+        feed = {name: value for name, value in feed.items() if name.split(":")[0] in op_types}
+        with tf.compat.v1.Session() as sess:
+            sess.run(fetches, feed_dict=feed)
+            options = tf.compat.v1.RunOptions(trace_level=tf.compat.v1.RunOptions.FULL_TRACE)
+            for _ in range(repeat):
+                metadata = tf.compat.v1.RunMetadata()
+                sess.run(fetches, feed_dict=feed, options=options, run_metadata=metadata)
+                for device in metadata.step_stats.dev_stats:
+                    for stats in device.node_stats:
+                        op = op_types.get(stats.node_name.split(":")[0])
+                        if op is not None:
+                            micros[op] += stats.op_end_rel_micros - stats.op_start_rel_micros
+    return {op: (counts[op], micros[op] / repeat / 1000.) for op in counts}
+
+
+def _inference_graphs() -> Dict[str, Tuple[Callable, List[str], Dict[str, tuple]]]:
+    """
+    :return: name to (graph_def loader, outputs, sample input shapes) of the served graphs
+    """
+    return {
+        "facenet": (lambda: read_graph_def(os.path.join(BASE_DIR, MODEL_CONF.get("facenet"))),
+                    ["embeddings"],
+                    {"input:0": (1, 160, 160, 3)}),
+        "hpe": (lambda: read_graph_def(os.path.join(BASE_DIR, HPE_CONF.get("model"))),
+                ["Identity"],
+                {"x:0": (1, 64, 64, 1)}),
+        "mtcnn": (freeze_mtcnn,
+                  MTCNN_OUTPUTS,
+                  {"pnet/input:0": (1, 120, 160, 3), "rnet/input:0": (1, 24, 24, 3), "onet/input:0": (1, 48, 48, 3)})
+    }
+
+
+def optimize_inference_graphs(names: Optional[List[str]] = None, repeat: int = 10) -> None:
+    """
+    write the inference only graphs of facenet, hpe and mtcnn into the optimized_dir of the model config
+    and report op counts and per op latency before and after
+    :param names: graphs to optimize, all by default
+    :param repeat: traced runs of the latency report
+    :return: None
+    """
+    for name, (loader, outputs, shapes) in _inference_graphs().items():
+        if names and name not in names:
+            continue
+        graph_def = loader()
+        optimized = optimize_graph_def(graph_def, outputs)
+        path = optimized_graph_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(optimized.SerializeToString())
+        print(f"$ {name}: {len(graph_def.node)} -> {len(optimized.node)} nodes, written to {path}")
+
+        feed = {tensor: np.random.rand(*shape).astype(np.float32) for tensor, shape in shapes.items()}
+        feed.update({f"{c}:0": v for c, v in INFERENCE_CONSTANTS.items()})
+        before = op_profile(graph_def, feed, outputs, repeat)
+        after = op_profile(optimized, feed, outputs, repeat)
+        rows = []
+        for op in sorted(set(before) | set(after), key=lambda o: -before.get(o, (0, 0.))[1]):
+            b_count, b_ms = before.get(op, (0, 0.))
+            a_count, a_ms = after.get(op, (0, 0.))
+            rows.append([op, b_count, a_count, round(b_ms, 3), round(a_ms, 3)])
+        rows.append(["total", sum(r[1] for r in rows), sum(r[2] for r in rows),
+                     round(sum(v[1] for v in before.values()), 3), round(sum(v[1] for v in after.values()), 3)])
+        print(tabulate(rows, headers=["op", "nodes before", "nodes after", "ms before", "ms after"]))
@@ -116,6 +116,14 @@ class TrackLet:
 
         return dist_rate, high_ratio_variance, width_ratio_variance
 
+    def predicted_boxes(self) -> np.ndarray:
+        """
+        boxes where the tracked faces are expected in the next frame given to detect
+        :return: boxes in shape (n,4) as (x_min, y_min, x_max, y_max)
+        """
+        boxes = np.array([trk.peek() for trk in self._tracker.trackers]).reshape(-1, 4)
+        return boxes[~np.any(np.isnan(boxes), axis=1)]
+
     def detect(self, faces: np.ndarray, frame: np.ndarray, points: np.ndarray, frame_size: tuple) -> np.ndarray:
         attribute_list = []
 
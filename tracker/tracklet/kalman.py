@@ -59,6 +59,15 @@ class KalmanBoxTracker(object):
         self.history.append(convert_x_to_bbox(self.kf.x))
         return self.history[-1][0]
 
+    def peek(self):
+        """
+        Returns the bounding box estimate of the next predict without advancing the state vector.
+        """
+        x = self.kf.x.copy()
+        if (x[6] + x[2]) <= 0:
+            x[6] *= 0.0
+        return convert_x_to_bbox(np.dot(self.kf.F, x))[0]
+
     def get_state(self):
         """
         Returns the current bounding box estimate.
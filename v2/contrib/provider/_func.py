@@ -9,6 +9,8 @@ from v2.core.network import (MultiCascadeFaceDetector,
                              HPEModel)
 from v2.core.engine import RawVisualService, ClusteringService
 from v2.tools.logger import LOG_Path
+from v2.tools import ThreadBudget
+from recognition.utils import inference_graph, optimized_graph_path
 from settings import (CAMERA_MODEL_CONF,
                       BASE_DIR,
                       DETECTOR_CONF,
@@ -16,7 +18,8 @@ from settings import (CAMERA_MODEL_CONF,
                       GALLERY_CONF,
                       DEFAULT_CONF,
                       MASK_CONF,
-                      HPE_CONF)
+                      HPE_CONF,
+                      THREADS_CONF)
 # from settings import (PATH_NORMAL,
 #                       PATH_MASK)
 
@@ -35,17 +38,29 @@ def raw_visual_v1_service() -> RawVisualService:
         float(DETECTOR_CONF.get("step2_threshold")),
         float(DETECTOR_CONF.get("step3_threshold"))]
     factor = float(DETECTOR_CONF.get("scale_factor"))
+    buckets = [int(b) for b in MODEL_CONF.get("batch_buckets").split(",")]
+    # every model on its own graph and session, the pose and mask stages then overlap the detection
+    isolated = MODEL_CONF.getboolean("isolated_sessions")
+    # the detector, embedding, mask and pose sessions share the budget instead of each taking all of it
+    session_config = ThreadBudget.from_config(THREADS_CONF).session_config(sessions=4 if isolated else 1)
+    isolation = {"isolated": isolated, "session_config": session_config}
     face_dm = MultiCascadeFaceDetector(stages_threshold=threshold, scale_factor=factor, min_face=minsize,
-                                       name="raw_face_detector")
+                                       name="raw_face_detector", batch_buckets=buckets,
+                                       graph_path=str(optimized_graph_path("mtcnn")),
+                                       packed_pyramid=DETECTOR_CONF.getboolean("packed_pyramid"),
+                                       max_candidates=int(DETECTOR_CONF.get("nms_max_candidates")),
+                                       **isolation)
 
-    embedded_model = FaceNetModel(model_path=base.joinpath(MODEL_CONF.get('facenet')))
+    facenet_path = Path(inference_graph("facenet", base.joinpath(MODEL_CONF.get('facenet'))))
+    embedded_model = FaceNetModel(model_path=facenet_path, batch_buckets=buckets, **isolation)
 
     db = SimpleDatabase(db_path=base.joinpath(GALLERY_CONF.get("database_path")))
 
     distance = CosineDistanceV2(similarity_threshold=float(DEFAULT_CONF.get("similarity_threshold")))
 
     mask_detector = MaskModel(model_path=base.joinpath(MASK_CONF.get("model")),
-                              score_threshold=float(MASK_CONF.get("score_threshold")))
+                              score_threshold=float(MASK_CONF.get("score_threshold")), batch_buckets=buckets,
+                              keras_inference=MODEL_CONF.get("keras_inference"), **isolation)
 
     hpe_conf = (
         float(HPE_CONF.get("pan_left")),
@@ -54,12 +69,14 @@ def raw_visual_v1_service() -> RawVisualService:
         float(HPE_CONF.get("tilt_down"))
     )
 
-    hpe = HPEModel(model_path=base.joinpath(HPE_CONF.get("model")),
+    hpe = HPEModel(model_path=Path(inference_graph("hpe", base.joinpath(HPE_CONF.get("model")))),
                    img_norm=(float(HPE_CONF.get("im_norm_mean")), float(HPE_CONF.get("im_norm_var"))),
                    tilt_norm=(float(HPE_CONF.get("tilt_norm_mean")), float(HPE_CONF.get("tilt_norm_var"))),
                    pan_norm=(float(HPE_CONF.get("pan_norm_mean")), float(HPE_CONF.get("pan_norm_var"))),
                    rescale=float(HPE_CONF.get("rescale")),
-                   conf=hpe_conf
+                   conf=hpe_conf,
+                   batch_buckets=buckets,
+                   **isolation
                    )
 
     return RawVisualService(source_pool=vision_source(),
@@ -70,4 +87,7 @@ def raw_visual_v1_service() -> RawVisualService:
                             mask_detector=mask_detector,
                             hpe=hpe,
                             log_path=LOG_Path,
+                            pipelined=isolated,
+                            detect_batch=int(DETECTOR_CONF.get("detect_batch")),
+                            session_config=session_config,
                             name="basic_raw_visualization_service")
@@ -1,8 +1,22 @@
 from .base import BaseDistance
 from ._dist import CosineDistance, SklearnCosineDistance, EuclideanDistance,SklearnEuclideanDistance
+from ._engine import MatchingEngine
+from ._ann import IVFIndex
+from ._prototype import PrototypeIndex
+from ._quantized import QuantizedEngine
+from ._aggregate import IdentityAggregator, IdentityLayout, identity_reduce
+from ._graph import GraphMatcher
+from ._factory import create_distance
 
 Distance = BaseDistance
 CosineDistanceV1 = CosineDistance
 CosineDistanceV2 = SklearnCosineDistance
 EuclideanDistanceV1 = EuclideanDistance
 EuclideanDistanceV2 = SklearnEuclideanDistance
+MatchingEngine = MatchingEngine
+IVFIndex = IVFIndex
+PrototypeIndex = PrototypeIndex
+QuantizedEngine = QuantizedEngine
+IdentityAggregator = IdentityAggregator
+GraphMatcher = GraphMatcher
+DistanceFactory = create_distance
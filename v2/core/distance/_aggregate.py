@@ -0,0 +1,181 @@
+from typing import Tuple, Union
+
+import numpy as np
+
+# base
+from ._engine import MatchingEngine
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError, NoPassingArgumentError
+
+
+class IdentityLayout:
+    """
+    padded (identities, max_count) table of gallery columns, the padding points to an extra column
+    so every identity is reduced by the same numpy call
+    """
+
+    def __init__(self, labels: np.ndarray):
+        labels = np.asarray(labels)
+        self._identities, inverse = np.unique(labels, return_inverse=True)
+        self._inverse = inverse.reshape(-1).astype(np.int64)
+        size = self._inverse.shape[0]
+        counts = np.bincount(self._inverse, minlength=self._identities.shape[0])
+        width = int(counts.max()) if counts.shape[0] else 0
+
+        order = np.argsort(self._inverse, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        position = np.arange(size) - offsets[self._inverse[order]]
+        self._table = np.full((self._identities.shape[0], width), size, dtype=np.int64)
+        self._table[self._inverse[order], position] = order
+        self._counts = counts
+
+    @property
+    def identities(self) -> np.ndarray:
+        return self._identities
+
+    @property
+    def inverse(self) -> np.ndarray:
+        return self._inverse
+
+    @property
+    def table(self) -> np.ndarray:
+        return self._table
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self._counts
+
+
+def _padded_reduce(padded: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param padded: distances in shape (n,identities,max_count), padding is inf
+    :param k: number of neighbours
+    :return: min, top k mean, votes and the position of the closest row inside every identity
+    """
+    n_probes, n_identities, width = padded.shape
+    nearest_pos = np.argmin(padded, axis=2)
+    d_min = np.take_along_axis(padded, nearest_pos[:, :, None], axis=2)[:, :, 0]
+
+    k_id = max(1, min(k, width))
+    closest = np.partition(padded, k_id - 1, axis=2)[:, :, :k_id] if k_id < width else padded
+    finite = np.isfinite(closest)
+    n_finite = finite.sum(axis=2)
+    d_mean = np.where(finite, closest, 0.).sum(axis=2) / np.maximum(n_finite, 1)
+    d_mean[n_finite == 0] = np.inf
+
+    # the k nearest neighbours are among the k closest rows of every identity
+    flat = closest.reshape((n_probes, n_identities * closest.shape[2]))
+    k_nn = max(1, min(k, flat.shape[1]))
+    neighbours = np.argpartition(flat, k_nn - 1, axis=1)[:, :k_nn]
+    valid = np.isfinite(np.take_along_axis(flat, neighbours, axis=1))
+    bins = neighbours // closest.shape[2] + np.arange(n_probes)[:, None] * n_identities
+    votes = np.bincount(bins[valid], minlength=n_probes * n_identities).reshape((n_probes, n_identities))
+
+    return d_min, d_mean, votes, nearest_pos
+
+
+def identity_reduce(dist: np.ndarray, layout: IdentityLayout, k: int = 3) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    segment reduction of probe to gallery distances over identities in one pass
+    :param dist: matrix in shape (n,k), inf marks rows which are not scored
+    :param layout: IdentityLayout of the gallery labels
+    :param k: number of neighbours for the top k mean and the vote
+    :return: min distance, mean of the k closest distances, votes among the k nearest neighbours in
+             shape (n,identities) and the gallery index of the closest row of every identity
+    """
+    if len(dist.shape) != 2:
+        raise InCompatibleDimError("The dist is not 2 dimension")
+    if dist.shape[1] != layout.inverse.shape[0]:
+        raise InCompatibleDimError("The dist is not compatible with labels")
+
+    n_probes, n_identities = dist.shape[0], layout.identities.shape[0]
+    if n_identities == 0:
+        empty = np.empty((n_probes, 0))
+        return empty, empty, np.empty((n_probes, 0), dtype=np.int64), np.empty((n_probes, 0), dtype=np.int64)
+
+    padded = np.concatenate([dist, np.full((n_probes, 1), np.inf, dtype=dist.dtype)], axis=1)[:, layout.table]
+    d_min, d_mean, votes, nearest_pos = _padded_reduce(padded, k)
+    return d_min, d_mean, votes, layout.table[np.arange(n_identities)[None, :], nearest_pos]
+
+
+class IdentityAggregator(MatchingEngine):
+    """
+    identity level decisions, every probe is scored against all gallery vectors once and the distances
+    are reduced per identity by the min, the mean of the k closest or the k nearest neighbour vote
+    """
+    AGG_MIN = "min"
+    AGG_MEAN = "mean"
+    AGG_VOTE = "vote"
+
+    __aggregates = [AGG_MIN, AGG_MEAN, AGG_VOTE]
+
+    def __init__(self, similarity_threshold: float, k: int = 3, aggregate: str = "mean",
+                 metric: str = "angular", name=None, *args, **kwargs):
+        if aggregate not in self.__aggregates:
+            raise ValueError(f"aggregate {aggregate} is unknown")
+        self._k = max(1, int(k))
+        self._aggregate = aggregate
+        self._layout = None
+        super(IdentityAggregator, self).__init__(similarity_threshold=similarity_threshold, metric=metric,
+                                                 name=name, *args, **kwargs)
+
+    def fit(self, bs_obs: np.ndarray, labels: Union[np.ndarray, None] = None) -> "IdentityAggregator":
+        """
+        fit the gallery like MatchingEngine and build the identity layout of the labels, the gallery is
+        scored unpadded and the distances are gathered per identity through the layout
+        :param bs_obs: matrix in shape (k,m)
+        :param labels: encoded identity of each gallery row in shape (k,)
+        :return: self
+        """
+        if labels is None:
+            raise NoPassingArgumentError("labels are required to aggregate distances per identity")
+        super(IdentityAggregator, self).fit(bs_obs, labels)
+        self._layout = IdentityLayout(self._labels)
+        return self
+
+    def calculate_distant(self, n_obs: np.ndarray, bs_obs: Union[np.ndarray, None] = None) -> np.ndarray:
+        """
+        :param n_obs: matrix in shape (n,m)
+        :param bs_obs: only the fitted gallery is accepted, a new gallery needs its labels so fit it first
+        :return: matrix in shape (n,k)
+        """
+        if bs_obs is not None and bs_obs is not self._source:
+            raise NoPassingArgumentError("labels of bs_obs are required, call fit(bs_obs, labels) first")
+        return super(IdentityAggregator, self).calculate_distant(n_obs)
+
+    @property
+    def layout(self) -> IdentityLayout:
+        return self._layout
+
+    def aggregate(self, n_obs: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param n_obs: matrix in shape (n,m)
+        :return: min distance, top k mean distance, votes and nearest gallery index in shape (n,identities)
+        """
+        if self._layout is None:
+            raise NoPassingArgumentError("the gallery is not fitted, call fit first")
+        return identity_reduce(self._to_distance(self.similarity(n_obs)), self._layout, self._k)
+
+    def top_k(self, n_obs: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        k best identities of every probe
+        :param n_obs: matrix in shape (n,m)
+        :param k: number of identities
+        :return: gallery index of the closest row of each identity and the aggregated distance in
+                 shape (n,k) sorted by decision
+        """
+        d_min, d_mean, votes, nearest = self.aggregate(n_obs)
+        k = min(k, d_min.shape[1])
+        if k <= 0:
+            return np.empty((d_min.shape[0], 0), dtype=np.int64), np.empty((d_min.shape[0], 0))
+
+        score = d_min if self._aggregate == self.AGG_MIN else d_mean
+        if self._aggregate == self.AGG_VOTE:
+            # more votes first, the top k mean breaks ties
+            order = np.lexsort((d_mean, -votes), axis=1)[:, :k]
+        else:
+            order = np.argsort(score, axis=1, kind="stable")[:, :k]
+
+        return np.take_along_axis(nearest, order, axis=1), np.take_along_axis(score, order, axis=1)
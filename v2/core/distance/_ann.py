@@ -0,0 +1,138 @@
+import json
+from pathlib import Path
+from typing import Tuple, Union
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+# base
+from ._shortlist import ShortlistEngine
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError, NoPassingArgumentError
+
+
+class IVFIndex(ShortlistEngine):
+    """
+    inverted file index, the gallery is partitioned by spherical k-means and a probe is scored
+    only against the n_probe closest lists. n_probe is the recall/latency knob.
+    """
+    META = "index.json"
+    CENTROIDS = "centroids.npy"
+    VECTORS = "vectors.npy"
+    IDS = "ids.npy"
+    OFFSETS = "offsets.npy"
+    TRAIN_PER_LIST = 64
+
+    def __init__(self, similarity_threshold: float, n_lists: Union[int, None] = None, n_probe: int = 8,
+                 metric: str = "angular", name=None, *args, **kwargs):
+        self._n_lists = n_lists
+        self._n_probe = n_probe
+        self._centroids = None
+        super(IVFIndex, self).__init__(similarity_threshold=similarity_threshold, metric=metric, name=name,
+                                       *args, **kwargs)
+
+    @property
+    def n_probe(self) -> int:
+        return self._n_probe
+
+    @n_probe.setter
+    def n_probe(self, value: int):
+        self._n_probe = max(1, int(value))
+
+    @property
+    def n_lists(self) -> int:
+        return 0 if self._centroids is None else self._centroids.shape[0]
+
+    def fit(self, bs_obs: np.ndarray, labels: Union[np.ndarray, None] = None) -> "IVFIndex":
+        """
+        train coarse centroids and build the inverted lists
+        :param bs_obs: matrix in shape (k,m)
+        :param labels: encoded identity of each gallery row in shape (k,)
+        :return: self
+        """
+        if len(bs_obs.shape) != 2:
+            raise InCompatibleDimError("The bs_obs is not 2 dimension")
+        if labels is not None and len(labels) != bs_obs.shape[0]:
+            raise InCompatibleDimError("The labels is not compatible with bs_obs")
+
+        gallery = self._l2_normalize(bs_obs)
+        n_lists = self._n_lists if self._n_lists is not None else int(np.sqrt(gallery.shape[0]))
+        n_lists = max(1, min(n_lists, gallery.shape[0]))
+
+        if gallery.shape[0] > 0:
+            # centroids are trained on a sample, every row is assigned afterwards
+            rng = np.random.RandomState(0)
+            n_train = min(gallery.shape[0], n_lists * self.TRAIN_PER_LIST)
+            train = gallery[np.sort(rng.choice(gallery.shape[0], n_train, replace=False))]
+            k_means = KMeans(n_clusters=n_lists, n_init=1, random_state=0)
+            k_means.fit(train)
+            centroids = self._l2_normalize(k_means.cluster_centers_)
+            assign = np.argmax(np.dot(gallery, centroids.T), axis=1)
+        else:
+            centroids = np.empty((0, gallery.shape[1]), dtype=np.float32)
+            assign = np.empty((0,), dtype=np.int64)
+
+        ids = np.argsort(assign, kind="stable")
+        self._centroids = np.ascontiguousarray(centroids)
+        self._gallery = np.ascontiguousarray(gallery[ids])
+        self._ids = ids.astype(np.int64)
+        self._offsets = np.searchsorted(assign[ids], np.arange(centroids.shape[0] + 1)).astype(np.int64)
+        self._labels = None if labels is None else np.asarray(labels)
+        self._source = bs_obs
+        return self
+
+    def save(self, index_path: Path) -> None:
+        """
+        save the index as separate npy files so they can be memory mapped on load
+        :param index_path: directory path
+        :return: None
+        """
+        if not self.is_fitted:
+            raise NoPassingArgumentError("the index is not fitted, call fit first")
+        index_path = Path(index_path)
+        index_path.mkdir(parents=True, exist_ok=True)
+        np.save(str(index_path.joinpath(self.CENTROIDS)), self._centroids)
+        np.save(str(index_path.joinpath(self.VECTORS)), self._gallery)
+        np.save(str(index_path.joinpath(self.IDS)), self._ids)
+        np.save(str(index_path.joinpath(self.OFFSETS)), self._offsets)
+        with open(index_path.joinpath(self.META), 'w') as outfile:
+            json.dump({"n_lists": self.n_lists, "size": self.gallery_size, "dim": int(self._gallery.shape[1])},
+                      outfile)
+
+    @classmethod
+    def exists(cls, index_path: Path) -> bool:
+        return Path(index_path).joinpath(cls.META).is_file()
+
+    def load(self, index_path: Path) -> "IVFIndex":
+        """
+        load a saved index
+        :param index_path: directory path
+        :return: self
+        """
+        index_path = Path(index_path)
+        if not self.exists(index_path):
+            raise FileNotFoundError(f"there is no index at {str(index_path)}")
+        with open(index_path.joinpath(self.META), 'r') as infile:
+            meta = json.load(infile)
+        mmap_mode = 'r' if meta.get("size") else None
+        self._centroids = np.load(str(index_path.joinpath(self.CENTROIDS)), mmap_mode=mmap_mode)
+        self._gallery = np.load(str(index_path.joinpath(self.VECTORS)), mmap_mode=mmap_mode)
+        self._ids = np.load(str(index_path.joinpath(self.IDS)))
+        self._offsets = np.load(str(index_path.joinpath(self.OFFSETS)))
+        self._source = None
+        return self
+
+    def _search(self, n_obs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        normalize probes and find the n_probe closest lists of every probe
+        :param n_obs: matrix in shape (n,m)
+        :return: normalized probes and lists in shape (n,n_probe)
+        """
+        probes = self._normalize_probes(n_obs)
+        n_probe = min(self._n_probe, self.n_lists)
+        if n_probe == 0:
+            return probes, np.empty((probes.shape[0], 0), dtype=np.int64)
+
+        coarse = np.dot(probes, self._centroids.T)
+        return probes, np.argpartition(-coarse, n_probe - 1, axis=1)[:, :n_probe]
@@ -14,16 +14,16 @@ class CosineDistance(BaseDistance):
         self._sim_threshold = similarity_threshold
         super(CosineDistance, self).__init__(name, *args, **kwargs)
 
-    def __cosine_similarity_1_k(self, n_obs: np.ndarray, bs_obs: np.ndarray) -> np.ndarray:
+    def __cosine_similarity_n_k(self, n_obs: np.ndarray, bs_obs: np.ndarray) -> np.ndarray:
         """
-        this function calculate embedding cosine distance respect to embeddings
-        :param bs_obs:
-        :param n_obs:
-        :return: vector in shape (n,)
+        this function calculate embeddings cosine distance respect to embeddings
+        :param bs_obs: matrix in shape (k,m)
+        :param n_obs: matrix in shape (n,m)
+        :return: matrix in shape (n,k)
         """
-        dot = np.sum(np.multiply(n_obs, bs_obs), axis=1)
-        norm = np.linalg.norm(n_obs, axis=1) * np.linalg.norm(bs_obs, axis=1)
-        dist = np.arccos(dot / norm) / np.pi
+        dot = np.dot(n_obs, bs_obs.T)
+        norm = np.outer(np.linalg.norm(n_obs, axis=1), np.linalg.norm(bs_obs, axis=1))
+        dist = np.arccos(np.clip(dot / norm, -1., 1.)) / np.pi
         return dist
 
     def calculate_distant(self, n_obs: np.ndarray, bs_obs: np.ndarray) -> np.ndarray:
@@ -39,11 +39,7 @@ class CosineDistance(BaseDistance):
         if n_obs.shape[1] != bs_obs.shape[1]:
             raise InCompatibleDimError("The n_obs is not compatible with bs_obs")
 
-        dists = list()
-        for idx in range(n_obs.shape[0]):
-            vec = np.expand_dims(n_obs[idx], axis=0)
-            dists.append(self.__cosine_similarity_1_k(vec, bs_obs))
-        return np.array(dists)
+        return self.__cosine_similarity_n_k(n_obs, bs_obs)
 
     def satisfy(self, r_obs: np.ndarray) -> np.ndarray:
         """
@@ -0,0 +1,142 @@
+from typing import Tuple, Union
+
+import numpy as np
+
+# base
+from .base import BaseDistance
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError, NoPassingArgumentError
+
+
+class MatchingEngine(BaseDistance):
+    """
+    vectorized gallery matcher, the gallery is normalized once on fit and every probe batch
+    is scored with a single float32 matrix multiply
+    """
+    METRIC_ANGULAR = "angular"
+    METRIC_COSINE = "cosine"
+
+    __metrics = [METRIC_ANGULAR, METRIC_COSINE]
+
+    def __init__(self, similarity_threshold: float, metric: str = "angular", name=None, *args, **kwargs):
+        if metric not in self.__metrics:
+            raise ValueError(f"metric {metric} is unknown")
+        self._sim_threshold = similarity_threshold
+        self._metric = metric
+        self._gallery = None
+        self._labels = None
+        self._source = None
+        super(MatchingEngine, self).__init__(name, *args, **kwargs)
+
+    @staticmethod
+    def _l2_normalize(mat: np.ndarray) -> np.ndarray:
+        mat = np.asarray(mat, dtype=np.float32)
+        norm = np.linalg.norm(mat, axis=1, keepdims=True)
+        return np.divide(mat, np.maximum(norm, np.finfo(np.float32).tiny))
+
+    def _to_distance(self, sim: np.ndarray) -> np.ndarray:
+        """
+        convert cosine similarity into the configured distance
+        :param sim: cosine similarity
+        :return: arccos/pi for angular metric and 1 - cos for cosine metric
+        """
+        sim = np.clip(sim, -1., 1.)
+        if self._metric == self.METRIC_ANGULAR:
+            return np.arccos(sim) / np.pi
+        return 1. - sim
+
+    @staticmethod
+    def _is_normalized(mat: np.ndarray) -> bool:
+        return mat.dtype == np.float32 and mat.flags.c_contiguous and np.allclose(
+            np.linalg.norm(mat, axis=1), 1., atol=1e-4)
+
+    def fit(self, bs_obs: np.ndarray, labels: Union[np.ndarray, None] = None) -> "MatchingEngine":
+        """
+        normalize the gallery once and keep it contiguous in float32, a gallery which is already
+        normalized float32 (e.g. a memory mapped snapshot) is used without copy
+        :param bs_obs: matrix in shape (k,m)
+        :param labels: encoded identity of each gallery row in shape (k,)
+        :return: self
+        """
+        if len(bs_obs.shape) != 2:
+            raise InCompatibleDimError("The bs_obs is not 2 dimension")
+        if labels is not None and len(labels) != bs_obs.shape[0]:
+            raise InCompatibleDimError("The labels is not compatible with bs_obs")
+        if self._is_normalized(bs_obs):
+            self._gallery = bs_obs
+        else:
+            self._gallery = np.ascontiguousarray(self._l2_normalize(bs_obs))
+        self._labels = None if labels is None else np.asarray(labels)
+        self._source = bs_obs
+        return self
+
+    @property
+    def is_fitted(self) -> bool:
+        return self._gallery is not None
+
+    @property
+    def gallery_size(self) -> int:
+        return 0 if self._gallery is None else self._gallery.shape[0]
+
+    def similarity(self, n_obs: np.ndarray) -> np.ndarray:
+        """
+        cosine similarity of a probe batch respect to the fitted gallery
+        :param n_obs: matrix in shape (n,m)
+        :return: matrix in shape (n,k)
+        """
+        if not self.is_fitted:
+            raise NoPassingArgumentError("the gallery is not fitted, call fit first")
+
+        if len(n_obs.shape) != 2:
+            raise InCompatibleDimError("The n_obs is not 2 dimension")
+
+        if n_obs.shape[1] != self._gallery.shape[1]:
+            raise InCompatibleDimError("The n_obs is not compatible with bs_obs")
+
+        return np.dot(self._l2_normalize(n_obs), self._gallery.T)
+
+    def calculate_distant(self, n_obs: np.ndarray, bs_obs: Union[np.ndarray, None] = None) -> np.ndarray:
+        """
+        :param n_obs: matrix in shape (n,m)
+        :param bs_obs: matrix in shape (k,m), it is fitted when it differs from the last fitted gallery
+        :return: matrix in shape (n,k)
+        """
+        if bs_obs is not None:
+            if len(n_obs.shape) != len(bs_obs.shape):
+                raise InCompatibleDimError("The n_obs and bs_obs are not the same")
+            if bs_obs is not self._source:
+                self.fit(bs_obs)
+
+        return self._to_distance(self.similarity(n_obs))
+
+    def top_k(self, n_obs: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        find k closest gallery vectors for every probe, the distance is computed only for the selected ones
+        :param n_obs: matrix in shape (n,m)
+        :param k: number of neighbours
+        :return: indices and distances in shape (n,k) sorted ascending by distance
+        """
+        sim = self.similarity(n_obs)
+        k = min(k, sim.shape[1])
+        if k <= 0:
+            return np.empty((sim.shape[0], 0), dtype=np.int64), np.empty((sim.shape[0], 0), dtype=np.float32)
+
+        if k == 1:
+            idx = np.argmax(sim, axis=1).reshape((-1, 1))
+        else:
+            idx = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(sim, idx, axis=1), axis=1)
+            idx = np.take_along_axis(idx, order, axis=1)
+
+        return idx, self._to_distance(np.take_along_axis(sim, idx, axis=1))
+
+    def satisfy(self, r_obs: np.ndarray) -> np.ndarray:
+        """
+        :param r_obs: matrix in shape (n,m)
+        :return:
+        """
+        if len(r_obs.shape) != 2:
+            raise InCompatibleDimError("The r_obs is not 2 dimension")
+        min_obs = np.argmin(r_obs, axis=1)
+        return r_obs[np.arange(len(min_obs)), min_obs]
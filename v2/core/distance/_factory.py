@@ -0,0 +1,53 @@
+from typing import Union
+
+# models
+from ._engine import MatchingEngine
+from ._ann import IVFIndex
+from ._prototype import PrototypeIndex
+from ._quantized import QuantizedEngine
+from ._aggregate import IdentityAggregator
+
+METHOD_COSINE = "cosine"
+METHOD_COSINE_V2 = "cosine_v2"
+METHOD_ANN = "ann"
+METHOD_PROTOTYPE = "prototype"
+METHOD_QUANTIZED = "quantized"
+METHOD_KNN = "knn"
+
+
+def create_distance(method: str, similarity_threshold: float, **kwargs) \
+        -> Union[MatchingEngine, IVFIndex, PrototypeIndex, QuantizedEngine, IdentityAggregator]:
+    """
+    create a matching backend for an evaluation method
+    :param method: evaluation method name
+    :param similarity_threshold:
+    :param kwargs: backend options, n_lists and n_probe for ann, n_prototypes and shortlist for prototype,
+                   codec and pq_subspaces for quantized, knn_k and aggregate for knn
+    :return: matching backend, it should be fitted or loaded before top_k
+    """
+    if method == METHOD_COSINE:
+        return MatchingEngine(similarity_threshold=similarity_threshold, metric=MatchingEngine.METRIC_ANGULAR)
+    elif method == METHOD_COSINE_V2:
+        return MatchingEngine(similarity_threshold=similarity_threshold, metric=MatchingEngine.METRIC_COSINE)
+    elif method == METHOD_ANN:
+        return IVFIndex(similarity_threshold=similarity_threshold,
+                        n_lists=kwargs.get("n_lists"),
+                        n_probe=kwargs.get("n_probe", 8),
+                        metric=MatchingEngine.METRIC_ANGULAR)
+    elif method == METHOD_PROTOTYPE:
+        return PrototypeIndex(similarity_threshold=similarity_threshold,
+                              n_prototypes=kwargs.get("n_prototypes", 1),
+                              shortlist=kwargs.get("shortlist", 5),
+                              metric=MatchingEngine.METRIC_ANGULAR)
+    elif method == METHOD_QUANTIZED:
+        return QuantizedEngine(similarity_threshold=similarity_threshold,
+                               codec=kwargs.get("codec") or QuantizedEngine.CODEC_INT8,
+                               pq_subspaces=kwargs.get("pq_subspaces", 64),
+                               metric=MatchingEngine.METRIC_ANGULAR)
+    elif method == METHOD_KNN:
+        return IdentityAggregator(similarity_threshold=similarity_threshold,
+                                  k=kwargs.get("knn_k", 3),
+                                  aggregate=kwargs.get("aggregate", IdentityAggregator.AGG_MEAN),
+                                  metric=MatchingEngine.METRIC_ANGULAR)
+    else:
+        raise ValueError(f"evaluation method {method} is unknown")
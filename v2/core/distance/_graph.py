@@ -0,0 +1,104 @@
+from typing import Tuple
+
+import numpy as np
+import tensorflow as tf
+
+# base
+from ._engine import MatchingEngine
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError, NoPassingArgumentError
+
+
+class GraphMatcher:
+    """
+    exact matching head appended to the recognition graph, the normalized gallery lives in a
+    variable and one session call returns the k closest gallery indices and their distances,
+    a new gallery is swapped in by reassigning the variable
+    """
+
+    def __init__(self, embeddings: tf.Tensor, similarity_threshold: float, metric: str = "angular", k: int = 1,
+                 name=None):
+        """
+        :param embeddings: embedding tensor of the recognition graph in shape (n,m)
+        :param similarity_threshold:
+        :param metric: angular or cosine like MatchingEngine
+        :param k: number of neighbours
+        """
+        if metric not in [MatchingEngine.METRIC_ANGULAR, MatchingEngine.METRIC_COSINE]:
+            raise ValueError(f"metric {metric} is unknown")
+        dim = embeddings.get_shape().as_list()[-1]
+        if dim is None:
+            raise InCompatibleDimError("the embedding dimension should be static")
+
+        self._name = self.__class__.__name__ if name is None else name
+        self._sim_threshold = similarity_threshold
+        self._metric = metric
+        self._k = k
+        self._dim = dim
+        self._version = None
+        self._size = 0
+
+        with tf.compat.v1.variable_scope(self._name):
+            self._gallery_plc = tf.compat.v1.placeholder(tf.float32, (None, dim), "gallery")
+            # the row count is left unknown, so galleries of any size are assigned to the same variable
+            initial = tf.compat.v1.placeholder_with_default(tf.zeros((k, dim), dtype=tf.float32), (None, dim))
+            self._gallery = tf.compat.v1.Variable(initial, trainable=False,
+                                                  validate_shape=False, name="normalized_gallery",
+                                                  collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+            self._assign = tf.compat.v1.assign(self._gallery, self._gallery_plc, validate_shape=False)
+
+            probes = tf.math.l2_normalize(embeddings, axis=1)
+            sim = tf.clip_by_value(tf.matmul(probes, self._gallery, transpose_b=True), -1., 1.)
+            values, self._indices = tf.math.top_k(sim, k=k)
+            if metric == MatchingEngine.METRIC_ANGULAR:
+                self._distances = tf.math.acos(values) / np.pi
+            else:
+                self._distances = 1. - values
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def k(self) -> int:
+        return self._k
+
+    @property
+    def gallery_size(self) -> int:
+        return self._size
+
+    @property
+    def fetches(self) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        indices and distances in shape (n,k) sorted ascending by distance
+        """
+        return self._indices, self._distances
+
+    def assign(self, session: tf.compat.v1.Session, bs_obs: np.ndarray, version=None) -> "GraphMatcher":
+        """
+        normalize a gallery and copy it into the graph, it replaces the previous gallery
+        :param session: session of the recognition graph
+        :param bs_obs: matrix in shape (k,m)
+        :param version: gallery version which is assigned
+        :return: self
+        """
+        if len(bs_obs.shape) != 2 or bs_obs.shape[1] != self._dim:
+            raise InCompatibleDimError("The bs_obs is not compatible with the embeddings")
+        if bs_obs.shape[0] < self._k:
+            raise InCompatibleDimError(f"the gallery should have at least {self._k} vectors")
+
+        session.run(self._assign, feed_dict={self._gallery_plc: MatchingEngine._l2_normalize(bs_obs)})
+        self._version = version
+        self._size = bs_obs.shape[0]
+        return self
+
+    def top_k(self, session: tf.compat.v1.Session, feed_dict: dict) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param session: session of the recognition graph
+        :param feed_dict: feed of the embedding model
+        :return: indices and distances in shape (n,k)
+        """
+        if self._size == 0:
+            raise NoPassingArgumentError("the gallery is not assigned, call assign first")
+        return session.run(self.fetches, feed_dict=feed_dict)
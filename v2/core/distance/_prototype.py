@@ -0,0 +1,124 @@
+from typing import Tuple, Union
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+# base
+from ._shortlist import ShortlistEngine
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError, NoPassingArgumentError
+
+
+class PrototypeIndex(ShortlistEngine):
+    """
+    two stage identity search, probes are scored against a few prototypes of every identity and
+    only the embeddings of the shortlisted identities are scored exactly
+    """
+
+    def __init__(self, similarity_threshold: float, n_prototypes: int = 1, shortlist: int = 5,
+                 metric: str = "angular", name=None, *args, **kwargs):
+        self._n_prototypes = max(1, int(n_prototypes))
+        self._shortlist = max(1, int(shortlist))
+        self._prototypes = None
+        self._proto_offsets = None
+        super(PrototypeIndex, self).__init__(similarity_threshold=similarity_threshold, metric=metric, name=name,
+                                             *args, **kwargs)
+
+    @property
+    def shortlist(self) -> int:
+        return self._shortlist
+
+    @shortlist.setter
+    def shortlist(self, value: int):
+        self._shortlist = max(1, int(value))
+
+    @property
+    def n_identities(self) -> int:
+        return 0 if self._offsets is None else self._offsets.shape[0] - 1
+
+    @property
+    def n_prototypes(self) -> int:
+        return 0 if self._prototypes is None else self._prototypes.shape[0]
+
+    def _identity_prototypes(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        prototypes of one identity, the normalized mean or spherical k-means centers
+        :param vectors: normalized embeddings of one identity in shape (c,m)
+        :return: matrix in shape (p,m)
+        """
+        n_prototypes = min(self._n_prototypes, vectors.shape[0])
+        if n_prototypes == 1:
+            return self._l2_normalize(np.mean(vectors, axis=0, keepdims=True))
+        k_means = KMeans(n_clusters=n_prototypes, n_init=1, random_state=0)
+        k_means.fit(vectors)
+        return self._l2_normalize(k_means.cluster_centers_)
+
+    def fit(self, bs_obs: np.ndarray, labels: Union[np.ndarray, None] = None) -> "PrototypeIndex":
+        """
+        group the gallery by identity and build the prototypes
+        :param bs_obs: matrix in shape (k,m)
+        :param labels: encoded identity of each gallery row in shape (k,)
+        :return: self
+        """
+        if labels is None:
+            raise NoPassingArgumentError("labels are required to build identity prototypes")
+        if len(bs_obs.shape) != 2:
+            raise InCompatibleDimError("The bs_obs is not 2 dimension")
+        if len(labels) != bs_obs.shape[0]:
+            raise InCompatibleDimError("The labels is not compatible with bs_obs")
+
+        labels = np.asarray(labels)
+        gallery = self._l2_normalize(bs_obs)
+        _, assign = np.unique(labels, return_inverse=True)
+        assign = assign.reshape(-1)
+        n_identities = int(assign.max()) + 1 if assign.shape[0] else 0
+
+        ids = np.argsort(assign, kind="stable")
+        self._gallery = np.ascontiguousarray(gallery[ids])
+        self._ids = ids.astype(np.int64)
+        self._offsets = np.searchsorted(assign[ids], np.arange(n_identities + 1)).astype(np.int64)
+
+        if self._n_prototypes == 1 and n_identities:
+            # one normalized mean per identity, every identity slice is non empty
+            prototypes = self._l2_normalize(np.add.reduceat(self._gallery, self._offsets[:-1], axis=0))
+            proto_counts = np.ones((n_identities,), dtype=np.int64)
+        else:
+            prototypes = [self._identity_prototypes(self._gallery[self._offsets[l]:self._offsets[l + 1]])
+                          for l in range(n_identities)]
+            proto_counts = np.array([p.shape[0] for p in prototypes], dtype=np.int64)
+            prototypes = np.concatenate(prototypes, axis=0) if prototypes else \
+                np.empty((0, gallery.shape[1]), dtype=np.float32)
+
+        self._prototypes = np.ascontiguousarray(prototypes)
+        self._proto_offsets = np.concatenate([[0], np.cumsum(proto_counts)]).astype(np.int64)
+        self._labels = labels
+        self._source = bs_obs
+        return self
+
+    def calculate_distant(self, n_obs: np.ndarray, bs_obs: Union[np.ndarray, None] = None) -> np.ndarray:
+        """
+        :param n_obs: matrix in shape (n,m)
+        :param bs_obs: only the fitted gallery is accepted, a new gallery needs its labels so fit it first
+        :return: matrix in shape (n,k)
+        """
+        if bs_obs is not None and bs_obs is not self._source:
+            raise NoPassingArgumentError("labels of bs_obs are required, call fit(bs_obs, labels) first")
+        return super(PrototypeIndex, self).calculate_distant(n_obs)
+
+    def _search(self, n_obs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        normalize probes and shortlist the closest identities of every probe
+        :param n_obs: matrix in shape (n,m)
+        :return: normalized probes and identities in shape (n,shortlist)
+        """
+        probes = self._normalize_probes(n_obs)
+        shortlist = min(self._shortlist, self.n_identities)
+        if shortlist == 0:
+            return probes, np.empty((probes.shape[0], 0), dtype=np.int64)
+
+        coarse = np.dot(probes, self._prototypes.T)
+        if self.n_prototypes != self.n_identities:
+            # an identity is as close as its closest prototype
+            coarse = np.maximum.reduceat(coarse, self._proto_offsets[:-1], axis=1)
+        return probes, np.argpartition(-coarse, shortlist - 1, axis=1)[:, :shortlist]
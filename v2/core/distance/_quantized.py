@@ -0,0 +1,220 @@
+import json
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+# base
+from ._engine import MatchingEngine
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError, NoPassingArgumentError
+
+
+class QuantizedEngine(MatchingEngine):
+    """
+    compressed gallery matcher, float32 probes are scored directly against float16, int8 or
+    product quantization codes. codes are expanded block by block so the whole gallery is never
+    decompressed at once.
+    """
+    CODEC_FLOAT16 = "float16"
+    CODEC_INT8 = "int8"
+    CODEC_PQ = "pq"
+
+    META = "quantized.json"
+    CODES = "codes.npy"
+    SCALES = "scales.npy"
+    CODEBOOKS = "codebooks.npy"
+    BLOCK = 8192
+    PQ_CENTROIDS = 256
+    TRAIN_PER_CENTROID = 16
+
+    __codecs = [CODEC_FLOAT16, CODEC_INT8, CODEC_PQ]
+
+    def __init__(self, similarity_threshold: float, codec: str = "int8", pq_subspaces: int = 64,
+                 metric: str = "angular", name=None, *args, **kwargs):
+        if codec not in self.__codecs:
+            raise ValueError(f"codec {codec} is unknown")
+        self._codec = codec
+        self._pq_subspaces = pq_subspaces
+        self._codes = None
+        self._scales = None
+        self._codebooks = None
+        self._dim = None
+        super(QuantizedEngine, self).__init__(similarity_threshold=similarity_threshold, metric=metric, name=name,
+                                              *args, **kwargs)
+
+    @property
+    def codec(self) -> str:
+        return self._codec
+
+    @property
+    def is_fitted(self) -> bool:
+        return self._codes is not None
+
+    @property
+    def gallery_size(self) -> int:
+        return 0 if self._codes is None else self._codes.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """
+        memory used by the compressed gallery
+        :return: number of bytes
+        """
+        return int(sum(a.nbytes for a in [self._codes, self._scales, self._codebooks] if a is not None))
+
+    def _train_codebooks(self, gallery: np.ndarray) -> np.ndarray:
+        """
+        train one k-means codebook per sub space
+        :param gallery: normalized matrix in shape (k,m)
+        :return: codebooks in shape (subspaces,centroids,m/subspaces)
+        """
+        n_centroids = min(self.PQ_CENTROIDS, gallery.shape[0])
+        rng = np.random.RandomState(0)
+        n_train = min(gallery.shape[0], n_centroids * self.TRAIN_PER_CENTROID)
+        train = gallery[np.sort(rng.choice(gallery.shape[0], n_train, replace=False))]
+        sub_dim = gallery.shape[1] // self._pq_subspaces
+
+        codebooks = np.zeros((self._pq_subspaces, n_centroids, sub_dim), dtype=np.float32)
+        for j in range(self._pq_subspaces):
+            k_means = KMeans(n_clusters=n_centroids, n_init=1, random_state=0)
+            k_means.fit(train[:, j * sub_dim:(j + 1) * sub_dim])
+            codebooks[j] = k_means.cluster_centers_
+        return codebooks
+
+    def _encode_pq(self, gallery: np.ndarray) -> np.ndarray:
+        sub_dim = self._codebooks.shape[2]
+        codes = np.zeros((gallery.shape[0], self._pq_subspaces), dtype=np.uint8)
+        for j in range(self._pq_subspaces):
+            sub = gallery[:, j * sub_dim:(j + 1) * sub_dim]
+            book = self._codebooks[j]
+            # argmin of |x - c|^2 is argmax of x.c - |c|^2 / 2
+            codes[:, j] = np.argmax(np.dot(sub, book.T) - 0.5 * np.sum(book ** 2, axis=1), axis=1)
+        return codes
+
+    def fit(self, bs_obs: np.ndarray, labels: Union[np.ndarray, None] = None) -> "QuantizedEngine":
+        """
+        normalize and compress the gallery, the float32 gallery is not kept
+        :param bs_obs: matrix in shape (k,m)
+        :param labels: encoded identity of each gallery row in shape (k,)
+        :return: self
+        """
+        if len(bs_obs.shape) != 2:
+            raise InCompatibleDimError("The bs_obs is not 2 dimension")
+        if labels is not None and len(labels) != bs_obs.shape[0]:
+            raise InCompatibleDimError("The labels is not compatible with bs_obs")
+
+        gallery = self._l2_normalize(bs_obs)
+        self._dim = gallery.shape[1]
+        self._scales = None
+        self._codebooks = None
+
+        if self._codec == self.CODEC_FLOAT16:
+            self._codes = np.ascontiguousarray(gallery.astype(np.float16))
+        elif self._codec == self.CODEC_INT8:
+            # symmetric per vector scale
+            scales = np.maximum(np.max(np.abs(gallery), axis=1), np.finfo(np.float32).tiny) / 127.
+            self._codes = np.ascontiguousarray(np.round(gallery / scales[:, None]).astype(np.int8))
+            self._scales = scales.astype(np.float32)
+        else:
+            if gallery.shape[1] % self._pq_subspaces != 0:
+                raise InCompatibleDimError(f"dimension {gallery.shape[1]} is not divisible by "
+                                           f"{self._pq_subspaces} sub spaces")
+            if gallery.shape[0] > 0:
+                self._codebooks = self._train_codebooks(gallery)
+                self._codes = self._encode_pq(gallery)
+            else:
+                self._codebooks = np.zeros((self._pq_subspaces, 0, gallery.shape[1] // self._pq_subspaces),
+                                           dtype=np.float32)
+                self._codes = np.empty((0, self._pq_subspaces), dtype=np.uint8)
+
+        self._labels = None if labels is None else np.asarray(labels)
+        self._source = bs_obs
+        return self
+
+    def save(self, quantized_path: Path) -> None:
+        """
+        save codes as separate npy files so they can be memory mapped on load
+        :param quantized_path: directory path
+        :return: None
+        """
+        if not self.is_fitted:
+            raise NoPassingArgumentError("the gallery is not fitted, call fit first")
+        quantized_path = Path(quantized_path)
+        quantized_path.mkdir(parents=True, exist_ok=True)
+        np.save(str(quantized_path.joinpath(self.CODES)), self._codes)
+        if self._scales is not None:
+            np.save(str(quantized_path.joinpath(self.SCALES)), self._scales)
+        if self._codebooks is not None:
+            np.save(str(quantized_path.joinpath(self.CODEBOOKS)), self._codebooks)
+        with open(quantized_path.joinpath(self.META), 'w') as outfile:
+            json.dump({"codec": self._codec, "size": self.gallery_size, "dim": int(self._dim),
+                       "pq_subspaces": self._pq_subspaces, "nbytes": self.nbytes}, outfile)
+
+    @classmethod
+    def exists(cls, quantized_path: Path) -> bool:
+        return Path(quantized_path).joinpath(cls.META).is_file()
+
+    def load(self, quantized_path: Path) -> "QuantizedEngine":
+        """
+        load saved codes, the codec of the saved gallery replaces the configured one
+        :param quantized_path: directory path
+        :return: self
+        """
+        quantized_path = Path(quantized_path)
+        if not self.exists(quantized_path):
+            raise FileNotFoundError(f"there is no quantized gallery at {str(quantized_path)}")
+        with open(quantized_path.joinpath(self.META), 'r') as infile:
+            meta = json.load(infile)
+        mmap_mode = 'r' if meta.get("size") else None
+        self._codec = meta.get("codec")
+        self._dim = int(meta.get("dim"))
+        self._pq_subspaces = int(meta.get("pq_subspaces"))
+        self._codes = np.load(str(quantized_path.joinpath(self.CODES)), mmap_mode=mmap_mode)
+        scales_path = quantized_path.joinpath(self.SCALES)
+        self._scales = np.load(str(scales_path)) if scales_path.is_file() else None
+        codebooks_path = quantized_path.joinpath(self.CODEBOOKS)
+        self._codebooks = np.load(str(codebooks_path)) if codebooks_path.is_file() else None
+        self._source = None
+        return self
+
+    def similarity(self, n_obs: np.ndarray) -> np.ndarray:
+        """
+        asymmetric cosine similarity of float32 probes respect to the compressed gallery
+        :param n_obs: matrix in shape (n,m)
+        :return: matrix in shape (n,k)
+        """
+        if not self.is_fitted:
+            raise NoPassingArgumentError("the gallery is not fitted, call fit first")
+
+        if len(n_obs.shape) != 2:
+            raise InCompatibleDimError("The n_obs is not 2 dimension")
+
+        if n_obs.shape[1] != self._dim:
+            raise InCompatibleDimError("The n_obs is not compatible with bs_obs")
+
+        probes = self._l2_normalize(n_obs)
+        sim = np.empty((probes.shape[0], self.gallery_size), dtype=np.float32)
+
+        if self._codec == self.CODEC_PQ:
+            # lookup table of probe sub vectors against every centroid
+            sub_dim = self._codebooks.shape[2]
+            lut = np.einsum('njd,jcd->jnc', probes.reshape((probes.shape[0], self._pq_subspaces, sub_dim)),
+                            self._codebooks)
+            for start in range(0, self.gallery_size, self.BLOCK):
+                codes = self._codes[start:start + self.BLOCK]
+                block = np.zeros((probes.shape[0], codes.shape[0]), dtype=np.float32)
+                for j in range(self._pq_subspaces):
+                    block += lut[j][:, codes[:, j]]
+                sim[:, start:start + self.BLOCK] = block
+            return sim
+
+        for start in range(0, self.gallery_size, self.BLOCK):
+            codes = self._codes[start:start + self.BLOCK].astype(np.float32)
+            block = np.dot(probes, codes.T)
+            if self._scales is not None:
+                block *= self._scales[start:start + self.BLOCK]
+            sim[:, start:start + self.BLOCK] = block
+        return sim
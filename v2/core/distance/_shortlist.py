@@ -0,0 +1,99 @@
+from typing import Tuple
+
+import numpy as np
+
+# base
+from ._engine import MatchingEngine
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError, NoPassingArgumentError
+
+
+class ShortlistEngine(MatchingEngine):
+    """
+    base of the two stage matchers, the gallery is stored in contiguous groups (inverted lists or
+    identities) and a probe is scored exactly only against the groups which _search shortlists, the
+    rows which are not scanned are -inf similar
+    """
+
+    def __init__(self, similarity_threshold: float, metric: str = "angular", name=None, *args, **kwargs):
+        # gallery row of every stored row and the first row of every group
+        self._ids = None
+        self._offsets = None
+        super(ShortlistEngine, self).__init__(similarity_threshold=similarity_threshold, metric=metric, name=name,
+                                              *args, **kwargs)
+
+    def _normalize_probes(self, n_obs: np.ndarray) -> np.ndarray:
+        if not self.is_fitted:
+            raise NoPassingArgumentError("the gallery is not fitted, call fit first")
+
+        if len(n_obs.shape) != 2:
+            raise InCompatibleDimError("The n_obs is not 2 dimension")
+
+        if n_obs.shape[1] != self._gallery.shape[1]:
+            raise InCompatibleDimError("The n_obs is not compatible with bs_obs")
+
+        return self._l2_normalize(n_obs)
+
+    def _search(self, n_obs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        normalize probes and shortlist the groups of every probe
+        :param n_obs: matrix in shape (n,m)
+        :return: normalized probes and groups in shape (n,g)
+        """
+        raise NotImplementedError
+
+    def _scan(self, probe: np.ndarray, groups: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        score one probe against the shortlisted groups, groups are contiguous so no row is copied
+        :param probe: vector in shape (m,)
+        :param groups: group indices
+        :return: gallery indices and cosine similarities of the scanned rows
+        """
+        sims = [np.dot(self._gallery[self._offsets[g]:self._offsets[g + 1]], probe) for g in groups]
+        ids = [self._ids[self._offsets[g]:self._offsets[g + 1]] for g in groups]
+        if not sims:
+            return np.empty((0,), dtype=np.int64), np.empty((0,), dtype=np.float32)
+        return np.concatenate(ids), np.concatenate(sims)
+
+    def similarity(self, n_obs: np.ndarray) -> np.ndarray:
+        """
+        cosine similarity respect to the original gallery order, the rows which are not scanned are -inf
+        :param n_obs: matrix in shape (n,m)
+        :return: matrix in shape (n,k)
+        """
+        probes, groups = self._search(n_obs)
+        sim = np.full((probes.shape[0], self.gallery_size), -np.inf, dtype=np.float32)
+        for i in range(probes.shape[0]):
+            ids, c_sim = self._scan(probes[i], groups[i])
+            sim[i, ids] = c_sim
+        return sim
+
+    def _to_distance(self, sim: np.ndarray) -> np.ndarray:
+        dist = super(ShortlistEngine, self)._to_distance(sim)
+        dist[np.isneginf(sim)] = np.inf
+        return dist
+
+    def top_k(self, n_obs: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        k closest gallery vectors among the scanned rows of every probe
+        :param n_obs: matrix in shape (n,m)
+        :param k: number of neighbours
+        :return: indices and distances in shape (n,k) sorted ascending by distance
+        """
+        probes, groups = self._search(n_obs)
+        k = min(k, self.gallery_size)
+        idx = np.zeros((probes.shape[0], k), dtype=np.int64)
+        sim = np.full((probes.shape[0], k), -np.inf, dtype=np.float32)
+
+        for i in range(probes.shape[0]):
+            ids, c_sim = self._scan(probes[i], groups[i])
+            c_k = min(k, c_sim.shape[0])
+            if c_k == 0:
+                continue
+            best = np.argpartition(-c_sim, c_k - 1)[:c_k]
+            best = best[np.argsort(-c_sim[best])]
+            idx[i, :c_k] = ids[best]
+            sim[i, :c_k] = c_sim[best]
+
+        return idx, self._to_distance(sim)
@@ -1,13 +1,22 @@
 from unittest import TestCase
 import unittest
+import tempfile
 import numpy as np
+import tensorflow as tf
 
 # models
 from .base import BaseDistance
 from ._dist import CosineDistance, SklearnCosineDistance, EuclideanDistance, SklearnEuclideanDistance
+from ._engine import MatchingEngine
+from ._ann import IVFIndex
+from ._prototype import PrototypeIndex
+from ._quantized import QuantizedEngine
+from ._aggregate import IdentityAggregator, IdentityLayout, identity_reduce
+from ._graph import GraphMatcher
+from ._factory import create_distance
 
 # exception
-from v2.core.exceptions import InCompatibleDimError
+from v2.core.exceptions import InCompatibleDimError, NoPassingArgumentError
 
 
 class BaseDistanceTestCase(TestCase):
@@ -168,3 +177,273 @@ class SklearnEuclideanDistanceTestCase(TestCase):
         dis = SklearnEuclideanDistance(similarity_threshold=0.9)
         with self.assertRaises(InCompatibleDimError):
             _ = dis.satisfy(mat1)
+
+
+class MatchingEngineTestCase(TestCase):
+    def setUp(self) -> None:
+        self.probes = np.random.random((12, 512)) - 0.5
+        self.gallery = np.random.random((300, 512)) - 0.5
+
+    def test_angular_metric_equals_cosine_distance(self):
+        engine = MatchingEngine(similarity_threshold=0.3).fit(self.gallery)
+        expected = CosineDistance(similarity_threshold=0.3).calculate_distant(self.probes, self.gallery)
+        ans = engine.calculate_distant(self.probes)
+        self.assertEqual(ans.shape, (12, 300))
+        np.testing.assert_allclose(ans, expected, atol=1e-5)
+
+    def test_cosine_metric_equals_sklearn_cosine_distance(self):
+        engine = MatchingEngine(similarity_threshold=0.3, metric=MatchingEngine.METRIC_COSINE)
+        expected = SklearnCosineDistance(similarity_threshold=0.3).calculate_distant(self.probes, self.gallery)
+        ans = engine.calculate_distant(self.probes, self.gallery)
+        np.testing.assert_allclose(ans, expected, atol=1e-5)
+
+    def test_top_k_matches_argmin(self):
+        engine = MatchingEngine(similarity_threshold=0.3).fit(self.gallery)
+        dists = CosineDistance(similarity_threshold=0.3).calculate_distant(self.probes, self.gallery)
+        idx, scores = engine.top_k(self.probes, k=5)
+        self.assertEqual(idx.shape, (12, 5))
+        self.assertEqual(scores.shape, (12, 5))
+        np.testing.assert_array_equal(idx[:, 0], np.argmin(dists, axis=1))
+        np.testing.assert_allclose(scores[:, 0], np.min(dists, axis=1), atol=1e-5)
+        self.assertTrue(np.all(np.diff(scores, axis=1) >= 0))
+
+    def test_top_k_larger_than_gallery(self):
+        engine = MatchingEngine(similarity_threshold=0.3).fit(self.gallery[:3])
+        idx, scores = engine.top_k(self.probes, k=10)
+        self.assertEqual(idx.shape, (12, 3))
+
+    def test_top_k_with_empty_gallery(self):
+        engine = MatchingEngine(similarity_threshold=0.3).fit(np.empty((0, 512)))
+        idx, scores = engine.top_k(self.probes, k=1)
+        self.assertEqual(idx.shape, (12, 0))
+
+    def test_not_fitted_engine(self):
+        engine = MatchingEngine(similarity_threshold=0.3)
+        with self.assertRaises(NoPassingArgumentError):
+            _ = engine.top_k(self.probes)
+
+    def test_incompatible_dim(self):
+        engine = MatchingEngine(similarity_threshold=0.3).fit(self.gallery)
+        with self.assertRaises(InCompatibleDimError):
+            _ = engine.top_k(np.random.random((12, 100)))
+
+    def test_unknown_metric(self):
+        with self.assertRaises(ValueError):
+            _ = MatchingEngine(similarity_threshold=0.3, metric="mahalanobis")
+
+
+class IVFIndexTestCase(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        centers = rng.normal(size=(50, 128))
+        self.gallery = np.repeat(centers, 10, axis=0) + 0.05 * rng.normal(size=(500, 128))
+        self.probes = centers[:8] + 0.05 * rng.normal(size=(8, 128))
+
+    def test_full_probe_equals_exact_engine(self):
+        index = IVFIndex(similarity_threshold=0.3, n_lists=10, n_probe=10).fit(self.gallery)
+        exact = MatchingEngine(similarity_threshold=0.3).fit(self.gallery)
+        idx, scores = index.top_k(self.probes, k=3)
+        e_idx, e_scores = exact.top_k(self.probes, k=3)
+        np.testing.assert_array_equal(idx, e_idx)
+        np.testing.assert_allclose(scores, e_scores, atol=1e-5)
+        np.testing.assert_allclose(index.calculate_distant(self.probes), exact.calculate_distant(self.probes),
+                                   atol=1e-5)
+
+    def test_partial_probe_marks_unscanned_rows(self):
+        index = IVFIndex(similarity_threshold=0.3, n_lists=10, n_probe=1).fit(self.gallery)
+        dists = index.calculate_distant(self.probes)
+        self.assertEqual(dists.shape, (8, 500))
+        self.assertTrue(np.all(np.isinf(dists).sum(axis=1) > 0))
+        self.assertEqual(index.satisfy(dists).shape, (8,))
+
+    def test_save_and_load(self):
+        index = IVFIndex(similarity_threshold=0.3, n_lists=10, n_probe=2).fit(self.gallery)
+        path = tempfile.mkdtemp()
+        index.save(path)
+        self.assertTrue(IVFIndex.exists(path))
+        loaded = IVFIndex(similarity_threshold=0.3, n_probe=2).load(path)
+        self.assertEqual(loaded.n_lists, 10)
+        np.testing.assert_array_equal(loaded.top_k(self.probes, k=2)[0], index.top_k(self.probes, k=2)[0])
+
+    def test_not_fitted_index(self):
+        index = IVFIndex(similarity_threshold=0.3)
+        with self.assertRaises(NoPassingArgumentError):
+            _ = index.top_k(self.probes)
+
+
+class PrototypeIndexTestCase(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        centers = rng.normal(size=(50, 128))
+        self.labels = np.repeat(np.arange(50), 10)
+        self.gallery = centers[self.labels] + 0.05 * rng.normal(size=(500, 128))
+        self.probes = centers[:8] + 0.05 * rng.normal(size=(8, 128))
+
+    def test_full_shortlist_equals_exact_engine(self):
+        index = PrototypeIndex(similarity_threshold=0.3, shortlist=50).fit(self.gallery, self.labels)
+        exact = MatchingEngine(similarity_threshold=0.3).fit(self.gallery)
+        idx, scores = index.top_k(self.probes, k=3)
+        e_idx, e_scores = exact.top_k(self.probes, k=3)
+        np.testing.assert_array_equal(idx, e_idx)
+        np.testing.assert_allclose(scores, e_scores, atol=1e-5)
+
+    def test_shortlist_keeps_true_identity(self):
+        for n_prototypes in [1, 3]:
+            index = PrototypeIndex(similarity_threshold=0.3, n_prototypes=n_prototypes, shortlist=2)
+            index.fit(self.gallery, self.labels)
+            self.assertEqual(index.n_identities, 50)
+            self.assertEqual(index.n_prototypes, 50 * n_prototypes)
+            idx, _ = index.top_k(self.probes, k=1)
+            np.testing.assert_array_equal(self.labels[idx[:, 0]], np.arange(8))
+            dists = index.calculate_distant(self.probes)
+            self.assertTrue(np.all(np.isinf(dists).sum(axis=1) == 480))
+
+    def test_fit_without_labels(self):
+        with self.assertRaises(NoPassingArgumentError):
+            _ = PrototypeIndex(similarity_threshold=0.3).fit(self.gallery)
+
+    def test_calculate_distant_needs_fitted_gallery(self):
+        index = PrototypeIndex(similarity_threshold=0.3).fit(self.gallery, self.labels)
+        np.testing.assert_array_equal(index.calculate_distant(self.probes, self.gallery),
+                                      index.calculate_distant(self.probes))
+        with self.assertRaises(NoPassingArgumentError):
+            _ = index.calculate_distant(self.probes, self.gallery[:100])
+
+
+class QuantizedEngineTestCase(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        centers = rng.normal(size=(50, 128))
+        self.gallery = np.repeat(centers, 10, axis=0) + 0.05 * rng.normal(size=(500, 128))
+        self.probes = centers[:8] + 0.05 * rng.normal(size=(8, 128))
+        self.exact = MatchingEngine(similarity_threshold=0.3).fit(self.gallery)
+
+    def test_scalar_codecs_are_close_to_exact(self):
+        for codec, atol in [("float16", 1e-3), ("int8", 2e-2)]:
+            engine = QuantizedEngine(similarity_threshold=0.3, codec=codec).fit(self.gallery)
+            np.testing.assert_allclose(engine.similarity(self.probes), self.exact.similarity(self.probes), atol=atol)
+            self.assertLess(engine.nbytes, self.exact._gallery.nbytes)
+
+    def test_pq_keeps_nearest_identity(self):
+        engine = QuantizedEngine(similarity_threshold=0.3, codec="pq", pq_subspaces=16).fit(self.gallery)
+        idx, dists = engine.top_k(self.probes, k=1)
+        e_idx, _ = self.exact.top_k(self.probes, k=1)
+        np.testing.assert_array_equal(idx[:, 0] // 10, e_idx[:, 0] // 10)
+        self.assertEqual(dists.shape, (8, 1))
+        self.assertEqual(engine.nbytes, 500 * 16 + engine._codebooks.nbytes)
+
+    def test_save_and_load(self):
+        for codec in ["float16", "int8", "pq"]:
+            engine = QuantizedEngine(similarity_threshold=0.3, codec=codec, pq_subspaces=16).fit(self.gallery)
+            path = tempfile.mkdtemp()
+            engine.save(path)
+            self.assertTrue(QuantizedEngine.exists(path))
+            loaded = QuantizedEngine(similarity_threshold=0.3).load(path)
+            self.assertEqual(loaded.codec, codec)
+            np.testing.assert_allclose(loaded.similarity(self.probes), engine.similarity(self.probes), atol=1e-6)
+
+    def test_unknown_codec_and_dim(self):
+        with self.assertRaises(ValueError):
+            _ = QuantizedEngine(similarity_threshold=0.3, codec="int4")
+        with self.assertRaises(InCompatibleDimError):
+            _ = QuantizedEngine(similarity_threshold=0.3, codec="pq", pq_subspaces=48).fit(self.gallery)
+
+
+class IdentityAggregatorTestCase(TestCase):
+    def setUp(self) -> None:
+        rng = np.random.RandomState(0)
+        self.labels = np.array([2, 0, 1, 0, 2, 2, 1, 0, 0, 2])
+        self.dist = rng.random_sample((4, 10))
+
+    def test_reduce_equals_loop(self):
+        layout = IdentityLayout(self.labels)
+        d_min, d_mean, votes, nearest = identity_reduce(self.dist, layout, k=3)
+        for i in range(self.dist.shape[0]):
+            top = self.labels[np.argsort(self.dist[i])[:3]]
+            for j, identity in enumerate(layout.identities):
+                rows = np.where(self.labels == identity)[0]
+                self.assertAlmostEqual(d_min[i, j], self.dist[i, rows].min())
+                self.assertAlmostEqual(d_mean[i, j], np.sort(self.dist[i, rows])[:3].mean())
+                self.assertEqual(votes[i, j], np.sum(top == identity))
+                self.assertEqual(nearest[i, j], rows[np.argmin(self.dist[i, rows])])
+
+    def test_reduce_ignores_unscanned_rows(self):
+        dist = self.dist.copy()
+        dist[:, self.labels == 1] = np.inf
+        d_min, d_mean, votes, _ = identity_reduce(dist, IdentityLayout(self.labels), k=3)
+        self.assertTrue(np.all(np.isinf(d_min[:, 1])))
+        self.assertTrue(np.all(np.isinf(d_mean[:, 1])))
+        self.assertTrue(np.all(votes[:, 1] == 0))
+
+    def test_aggregator_decision(self):
+        rng = np.random.RandomState(0)
+        centers = rng.normal(size=(20, 64))
+        labels = np.repeat(np.arange(20), 5)
+        gallery = centers[labels] + 0.05 * rng.normal(size=(100, 64))
+        probes = centers[:6] + 0.05 * rng.normal(size=(6, 64))
+        for aggregate in ["min", "mean", "vote"]:
+            matcher = IdentityAggregator(similarity_threshold=0.3, k=3, aggregate=aggregate).fit(gallery, labels)
+            idx, dists = matcher.top_k(probes, k=2)
+            self.assertEqual(idx.shape, (6, 2))
+            np.testing.assert_array_equal(labels[idx[:, 0]], np.arange(6))
+            self.assertTrue(np.all(dists[:, 0] < 0.3))
+        with self.assertRaises(ValueError):
+            _ = IdentityAggregator(similarity_threshold=0.3, aggregate="max")
+
+    def test_aggregator_scores_unpadded_gallery(self):
+        # one identity with many rows must not pad the others
+        labels = np.concatenate([np.zeros(40, dtype=np.int64), np.repeat(np.arange(1, 51), 2)])
+        gallery = np.random.RandomState(1).normal(size=(labels.shape[0], 16))
+        matcher = IdentityAggregator(similarity_threshold=0.3, k=3).fit(gallery, labels)
+        self.assertEqual(matcher.similarity(gallery[:2]).shape, (2, labels.shape[0]))
+        self.assertEqual(matcher.gallery_size, labels.shape[0])
+        d_min, _, _, nearest = matcher.aggregate(gallery[:2])
+        np.testing.assert_allclose(d_min[:, 0], 0., atol=1e-3)
+        np.testing.assert_array_equal(nearest[:, 0], [0, 1])
+
+    def test_aggregator_calculate_distant_needs_fitted_gallery(self):
+        gallery = np.random.RandomState(1).normal(size=(10, 16))
+        matcher = IdentityAggregator(similarity_threshold=0.3).fit(gallery, self.labels)
+        self.assertEqual(matcher.calculate_distant(gallery[:2], gallery).shape, (2, 10))
+        with self.assertRaises(NoPassingArgumentError):
+            _ = matcher.calculate_distant(gallery[:2], gallery[:5])
+
+
+class DistanceFactoryTestCase(TestCase):
+    def test_create_known_methods(self):
+        self.assertTrue(isinstance(create_distance("cosine", 0.3), MatchingEngine))
+        self.assertTrue(isinstance(create_distance("cosine_v2", 0.3), MatchingEngine))
+        self.assertTrue(isinstance(create_distance("ann", 0.3, n_probe=4), IVFIndex))
+        self.assertTrue(isinstance(create_distance("prototype", 0.3, shortlist=4), PrototypeIndex))
+        self.assertTrue(isinstance(create_distance("quantized", 0.3, codec="pq"), QuantizedEngine))
+        self.assertTrue(isinstance(create_distance("knn", 0.3, knn_k=5), IdentityAggregator))
+
+    def test_create_unknown_method(self):
+        with self.assertRaises(ValueError):
+            _ = create_distance("svm", 0.3)
+
+
+class GraphMatcherTestCase(TestCase):
+    def test_graph_top_k_and_swap(self):
+        gallery = np.random.randn(30, 16).astype(np.float32)
+        probes = np.random.randn(6, 16).astype(np.float32)
+        with tf.Graph().as_default():
+            plc = tf.compat.v1.placeholder(tf.float32, (None, 16))
+            matcher = GraphMatcher(plc, similarity_threshold=0.3, k=3)
+            with tf.compat.v1.Session() as sess:
+                with self.assertRaises(NoPassingArgumentError):
+                    matcher.top_k(sess, {plc: probes})
+
+                matcher.assign(sess, gallery, version=1)
+                idx, dist = matcher.top_k(sess, {plc: probes})
+                e_idx, e_dist = MatchingEngine(0.3).fit(gallery).top_k(probes, k=3)
+                np.testing.assert_array_equal(idx, e_idx)
+                np.testing.assert_allclose(dist, e_dist, atol=1e-5)
+
+                matcher.assign(sess, gallery[:4], version=2)
+                idx, _ = matcher.top_k(sess, {plc: probes})
+                self.assertEqual(matcher.version, 2)
+                self.assertTrue((idx < 4).all())
+
+                with self.assertRaises(InCompatibleDimError):
+                    matcher.assign(sess, gallery[:2])
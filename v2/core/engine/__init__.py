@@ -1,4 +1,17 @@
-from ._default import RawVisualService,ClusteringService
+from ._default import RawVisualService,ClusteringService, CameraClusters
+from ._batcher import EmbeddingBatcher, EmbeddingResult
+from ._readiness import Readiness, WarmupCall
+from ._runner import StageRunner
+from ._roi import RoiPlanner, pad_boxes, merge_boxes
 
 RawVisualService = RawVisualService
 ClusteringService = ClusteringService
+CameraClusters = CameraClusters
+EmbeddingBatcher = EmbeddingBatcher
+EmbeddingResult = EmbeddingResult
+Readiness = Readiness
+WarmupCall = WarmupCall
+StageRunner = StageRunner
+RoiPlanner = RoiPlanner
+pad_boxes = pad_boxes
+merge_boxes = merge_boxes
@@ -4,6 +4,8 @@ from datetime import datetime
 # loggers
 from v2.tools.logger import get_logger, ConsoleLogger
 
+from ._readiness import Readiness
+
 
 class BasicService:
     def __init__(self, name, log_path: Path, display=True, *args, **kwargs):
@@ -16,6 +18,7 @@ class BasicService:
         self._file_logger = get_logger(self._log_filename, self._name)
         self._console_logger = ConsoleLogger()
         self._display = display
+        self._readiness = Readiness(name=self._name)
 
         super(BasicService, self).__init__(*args, **kwargs)
 
@@ -23,6 +26,13 @@ class BasicService:
     def name(self) -> str:
         return self._name
 
+    @property
+    def readiness(self) -> Readiness:
+        """
+        set once every model is warmed up
+        """
+        return self._readiness
+
     def exec_(self, *args, **kwargs) -> None:
         raise NotImplementedError
 
@@ -0,0 +1,166 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, List, Sequence, Union
+
+import numpy as np
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError
+
+
+class EmbeddingResult:
+    __slots__ = ["source_id", "track_ids", "embeddings"]
+
+    def __init__(self, source_id: str, track_ids: List, embeddings: np.ndarray):
+        self.source_id = source_id
+        self.track_ids = track_ids
+        self.embeddings = embeddings
+
+    def __repr__(self):
+        return f"EmbeddingResult: {self.source_id} with {len(self.track_ids)} faces"
+
+
+class _Request:
+    __slots__ = ["source_id", "track_ids", "faces", "future", "submitted_at"]
+
+    def __init__(self, source_id: str, track_ids: List, faces: np.ndarray):
+        self.source_id = source_id
+        self.track_ids = track_ids
+        self.faces = faces
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
+
+
+class EmbeddingBatcher(threading.Thread):
+    """
+        shared embedding service, crops of all sources are queued and embedded by one model call when
+        max_batch_size faces are waiting, the oldest request waited max_wait_ms or every registered
+        source has a request in the queue, results are routed back to the source and the tracks
+    """
+
+    def __init__(self, embed_fn: Callable[[np.ndarray], np.ndarray], max_batch_size: int = 32,
+                 max_wait_ms: float = 10., name=None, *args, **kwargs):
+        """
+        :param embed_fn: callable which embeds a batch in shape (n,h,w,c) and returns (n,m)
+        :param max_batch_size: faces per model call
+        :param max_wait_ms: maximum time the oldest request waits for other sources
+        """
+        self._embed_fn = embed_fn
+        self._max_batch_size = max(1, int(max_batch_size))
+        self._max_wait = max(0., float(max_wait_ms)) / 1000.
+        self._queue = deque()
+        self._sources = set()
+        self._cond = threading.Condition()
+        self._running = True
+        self._n_batches = 0
+        self._n_faces = 0
+        super(EmbeddingBatcher, self).__init__(name=self.__class__.__name__ if name is None else name,
+                                               daemon=True, *args, **kwargs)
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self._n_faces / self._n_batches if self._n_batches else 0.
+
+    @property
+    def n_batches(self) -> int:
+        return self._n_batches
+
+    def register(self, source_id: str) -> None:
+        """
+        a registered source is waited for, a batch is dispatched early when all of them submitted
+        :param source_id: camera id
+        :return: None
+        """
+        with self._cond:
+            self._sources.add(source_id)
+            self._cond.notify()
+
+    def unregister(self, source_id: str) -> None:
+        with self._cond:
+            self._sources.discard(source_id)
+            self._cond.notify()
+
+    def submit(self, source_id: str, track_ids: Sequence, faces: np.ndarray) -> Future:
+        """
+        queue the crops of one frame
+        :param source_id: camera id
+        :param track_ids: track id of each face
+        :param faces: preprocessed faces in shape (n,h,w,c)
+        :return: future of an EmbeddingResult
+        """
+        faces = np.asarray(faces)
+        track_ids = list(track_ids)
+        if faces.shape[0] != len(track_ids):
+            raise InCompatibleDimError("every face should have a track id")
+
+        request = _Request(source_id, track_ids, faces)
+        if faces.shape[0] == 0:
+            request.future.set_result(EmbeddingResult(source_id, track_ids, np.empty((0, 0), dtype=np.float32)))
+            return request.future
+
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("the embedding batcher is stopped")
+            self._queue.append(request)
+            self._cond.notify()
+        return request.future
+
+    def embed(self, source_id: str, track_ids: Sequence, faces: np.ndarray,
+              timeout: Union[float, None] = None) -> EmbeddingResult:
+        """
+        blocking submit
+        """
+        return self.submit(source_id, track_ids, faces).result(timeout=timeout)
+
+    def stop(self) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def _ready(self) -> bool:
+        if not self._queue:
+            return False
+        if not self._running or sum(r.faces.shape[0] for r in self._queue) >= self._max_batch_size:
+            return True
+        if self._sources and self._sources.issubset(r.source_id for r in self._queue):
+            return True
+        return time.perf_counter() - self._queue[0].submitted_at >= self._max_wait
+
+    def _take(self) -> List[_Request]:
+        batch, size = [], 0
+        while self._queue and (not batch or size + self._queue[0].faces.shape[0] <= self._max_batch_size):
+            request = self._queue.popleft()
+            batch.append(request)
+            size += request.faces.shape[0]
+        return batch
+
+    def _dispatch(self, batch: List[_Request]) -> None:
+        try:
+            embeddings = self._embed_fn(np.concatenate([r.faces for r in batch], axis=0))
+        except Exception as e:
+            for r in batch:
+                r.future.set_exception(e)
+            return
+
+        self._n_batches += 1
+        self._n_faces += embeddings.shape[0]
+        start = 0
+        for r in batch:
+            end = start + r.faces.shape[0]
+            r.future.set_result(EmbeddingResult(r.source_id, r.track_ids, embeddings[start:end]))
+            start = end
+
+    def run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready():
+                    if not self._running and not self._queue:
+                        return
+                    timeout = None
+                    if self._queue:
+                        timeout = max(0., self._max_wait - (time.perf_counter() - self._queue[0].submitted_at))
+                    self._cond.wait(timeout)
+                batch = self._take()
+            self._dispatch(batch)
@@ -1,30 +1,89 @@
-from typing import Tuple
+from typing import Dict, List, Sequence, Tuple
 from typing import Union
+from collections import deque
 
 import cv2
 import numpy as np
 import tensorflow as tf
 
 from ._basic import BasicService
+from ._batcher import EmbeddingBatcher, EmbeddingResult
+from ._runner import StageRunner
 from pathlib import Path
 
 from v2.core.source import SourcePool
 from v2.core.network import (MultiCascadeFaceDetector,
                              FaceNetModel,
                              HPEModel,
-                             MaskModel)
+                             MaskModel,
+                             run_fused)
 from v2.core.db import SimpleDatabase
 from v2.core.nomalizer import GrayScaleConvertor
-from v2.core.distance import CosineDistanceV2, CosineDistanceV1
-from v2.tools import draw_cure_face
+from v2.core.distance import CosineDistanceV2, CosineDistanceV1, Distance
+from v2.tools import draw_cure_face, inference_device
+
+
+class CameraClusters:
+    """
+    clusters of the faces of one camera, every embedded track joins the nearest cluster when it is
+    closer than the threshold and opens a new cluster otherwise
+    """
+
+    def __init__(self, distance: Distance, threshold: float, name=None):
+        """
+        :param distance: distance which scores an embedding against the cluster centers
+        :param threshold: maximum distance to join a cluster
+        """
+        self._name = self.__class__.__name__ if name is None else name
+        self._dist = distance
+        self._threshold = threshold
+        self._centers = None
+        self._tracks: List[List] = []
+
+    @property
+    def tracks(self) -> List[List]:
+        """
+        track ids of every cluster
+        """
+        return self._tracks
+
+    def assign(self, track_ids: Sequence, embeddings: np.ndarray) -> List[int]:
+        """
+        :param track_ids: track id of every embedding
+        :param embeddings: matrix in shape (n,m)
+        :return: cluster of every track
+        """
+        clusters = []
+        for track_id, embedding in zip(track_ids, embeddings):
+            embedding = embedding.reshape((1, -1))
+            cluster = -1
+            if self._centers is not None:
+                distances = self._dist.calculate_distant(embedding, self._centers)[0]
+                nearest = int(np.argmin(distances))
+                if distances[nearest] <= self._threshold:
+                    cluster = nearest
+
+            if cluster < 0:
+                self._centers = embedding if self._centers is None else np.vstack([self._centers, embedding])
+                self._tracks.append([])
+                cluster = len(self._tracks) - 1
+            self._tracks[cluster].append(track_id)
+            clusters.append(cluster)
+        return clusters
 
 
 class EmbeddingService(BasicService):
     def __init__(self, name, log_path: Path, source_pool: SourcePool, face_detector: Union[MultiCascadeFaceDetector],
                  embedded: Union[FaceNetModel], database: Union[SimpleDatabase],
                  distance: Union[CosineDistanceV2, CosineDistanceV1], mask_detector: Union[MaskModel],
-                 hpe: Union[HPEModel], display=True,
-                 *args, **kwargs):
+                 hpe: Union[HPEModel], display=True, max_batch_size: int = 32, max_wait_ms: float = 10.,
+                 device: str = "gpu", session_config: Union[tf.compat.v1.ConfigProto, None] = None,
+                 detect_batch: int = 1, *args, **kwargs):
+        """
+        :param detect_batch: frames of different sources which are detected together, see FaceDetector.extract_batch
+        """
+        if detect_batch < 1:
+            raise ValueError("detect_batch should be positive")
         self._vision = source_pool
         self._f_d = face_detector
         self._embedded = embedded
@@ -33,11 +92,97 @@ class EmbeddingService(BasicService):
         self._hpe_model = hpe
         self._mask_d = mask_detector
         self._gray_conv = GrayScaleConvertor()
+        self._max_batch_size = max_batch_size
+        self._max_wait_ms = max_wait_ms
+        self._device = device
+        self._session_config = session_config
+        self._detect_batch = detect_batch
+        self._batcher = None
+        self._pending = deque()
         super(EmbeddingService, self).__init__(name=name, log_path=log_path, display=display, *args, **kwargs)
 
     def _scale_factor(self, origin_shape: Tuple[int, int], conv_shape: Tuple[int, int]) -> Tuple[float, float]:
         return origin_shape[0] / conv_shape[0], origin_shape[1] / conv_shape[1]
 
+    def _next_streams(self) -> List[Tuple]:
+        """
+        :return: (origin_matrix, matrix, id, timestamp) of up to detect_batch sources
+        """
+        if self._detect_batch > 1:
+            return self._vision.next_streams(self._detect_batch)
+        o_frame, v_frame, v_id, v_timestamp = self._vision.next_stream()
+        if v_frame is None and v_id is None and v_timestamp is None:
+            return []
+        return [(o_frame, v_frame, v_id, v_timestamp)]
+
+    def _warmup(self, session: tf.compat.v1.Session, models: list) -> None:
+        """
+        run every batch bucket of the loaded models and the P-Net pyramid of every source frame size once,
+        the service is ready afterwards
+        """
+        for model in models:
+            model.warmup(session=session, on_call=self._readiness.record, frame_shapes=self._vision.frame_shapes)
+        for call in self._readiness.calls:
+            self._file_logger.info(f"[Warmup] {call.model} {call.shape} {call.seconds * 1000.:.1f} ms")
+        msg = f"[OK] models are warmed up for batch sizes {self._embedded.batch_buckets} " \
+              f"in {self._readiness.warmup_seconds:.2f}s"
+        self._file_logger.info(msg)
+        if self._display:
+            self._console_logger.success(msg)
+
+    def _set_ready(self) -> None:
+        self._readiness.set_ready()
+        msg = "[OK] Ready to start"
+        self._file_logger.info(msg)
+        if self._display:
+            self._console_logger.success(msg)
+
+    def _start_batcher(self, session: tf.compat.v1.Session) -> EmbeddingBatcher:
+        """
+        start the shared embedding batcher of all sources, the default graph is thread local so the
+        graph of the caller is captured for the batcher thread
+        """
+        graph = tf.compat.v1.get_default_graph()
+
+        def _embed(batch: np.ndarray) -> np.ndarray:
+            with graph.as_default():
+                return self._embedded.get_embeddings(session, batch)
+
+        self._batcher = EmbeddingBatcher(_embed, max_batch_size=self._max_batch_size, max_wait_ms=self._max_wait_ms,
+                                         name=f"{self._name}_batcher")
+        for source_id in self._vision.source_ids:
+            self._batcher.register(source_id)
+        self._batcher.start()
+        return self._batcher
+
+    def _submit_faces(self, source_id: str, track_ids: Sequence, faces: np.ndarray) -> None:
+        """
+        queue the faces of one frame without waiting for the embeddings
+        """
+        self._pending.append(self._batcher.submit(source_id, track_ids, faces))
+
+    def _completed_embeddings(self) -> List[EmbeddingResult]:
+        """
+        :return: results of the submitted frames which are embedded, in submission order
+        """
+        results = []
+        while self._pending and self._pending[0].done():
+            results.append(self._pending.popleft().result())
+        return results
+
+    def _crop_faces(self, mat: np.ndarray, boxes: np.ndarray, size: Tuple[int, int] = (160, 160)) -> np.ndarray:
+        """
+        :param mat: frame in shape (h,w,c)
+        :param boxes: boxes in shape (n,4)
+        :param size: face size
+        :return: tensor in shape (n,size,size,c)
+        """
+        faces = []
+        for x_min, y_min, x_max, y_max in boxes[:, :4].astype(np.int):
+            face = mat[max(y_min, 0):max(y_max, 0), max(x_min, 0):max(x_max, 0)]
+            faces.append(cv2.resize(face, size) if face.size else np.zeros(size + mat.shape[2:], dtype=mat.dtype))
+        return np.array(faces) if faces else np.empty((0,) + size + mat.shape[2:], dtype=mat.dtype)
+
     def _get_origin_box(self, scale_factor: Tuple[float, float], boxes: np.ndarray) -> np.ndarray:
         if boxes.shape[0] > 0:
             x_min = boxes[:, 0] * scale_factor[0]
@@ -53,22 +198,37 @@ class EmbeddingService(BasicService):
 
 
 class ClusteringService(EmbeddingService):
-    def __init__(self, name, log_path: Path, display=True, *args, **kwargs):
+    def __init__(self, name, log_path: Path, display=True, cluster_threshold: float = 0.5, *args, **kwargs):
+        """
+        :param cluster_threshold: maximum distance of a track to the cluster it joins, see CameraClusters
+        """
+        self._cluster_threshold = cluster_threshold
+        self._clusters: Dict[str, CameraClusters] = dict()
         super(ClusteringService, self).__init__(name=name, log_path=log_path, display=display, *args, **kwargs)
 
+    def _route(self, result: EmbeddingResult) -> List[int]:
+        """
+        hand the embeddings of a frame to the clusters of its camera
+        :return: cluster of every track of the result
+        """
+        clusters = self._clusters.get(result.source_id)
+        if clusters is None:
+            clusters = CameraClusters(self._dist, self._cluster_threshold, name=f"{result.source_id}_clusters")
+            self._clusters[result.source_id] = clusters
+        return clusters.assign(result.track_ids, result.embeddings)
+
     def exec_(self, *args, **kwargs) -> None:
 
-        physical_devices = tf.config.list_physical_devices('GPU')
-        tf.config.experimental.set_memory_growth(physical_devices[0], True)
+        device = inference_device(self._device)
 
         msg = f"[Start] clustering server is now starting"
         self._file_logger.info(msg)
         if self._display:
             self._console_logger.success(msg)
 
-        with tf.device('/device:gpu:0'):
+        with tf.device(device):
             with tf.Graph().as_default():
-                with tf.compat.v1.Session() as sess:
+                with tf.compat.v1.Session(config=self._session_config) as sess:
 
                     # face detector
                     self._f_d.load_model(session=sess)
@@ -91,35 +251,58 @@ class ClusteringService(EmbeddingService):
                     if self._display:
                         self._console_logger.success(msg)
 
+                    # every batch bucket is run once before the first frame
+                    self._warmup(sess, [self._f_d, self._hpe_model, self._embedded])
+
+                    # crops of all cameras are embedded together
+                    self._start_batcher(sess)
+                    self._set_ready()
+
                     while True:
-                        o_frame, v_frame, v_id, v_timestamp = self._vision.next_stream()
+                        for result in self._completed_embeddings():
+                            for track_id, cluster in zip(result.track_ids, self._route(result)):
+                                msg = f"[Cluster] track {track_id} of camera {result.source_id} -> cluster {cluster}"
+                                self._file_logger.info(msg)
 
-                        if v_frame is None and v_id is None and v_timestamp is None:
+                        streams = self._next_streams()
+                        if not streams:
                             continue
 
-                        scale_ratio = self._scale_factor(origin_shape=o_frame.shape, conv_shape=v_frame.shape)
+                        detections = self._f_d.extract_batch([v_frame for _, v_frame, _, _ in streams])
+                        for (o_frame, v_frame, v_id, v_timestamp), (f_bound, f_landmarks) in zip(streams, detections):
+                            scale_ratio = self._scale_factor(origin_shape=o_frame.shape, conv_shape=v_frame.shape)
 
-                        f_bound, f_landmarks = self._f_d.extract(im=v_frame)
-                        origin_f_bound = self._get_origin_box(scale_ratio, f_bound)
-                        origin_gray_one_ch_frame = self._gray_conv.normalize(o_frame.copy(), channel="one")
-                        origin_gray_full_ch_frame = self._gray_conv.normalize(o_frame.copy(), channel="full")
+                            origin_f_bound = self._get_origin_box(scale_ratio, f_bound)
+                            origin_gray_one_ch_frame = self._gray_conv.normalize(o_frame.copy(), channel="one")
+                            origin_gray_full_ch_frame = self._gray_conv.normalize(o_frame.copy(), channel="full")
 
-                        head_scores = self._hpe_model.estimate_poses(sess, origin_gray_one_ch_frame,
-                                                                     origin_f_bound.astype(np.int))
-                        has_head, has_no_head = self._hpe_model.validate_angle(head_scores)
+                            head_scores = self._hpe_model.estimate_poses(sess, origin_gray_one_ch_frame,
+                                                                         origin_f_bound.astype(np.int))
+                            has_head, has_no_head = self._hpe_model.validate_angle(head_scores)
 
-                        if has_no_head.shape[0]:
-                            msg = f"[Drop] {head_scores.shape[0]} face have been dropped."
-                            self._file_logger.info(msg)
-                            if self._display:
-                                self._console_logger.warn(msg)
+                            if has_no_head.shape[0]:
+                                msg = f"[Drop] {head_scores.shape[0]} face have been dropped."
+                                self._file_logger.info(msg)
+                                if self._display:
+                                    self._console_logger.warn(msg)
+
+                            if has_head.shape[0] > 0:
+                                faces = self._crop_faces(origin_gray_full_ch_frame, origin_f_bound[has_head, ...])
+                                self._submit_faces(v_id, [f"{v_timestamp}-{i}" for i in has_head], faces)
 
 
 class RawVisualService(EmbeddingService):
     COLOR_DEFAULT = (0, 0, 255)
     COLOR_DODGER_BLUE = (255, 144, 30)
 
-    def __init__(self, name, log_path: Path, display=True, *args, **kwargs):
+    def __init__(self, name, log_path: Path, display=True, fused: bool = False, pipelined: bool = False,
+                 *args, **kwargs):
+        """
+        :param fused: run the head pose estimator and the mask classifier by one session call
+        :param pipelined: run the head pose and mask stages of a frame while the next frame is in detection
+        """
+        self._fused = fused
+        self._runner = StageRunner(max_workers=1, name="pose_mask_stage") if pipelined else None
         super(RawVisualService, self).__init__(name=name, log_path=log_path, display=display, *args, **kwargs)
 
     def _draw(self, mat: np.ndarray, box_mat: np.ndarray, label_mat: Union[np.ndarray, None] = None) -> np.ndarray:
@@ -131,19 +314,65 @@ class RawVisualService(EmbeddingService):
 
         return mat
 
+    def _analyze(self, session: tf.compat.v1.Session, origin_f_bound: np.ndarray, gray_one_ch_frame: np.ndarray,
+                 gray_full_ch_frame: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        head pose and mask stages of one frame
+        :return: head scores, faces with a valid head pose, dropped faces and mask scores of the valid ones
+        """
+        all_mask_scores = None
+        if self._fused and origin_f_bound.shape[0] > 0:
+            # poses and mask scores of every face by one session call
+            boxes = origin_f_bound.astype(np.int)
+            raw_poses, all_mask_scores = run_fused(session, [
+                (self._hpe_model, self._hpe_model.prepare(gray_one_ch_frame, boxes)),
+                (self._mask_d, self._mask_d.prepare(gray_full_ch_frame, boxes))])
+            head_scores = self._hpe_model.postprocess(raw_poses)
+        else:
+            head_scores = self._hpe_model.estimate_poses(session, gray_one_ch_frame, origin_f_bound.astype(np.int))
+        has_head, has_no_head = self._hpe_model.validate_angle(head_scores)
+
+        mask_scores = np.empty((0, 1))
+        if has_head.shape[0] > 0:
+            if all_mask_scores is not None:
+                mask_scores = all_mask_scores[has_head, ...]
+            else:
+                mask_scores = self._mask_d.predict(gray_full_ch_frame, origin_f_bound[has_head, ...].astype(np.int))
+        return head_scores, has_head, has_no_head, mask_scores
+
+    def _report(self, o_frame: np.ndarray, v_id: str, origin_f_bound: np.ndarray,
+                analysis: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]) -> None:
+        head_scores, has_head, has_no_head, mask_scores = analysis
+
+        if has_no_head.shape[0]:
+            msg = f"[Drop] {head_scores.shape[0]} face have been dropped."
+            self._file_logger.info(msg)
+            if self._display:
+                self._console_logger.warn(msg)
+
+        if has_head.shape[0] > 0:
+            has_mask, has_no_mask = self._mask_d.validate_mask(mask_scores)
+
+            print(has_mask)
+            print(has_no_mask)
+
+        # display
+        display_frame = self._draw(o_frame, origin_f_bound, None)
+        window_name = f"{v_id[0:5]}..."
+        cv2.imshow(window_name, display_frame)
+
     def exec_(self, *args, **kwargs) -> None:
 
-        physical_devices = tf.config.list_physical_devices('GPU')
-        tf.config.experimental.set_memory_growth(physical_devices[0], True)
+        device = inference_device(self._device)
 
         msg = f"[Start] recognition server is now starting"
         self._file_logger.info(msg)
         if self._display:
             self._console_logger.success(msg)
 
-        with tf.device('/device:gpu:0'):
+        with tf.device(device):
             with tf.Graph().as_default():
-                with tf.compat.v1.Session() as sess:
+                with tf.compat.v1.Session(config=self._session_config) as sess:
 
                     # face detector
                     self._f_d.load_model(session=sess)
@@ -173,43 +402,39 @@ class RawVisualService(EmbeddingService):
                     if self._display:
                         self._console_logger.success(msg)
 
-                    while True:
-                        o_frame, v_frame, v_id, v_timestamp = self._vision.next_stream()
+                    # every batch bucket is run once before the first frame
+                    self._warmup(sess, [self._f_d, self._hpe_model, self._mask_d, self._embedded])
+                    self._set_ready()
 
-                        if v_frame is None and v_id is None and v_timestamp is None:
+                    pending = None
+                    while True:
+                        streams = self._next_streams()
+                        if not streams:
                             continue
 
-                        scale_ratio = self._scale_factor(origin_shape=o_frame.shape, conv_shape=v_frame.shape)
-
                         if cv2.waitKey(1) == ord("q"):
                             break
 
-                        f_bound, f_landmarks = self._f_d.extract(im=v_frame)
-                        origin_f_bound = self._get_origin_box(scale_ratio, f_bound)
-                        origin_gray_one_ch_frame = self._gray_conv.normalize(o_frame.copy(), channel="one")
-                        origin_gray_full_ch_frame = self._gray_conv.normalize(o_frame.copy(), channel="full")
-
-                        head_scores = self._hpe_model.estimate_poses(sess, origin_gray_one_ch_frame,
-                                                                     origin_f_bound.astype(np.int))
-                        has_head, has_no_head = self._hpe_model.validate_angle(head_scores)
-
-                        if has_no_head.shape[0]:
-                            msg = f"[Drop] {head_scores.shape[0]} face have been dropped."
-                            self._file_logger.info(msg)
-                            if self._display:
-                                self._console_logger.warn(msg)
-
-                        if has_head.shape[0] > 0:
-                            mask_scores = self._mask_d.predict(origin_gray_full_ch_frame,
-                                                               origin_f_bound[has_head, ...].astype(np.int))
-                            has_mask, has_no_mask = self._mask_d.validate_mask(mask_scores)
-
-
-
-                            print(has_mask)
-                            print(has_no_mask)
-
-                        # display
-                        display_frame = self._draw(o_frame, origin_f_bound, None)
-                        window_name = f"{v_id[0:5]}..."
-                        cv2.imshow(window_name, display_frame)
+                        detections = self._f_d.extract_batch([v_frame for _, v_frame, _, _ in streams])
+                        for (o_frame, v_frame, v_id, v_timestamp), (f_bound, f_landmarks) in zip(streams, detections):
+                            scale_ratio = self._scale_factor(origin_shape=o_frame.shape, conv_shape=v_frame.shape)
+
+                            origin_f_bound = self._get_origin_box(scale_ratio, f_bound)
+                            origin_gray_one_ch_frame = self._gray_conv.normalize(o_frame.copy(), channel="one")
+                            origin_gray_full_ch_frame = self._gray_conv.normalize(o_frame.copy(), channel="full")
+
+                            if self._runner is None:
+                                self._report(o_frame, v_id, origin_f_bound,
+                                             self._analyze(sess, origin_f_bound, origin_gray_one_ch_frame,
+                                                           origin_gray_full_ch_frame))
+                                continue
+
+                            # head pose and mask of this frame run while the next frame is in detection
+                            if pending is not None:
+                                self._report(*pending[0], pending[1].result())
+                            pending = ((o_frame, v_id, origin_f_bound),
+                                       self._runner.submit(self._analyze, sess, origin_f_bound,
+                                                           origin_gray_one_ch_frame, origin_gray_full_ch_frame))
+
+                    if self._runner is not None:
+                        self._runner.shutdown()
@@ -0,0 +1,87 @@
+import time
+import threading
+from typing import Callable, List, Sequence
+
+import numpy as np
+
+
+class WarmupCall:
+    __slots__ = ["model", "shape", "seconds"]
+
+    def __init__(self, model: str, shape: Sequence[int], seconds: float):
+        self.model = model
+        self.shape = tuple(int(d) for d in shape)
+        self.seconds = seconds
+
+    def __repr__(self):
+        return f"WarmupCall: {self.model} {self.shape} in {self.seconds * 1000.:.1f} ms"
+
+
+class Readiness:
+    """
+    readiness flag of a service, every warmup call is timed through it and the flag is set once all
+    the models have seen their input shapes, other threads poll or wait on it
+    """
+
+    def __init__(self, name=None):
+        self._name = self.__class__.__name__ if name is None else name
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._calls: List[WarmupCall] = []
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def ready(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def calls(self) -> List[WarmupCall]:
+        with self._lock:
+            return list(self._calls)
+
+    @property
+    def warmup_seconds(self) -> float:
+        return sum(c.seconds for c in self.calls)
+
+    def record(self, model: str, shape: Sequence[int], seconds: float) -> None:
+        """
+        :param model: name of the model
+        :param shape: input shape of the call
+        :param seconds: duration of the call
+        :return: None
+        """
+        with self._lock:
+            self._calls.append(WarmupCall(model, shape, seconds))
+
+    def timed(self, model: str, fn: Callable, batch: np.ndarray):
+        """
+        run and record one warmup call
+        :param model: name of the model
+        :param fn: callable which takes the batch
+        :param batch: synthetic input
+        :return: output of fn
+        """
+        start = time.perf_counter()
+        out = fn(batch)
+        self.record(model, batch.shape, time.perf_counter() - start)
+        return out
+
+    def set_ready(self) -> None:
+        self._event.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        :param timeout: seconds, forever by default
+        :return: readiness after waiting
+        """
+        return self._event.wait(timeout)
+
+    def as_dict(self) -> dict:
+        return {"name": self._name,
+                "ready": self.ready,
+                "warmup_ms": round(self.warmup_seconds * 1000., 3),
+                "calls": [{"model": c.model, "shape": list(c.shape), "ms": round(c.seconds * 1000., 3)}
+                          for c in self.calls]}
@@ -0,0 +1,109 @@
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+
+
+def pad_boxes(boxes: np.ndarray, padding: float, min_side: int, frame_shape: Tuple[int, int]) -> np.ndarray:
+    """
+    :param boxes: boxes in shape (n,4) as (x_min, y_min, x_max, y_max)
+    :param padding: added to every side as a ratio of the larger side of the box
+    :param min_side: smaller boxes grow around their center up to min_side
+    :param frame_shape: (height, width) the boxes are clipped to
+    :return: integer boxes in shape (n,4)
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    center = (boxes[:, :2] + boxes[:, 2:]) / 2.
+    half = np.maximum(np.max(boxes[:, 2:] - boxes[:, :2], axis=1) * (.5 + padding), min_side / 2.)[:, None]
+    h, w = frame_shape
+    padded = np.hstack([np.floor(center - half), np.ceil(center + half)])
+    padded = np.clip(padded, 0, [w, h, w, h]).astype(np.int32)
+    return padded[(padded[:, 2] > padded[:, 0]) & (padded[:, 3] > padded[:, 1])]
+
+
+def merge_boxes(boxes: np.ndarray) -> np.ndarray:
+    """
+    replace overlapping boxes by their bounding box until no two boxes overlap
+    :param boxes: boxes in shape (n,4) as (x_min, y_min, x_max, y_max)
+    :return: boxes in shape (m,4), m <= n
+    """
+    boxes = [b for b in np.asarray(boxes).reshape(-1, 4)]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = np.concatenate([np.minimum(a[:2], b[:2]), np.maximum(a[2:], b[2:])])
+                    boxes.pop(j)
+                    merged = True
+                    break
+            if merged:
+                break
+    return np.array(boxes, dtype=np.int32).reshape(-1, 4)
+
+
+class RoiPlanner:
+    """
+    regions of a frame the face detector should scan, the motion regions and the predicted boxes of the
+    tracks are padded and merged, every full_scan calls the whole frame is scanned so new faces which
+    did not move are found too
+    """
+
+    def __init__(self, full_scan: int = 10, padding: float = .5, min_side: int = 48, max_area: float = .6,
+                 name=None):
+        """
+        :param full_scan: one call of full_scan calls scans the whole frame, 1 always scans it
+        :param padding: added to every side of a region as a ratio of its larger side
+        :param min_side: smaller regions grow up to min_side, a region should fit a face of the minimum size
+        :param max_area: the whole frame is scanned when the regions cover more of it
+        """
+        if full_scan < 1:
+            raise ValueError("full_scan should be positive")
+        self._name = self.__class__.__name__ if name is None else name
+        self._full_scan = full_scan
+        self._padding = padding
+        self._min_side = min_side
+        self._max_area = max_area
+        self._calls = 0
+        self._full_scans = 0
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    @property
+    def full_scans(self) -> int:
+        return self._full_scans
+
+    def plan(self, frame_shape: Tuple[int, int], motion: Union[Sequence, None] = None,
+             tracks: Union[np.ndarray, None] = None) -> Union[np.ndarray, None]:
+        """
+        :param frame_shape: (height, width) of the frame
+        :param motion: motion regions as (x, y, w, h) like BSMotionDetection, None when the motion is unknown
+        :param tracks: predicted boxes of the tracks in shape (n,4) as (x_min, y_min, x_max, y_max)
+        :return: None to scan the whole frame, or regions in shape (n,4) which may be empty
+        """
+        self._calls += 1
+        if motion is None or (self._calls - 1) % self._full_scan == 0:
+            self._full_scans += 1
+            return None
+
+        boxes = [np.empty((0, 4)) if tracks is None else np.asarray(tracks, dtype=np.float64).reshape(-1, 4)]
+        if len(motion) > 0:
+            motion = np.asarray(motion, dtype=np.float64).reshape(-1, 4)
+            boxes.append(np.hstack([motion[:, :2], motion[:, :2] + motion[:, 2:]]))
+        rois = merge_boxes(pad_boxes(np.concatenate(boxes), self._padding, self._min_side, frame_shape))
+
+        area = np.sum((rois[:, 2] - rois[:, 0]) * (rois[:, 3] - rois[:, 1]))
+        if area > self._max_area * frame_shape[0] * frame_shape[1]:
+            self._full_scans += 1
+            return None
+        return rois
+
+    def __repr__(self):
+        return f"RoiPlanner: full scan {self._full_scans} of {self._calls} calls"
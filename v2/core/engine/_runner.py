@@ -0,0 +1,42 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Sequence, Tuple
+
+
+class StageRunner:
+    """
+    runs independent stages on a thread pool, e.g. the head pose of frame n while the detector is busy
+    with frame n+1, the models of concurrent stages should be isolated so each one runs on its own
+    session and thread pools
+    """
+
+    def __init__(self, max_workers: int = 2, name=None):
+        """
+        :param max_workers: stages which run at the same time
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers should be positive")
+        self._name = self.__class__.__name__ if name is None else name
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=self._name)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        :param fn: stage
+        :return: Future of the stage output
+        """
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def run(self, stages: Sequence[Tuple[Callable, tuple]]) -> List:
+        """
+        run stages concurrently and wait for all of them
+        :param stages: (callable, args) pairs
+        :return: outputs in the order of stages
+        """
+        futures = [self._pool.submit(fn, *args) for fn, args in stages]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
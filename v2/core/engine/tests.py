@@ -1,7 +1,18 @@
 from unittest import TestCase
+import threading
+import numpy as np
 from v2.tools.logger import LOG_Path
 
 from v2.core.engine._basic import BasicService
+from v2.core.engine._batcher import EmbeddingBatcher
+from v2.core.engine._readiness import Readiness
+from v2.core.engine._runner import StageRunner
+from v2.core.engine._default import CameraClusters
+from v2.core.distance import CosineDistanceV2
+from v2.core.engine._roi import RoiPlanner, pad_boxes, merge_boxes
+
+# exceptions
+from v2.core.exceptions import InCompatibleDimError
 
 
 class BasicServiceTestCase(TestCase):
@@ -17,3 +28,126 @@ class BasicServiceTestCase(TestCase):
         self.assertEqual(a.name, "bladeRunner")
 
 
+
+
+class EmbeddingBatcherTestCase(TestCase):
+    def setUp(self) -> None:
+        self.calls = []
+
+        def _embed(batch):
+            self.calls.append(batch.shape[0])
+            return batch.reshape((batch.shape[0], -1)).sum(axis=1, keepdims=True)
+
+        self.batcher = EmbeddingBatcher(_embed, max_batch_size=8, max_wait_ms=1000.)
+
+    def tearDown(self) -> None:
+        self.batcher.stop()
+
+    def test_batch_all_registered_sources(self):
+        self.batcher.register("cam_1")
+        self.batcher.register("cam_2")
+        first = self.batcher.submit("cam_1", ["a", "b"], np.ones((2, 4, 4, 3)))
+        second = self.batcher.submit("cam_2", ["c"], np.full((1, 4, 4, 3), 2.))
+        self.batcher.start()
+
+        res_1, res_2 = first.result(timeout=1.), second.result(timeout=1.)
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(res_1.source_id, "cam_1")
+        self.assertEqual(res_1.track_ids, ["a", "b"])
+        np.testing.assert_allclose(res_1.embeddings[:, 0], [48., 48.])
+        self.assertEqual(res_2.track_ids, ["c"])
+        np.testing.assert_allclose(res_2.embeddings[:, 0], [96.])
+
+    def test_max_batch_size_and_wait(self):
+        batcher = EmbeddingBatcher(lambda b: b.reshape((b.shape[0], -1))[:, :1], max_batch_size=4, max_wait_ms=5.)
+        batcher.start()
+        futures = [batcher.submit("cam_1", [i, i + 1, i + 2], np.ones((3, 2, 2, 1))) for i in range(3)]
+        self.assertTrue(all(f.result(timeout=1.).embeddings.shape == (3, 1) for f in futures))
+        self.assertGreaterEqual(batcher.n_batches, 3)
+        batcher.stop()
+
+    def test_submit_incompatible_track_ids(self):
+        with self.assertRaises(InCompatibleDimError):
+            self.batcher.submit("cam_1", ["a"], np.ones((2, 4, 4, 3)))
+
+
+class ReadinessTestCase(TestCase):
+    def test_timed_calls_and_flag(self):
+        readiness = Readiness(name="service")
+        self.assertFalse(readiness.ready)
+        self.assertFalse(readiness.wait(timeout=0.01))
+
+        out = readiness.timed("model", lambda b: b.sum(), np.ones((4, 3)))
+        readiness.record("other", (1, 2), 0.5)
+        self.assertEqual(out, 12.)
+        self.assertEqual([(c.model, c.shape) for c in readiness.calls], [("model", (4, 3)), ("other", (1, 2))])
+        self.assertGreaterEqual(readiness.warmup_seconds, 0.5)
+
+        readiness.set_ready()
+        self.assertTrue(readiness.wait(timeout=0.01))
+        report = readiness.as_dict()
+        self.assertTrue(report["ready"])
+        self.assertEqual(report["calls"][1], {"model": "other", "shape": [1, 2], "ms": 500.})
+
+    def test_service_readiness(self):
+        a = BasicService(name="service", log_path=LOG_Path)
+        self.assertEqual(a.readiness.name, "service")
+        self.assertFalse(a.readiness.ready)
+
+
+class StageRunnerTestCase(TestCase):
+    def test_stages_overlap(self):
+        runner = StageRunner(max_workers=2)
+        barrier = threading.Barrier(2, timeout=1.)
+        # both stages pass the barrier only when they run at the same time
+        outputs = runner.run([(lambda x: barrier.wait() is not None and x * 2, (1,)),
+                              (lambda x: barrier.wait() is not None and x * 3, (2,))])
+        self.assertEqual(outputs, [2, 6])
+        self.assertEqual(runner.submit(sum, [1, 2]).result(timeout=1.), 3)
+        runner.shutdown()
+
+    def test_invalid_workers(self):
+        with self.assertRaises(ValueError):
+            _ = StageRunner(max_workers=0)
+
+
+class CameraClustersTestCase(TestCase):
+    def test_assign(self):
+        clusters = CameraClusters(CosineDistanceV2(similarity_threshold=.5), threshold=.1)
+        self.assertEqual(clusters.assign(["a", "b"], np.array([[1., 0.], [0., 1.]])), [0, 1])
+        self.assertEqual(clusters.assign(["c"], np.array([[.99, .01]])), [0])
+        self.assertEqual(clusters.tracks, [["a", "c"], ["b"]])
+        self.assertEqual(clusters.assign([], np.empty((0, 2))), [])
+
+
+class RoiPlannerTestCase(TestCase):
+    def test_pad_boxes(self):
+        boxes = pad_boxes(np.array([[10, 10, 30, 30], [100, 50, 102, 52]]), padding=.5, min_side=40,
+                          frame_shape=(60, 120))
+        np.testing.assert_array_equal(boxes, [[0, 0, 40, 40], [81, 31, 120, 60]])
+
+    def test_merge_boxes(self):
+        boxes = merge_boxes(np.array([[0, 0, 10, 10], [50, 50, 60, 60], [5, 5, 20, 20], [18, 0, 52, 55]]))
+        np.testing.assert_array_equal(boxes, [[0, 0, 60, 60]])
+        np.testing.assert_array_equal(merge_boxes(np.array([[0, 0, 10, 10], [10, 0, 20, 10]])),
+                                      [[0, 0, 10, 10], [10, 0, 20, 10]])
+
+    def test_full_scan(self):
+        planner = RoiPlanner(full_scan=3, padding=0., min_side=10)
+        plans = [planner.plan((100, 100), motion=[(10, 10, 10, 10)]) for _ in range(6)]
+        self.assertEqual([p is None for p in plans], [True, False, False, True, False, False])
+        np.testing.assert_array_equal(plans[1], [[10, 10, 20, 20]])
+        self.assertEqual(planner.full_scans, 2)
+
+        self.assertIsNone(planner.plan((100, 100), motion=None))
+        with self.assertRaises(ValueError):
+            RoiPlanner(full_scan=0)
+
+    def test_plan_regions(self):
+        planner = RoiPlanner(full_scan=100, padding=0., min_side=10, max_area=.5)
+        planner.plan((100, 100), motion=[])
+        self.assertEqual(planner.plan((100, 100), motion=[]).shape, (0, 4))
+        rois = planner.plan((100, 100), motion=[(0, 0, 10, 10)], tracks=np.array([[5., 5., 15., 15.],
+                                                                                   [60., 60., 70., 70.]]))
+        np.testing.assert_array_equal(rois, [[0, 0, 15, 15], [60, 60, 70, 70]])
+        self.assertIsNone(planner.plan((100, 100), motion=[(0, 0, 80, 80)]))
@@ -1,11 +1,18 @@
-from .base import BaseModel
+from .base import BaseModel, run_fused
 from ._face_detector import FaceDetector
 from ._recognizer import FaceNetModel
+from ._lite import LiteFaceNetModel, convert_to_lite
 from ._hpe import HeadPoseEstimatorModel
 from ._mask import MaskClassifierModel
+from ._inference import KerasInference, INFERENCE_MODES
 
 BaseModel = BaseModel
+run_fused = run_fused
 MultiCascadeFaceDetector = FaceDetector
 FaceNetModel = FaceNetModel
+LiteFaceNetModel = LiteFaceNetModel
+convert_to_lite = convert_to_lite
 HPEModel = HeadPoseEstimatorModel
 MaskModel = MaskClassifierModel
+KerasInference = KerasInference
+INFERENCE_MODES = INFERENCE_MODES
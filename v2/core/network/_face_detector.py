@@ -1,4 +1,4 @@
-from typing import List, Tuple
+from typing import List, Sequence, Tuple
 
 # model
 import numpy as np
@@ -11,8 +11,16 @@ from v2.core.exceptions import *
 
 
 class FaceDetector(BaseModel):
-    def __init__(self, stages_threshold, scale_factor: float, min_face: int, name=None,
-                 *args, **kwargs):
+    def __init__(self, stages_threshold, scale_factor: float, min_face: int, name=None, graph_path=None,
+                 packed_pyramid: bool = False, max_candidates: int = 0, *args, **kwargs):
+        """
+        :param graph_path: frozen graph of the three stages, used instead of the npy weights when it exists
+        :param packed_pyramid: run P-Net once on the packed pyramid instead of once per scale
+        :param max_candidates: best P-Net candidates which take part in the first stage nms, 0 for all of them
+        """
+        self._graph_path = graph_path
+        self._packed_pyramid = packed_pyramid
+        self._max_candidates = max_candidates if max_candidates > 0 else None
         self._stages_threshold = stages_threshold
         self._scale_factor = scale_factor
         self._min_face = min_face
@@ -34,12 +42,32 @@ class FaceDetector(BaseModel):
     def set_outputs_name(self, names: List[str]) -> None:
         raise DisableMethodWarning("set_outputs_name method has disabled by child class")
 
-    def load_model(self, **kwargs):
-        _sess = kwargs.get("session")
-        if _sess is None:
+    def _load(self, session) -> None:
+        if session is None:
             raise SessionIsNotSetError("you should set session on load_model")
 
-        self._p_net_fn, self._r_net_fn, self._o_net_fn = detect_face.create_mtcnn(sess=_sess)
+        self._p_net_fn, _r_net_fn, _o_net_fn = detect_face.create_mtcnn(sess=session, graph_path=self._graph_path)
+        # the pyramid of P-Net changes the spatial shape, only R-Net and O-Net batches are bucketed
+        self._r_net_fn = lambda b: self._run_bucketed(_r_net_fn, b)
+        self._o_net_fn = lambda b: self._run_bucketed(_o_net_fn, b)
+
+    def warmup(self, **kwargs) -> None:
+        """
+        :param kwargs: on_call timing callback, frame_shapes (h,w) of the sources whose P-Net pyramid is run
+        """
+        on_call = kwargs.get("on_call")
+        for h, w in kwargs.get("frame_shapes") or []:
+            scales = detect_face.pyramid_scales(h, w, self._min_face, self._scale_factor)
+            if self._packed_pyramid:
+                (ch, cw), _ = detect_face.pyramid_canvas(h, w, scales)
+                shapes = [(1, cw, ch, 3)]
+            else:
+                # P-Net sees the transposed image, see detect_face
+                shapes = [(1, int(np.ceil(w * scale)), int(np.ceil(h * scale)), 3) for scale in scales]
+            for shape in shapes:
+                self._warmup_call(self._p_net_fn, np.zeros(shape, dtype=np.float32), on_call)
+        self._warmup_buckets(self._r_net_fn, (24, 24, 3), on_call=on_call)
+        self._warmup_buckets(self._o_net_fn, (48, 48, 3), on_call=on_call)
 
     def extract(self, im: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         return detect_face.detect_face(im,
@@ -48,5 +76,44 @@ class FaceDetector(BaseModel):
                                        rnet=self._r_net_fn,
                                        onet=self._o_net_fn,
                                        threshold=self._stages_threshold,
-                                       factor=self._scale_factor
+                                       factor=self._scale_factor,
+                                       packed=self._packed_pyramid,
+                                       max_candidates=self._max_candidates
                                        )
+
+    def extract_batch(self, ims: Sequence[np.ndarray]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        detect the faces of several frames, e.g. one frame of every camera or consecutive frames of a file,
+        R-Net and O-Net run once on the candidates of all the frames
+        :param ims: frames in shape (h,w,3), their sizes may differ
+        :return: (boxes, landmarks) of each frame like extract
+        """
+        if not ims:
+            return []
+        return detect_face.detect_faces(list(ims),
+                                        minsize=self._min_face,
+                                        pnet=self._p_net_fn,
+                                        rnet=self._r_net_fn,
+                                        onet=self._o_net_fn,
+                                        threshold=self._stages_threshold,
+                                        factor=self._scale_factor,
+                                        packed=self._packed_pyramid,
+                                        max_candidates=self._max_candidates)
+
+    def extract_rois(self, im: np.ndarray, rois: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        detect the faces inside regions of a frame, e.g. the motion regions and the predicted boxes of the
+        tracks, R-Net and O-Net run once on the candidates of all the regions
+        :param im: frame in shape (h,w,3)
+        :param rois: regions in shape (n,4) as (x_min, y_min, x_max, y_max), see RoiPlanner
+        :return: (boxes, landmarks) in the coordinates of the frame like extract
+        """
+        return detect_face.detect_face_rois(im, rois,
+                                            minsize=self._min_face,
+                                            pnet=self._p_net_fn,
+                                            rnet=self._r_net_fn,
+                                            onet=self._o_net_fn,
+                                            threshold=self._stages_threshold,
+                                            factor=self._scale_factor,
+                                            packed=self._packed_pyramid,
+                                            max_candidates=self._max_candidates)
@@ -37,8 +37,20 @@ class HeadPoseEstimatorModel(BaseModel):
         self._poses_tensor_shape = tf.TensorShape([None, 2])
         self._normalizer = HpeNormalizer(name="pose-estimator")
 
-    def estimate_poses(self, session: tf.compat.v1.Session, input_im: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    def _run(self, session: tf.compat.v1.Session, batch: np.ndarray) -> np.ndarray:
+        return self._session_of(session).run(self.fetch, feed_dict=self.feed_dict(batch))
+
+    def warmup(self, **kwargs) -> None:
+        _sess = self._session_of(kwargs.get("session"))
+        self._warmup_buckets(lambda b: self._run(_sess, b), self._input_tensor_shape.as_list()[1:],
+                             on_call=kwargs.get("on_call"))
 
+    def prepare(self, input_im: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+        """
+        :param input_im: gray level frame in shape (h,w)
+        :param boxes: boxes in shape (n,4)
+        :return: normalized crops in shape (n,64,64,1) for feed_dict
+        """
         try:
             self._bounding_box_tensor_shape.assert_is_compatible_with(boxes.shape)
             _norm_cropped = self._normalizer.normalize(mat=input_im,
@@ -47,17 +59,23 @@ class HeadPoseEstimatorModel(BaseModel):
                                                        hpe_im_norm=self._img_norm,
                                                        offset_per=0,
                                                        cropping="large")
-
             self._input_tensor_shape.assert_is_compatible_with(_norm_cropped.shape)
-            _fn_input_plc = self._inputs[0][0]
-            _fn_embed_plc = self._outputs[0][0]
-            _feed = {_fn_input_plc: _norm_cropped}
-            _poses = session.run(_fn_embed_plc, feed_dict=_feed)
-            return self._normalizer.normalize_output(_poses, self._tilt_norm, self._pan_norm, self._rescale)
+            return _norm_cropped
 
         except ValueError:
             raise InCompatibleDimError("Input shape is not compatible with model shape")
 
+    def postprocess(self, poses: np.ndarray) -> np.ndarray:
+        """
+        :param poses: raw model output in shape (n,2)
+        :return: tilt and pan in degree
+        """
+        return self._normalizer.normalize_output(poses, self._tilt_norm, self._pan_norm, self._rescale)
+
+    def estimate_poses(self, session: tf.compat.v1.Session, input_im: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+        _norm_cropped = self.prepare(input_im, boxes)
+        return self.postprocess(self._run_bucketed(lambda b: self._run(session, b), _norm_cropped))
+
     def __validate_angle(self, mat: np.ndarray) -> np.ndarray:
         tilt_log = np.logical_and(mat[:, 0] < self._tilt_up, mat[:, 0] > self._tilt_down)
         pan_log = np.logical_and(mat[:, 1] < self._pan_left, mat[:, 1] > self._pan_right)
@@ -0,0 +1,71 @@
+from typing import Union
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+INFERENCE_PREDICT = "predict"
+INFERENCE_TRACED = "traced"
+INFERENCE_FROZEN = "frozen"
+INFERENCE_MODES = [INFERENCE_PREDICT, INFERENCE_TRACED, INFERENCE_FROZEN]
+# graph mode, the output tensors of the model are run by the session of its graph
+INFERENCE_SESSION = "session"
+
+
+class KerasInference:
+    """
+    direct call inference of a keras model, predict pays for its data adapter and callbacks on every
+    call which dominates the tiny per frame batches, here the forward pass is traced once by a
+    tf.function whose input signature only leaves the batch size open, frozen goes one step further
+    and folds the weights into the traced graph as constants, in graph mode the output tensors of the
+    model are already in the session graph and are run by session.run
+    """
+
+    def __init__(self, model: tf.keras.Model, mode: str = INFERENCE_TRACED,
+                 session: Union[tf.compat.v1.Session, None] = None, name=None):
+        """
+        :param model: keras model with one input
+        :param mode: predict, traced or frozen
+        :param session: session of the model graph in graph mode, the keras session by default
+        """
+        if mode not in INFERENCE_MODES:
+            raise ValueError(f"inference mode {mode} is unknown")
+        self._name = self.__class__.__name__ if name is None else name
+        self._model = model
+        self._mode = mode if tf.executing_eagerly() else INFERENCE_SESSION
+        self._fn = None
+        self._session = None
+        self._dtype = model.inputs[0].dtype
+
+        if self._mode == INFERENCE_SESSION:
+            self._session = session if session is not None else tf.compat.v1.keras.backend.get_session()
+            self._input = model.inputs[0]
+            self._fetch = model.outputs[0] if len(model.outputs) == 1 else list(model.outputs)
+        elif self._mode != INFERENCE_PREDICT:
+            spec = tf.TensorSpec([None] + list(model.inputs[0].shape[1:]), self._dtype)
+            self._fn = tf.function(lambda x: model(x, training=False), input_signature=[spec])
+            if self._mode == INFERENCE_FROZEN:
+                self._fn = convert_variables_to_constants_v2(self._fn.get_concrete_function())
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    @property
+    def model(self) -> tf.keras.Model:
+        return self._model
+
+    def __call__(self, batch: np.ndarray) -> Union[np.ndarray, list]:
+        """
+        :param batch: preprocessed tensor in shape (n,...)
+        :return: output of the model, a list for several outputs like predict
+        """
+        if self._session is not None:
+            return self._session.run(self._fetch, feed_dict={self._input: batch})
+        if self._fn is None:
+            return self._model.predict(batch, verbose=0)
+
+        out = self._fn(tf.convert_to_tensor(batch, dtype=self._dtype))
+        if isinstance(out, (list, tuple)):
+            return out[0].numpy() if len(out) == 1 else [o.numpy() for o in out]
+        return out.numpy()
@@ -0,0 +1,100 @@
+from pathlib import Path
+from typing import Dict, Union
+
+# model
+import numpy as np
+import tensorflow as tf
+
+from .base import BaseModel
+from v2.core.nomalizer import FaceNetNormalizer
+
+# exceptions
+from v2.core.exceptions import *
+
+PRECISION_FLOAT16 = "float16"
+PRECISION_INT8 = "int8"
+
+
+def convert_to_lite(keras_path: Path, lite_path: Path, precision: str = PRECISION_FLOAT16) -> Path:
+    """
+    convert the keras FaceNet model into a tflite model for cpu inference
+    :param keras_path: keras model (.h5)
+    :param lite_path: output file (.tflite)
+    :param precision: float16 weights or int8 dynamic range quantization
+    :return: lite_path
+    """
+    if precision not in [PRECISION_FLOAT16, PRECISION_INT8]:
+        raise ValueError(f"precision {precision} is unknown")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(str(keras_path), compile=False))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == PRECISION_FLOAT16:
+        converter.target_spec.supported_types = [tf.float16]
+
+    lite_path = Path(lite_path)
+    lite_path.parent.mkdir(parents=True, exist_ok=True)
+    lite_path.write_bytes(converter.convert())
+    return lite_path
+
+
+class LiteFaceNetModel(BaseModel):
+    """
+    FaceNet on the tflite cpu interpreter, it keeps the FaceNetModel interface but does not need a
+    session, one interpreter is allocated per batch bucket so a batch never resizes the tensors
+    """
+
+    def __init__(self, model_path: Path, num_threads: Union[int, None] = None, name=None, *args, **kwargs):
+        super(LiteFaceNetModel, self).__init__(model_path=model_path, name=name, *args, **kwargs)
+        self._num_threads = num_threads
+        self._interpreters: Dict[int, tf.lite.Interpreter] = {}
+        self._input_tensor_shape = tf.TensorShape([None, 160, 160, 3])
+        self._normalizer = FaceNetNormalizer(name="faceNetNormalizer")
+
+    def load_model(self, **kwargs):
+        self._interpreters = {}
+        self._interpreter(self._buckets[0])
+
+    def _interpreter(self, batch_size: int) -> tf.lite.Interpreter:
+        interpreter = self._interpreters.get(batch_size)
+        if interpreter is None:
+            interpreter = tf.lite.Interpreter(model_path=str(self._model_path), num_threads=self._num_threads)
+            _input = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(_input["index"], [batch_size] + list(_input["shape"][1:]))
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = interpreter
+        return interpreter
+
+    @property
+    def embedding_size(self) -> int:
+        return int(self._interpreter(self._buckets[0]).get_output_details()[0]["shape"][-1])
+
+    def embed(self, batch: np.ndarray) -> np.ndarray:
+        """
+        :param batch: prewhitened faces in shape (n,160,160,3)
+        :return: embeddings in shape (n,m)
+        """
+        return self._run_bucketed(self._run, batch)
+
+    def _run(self, batch: np.ndarray) -> np.ndarray:
+        interpreter = self._interpreter(batch.shape[0])
+        interpreter.set_tensor(interpreter.get_input_details()[0]["index"], batch.astype(np.float32))
+        interpreter.invoke()
+        return np.array(interpreter.get_tensor(interpreter.get_output_details()[0]["index"]))
+
+    def prepare(self, input_im: np.ndarray) -> np.ndarray:
+        try:
+            self._input_tensor_shape.assert_is_compatible_with(input_im.shape)
+        except ValueError:
+            raise InCompatibleDimError("Input shape is not compatible with model shape")
+        return self._normalizer.normalize(input_im)
+
+    def get_embeddings(self, session: Union[tf.compat.v1.Session, None], input_im: np.ndarray) -> np.ndarray:
+        """
+        :param session: not used, kept to be interchangeable with FaceNetModel
+        :param input_im: faces in shape (n,160,160,3)
+        :return: embeddings in shape (n,m)
+        """
+        return self.embed(self.prepare(input_im))
+
+    def warmup(self, **kwargs) -> None:
+        self._warmup_buckets(self._run, self._input_tensor_shape.as_list()[1:], on_call=kwargs.get("on_call"))
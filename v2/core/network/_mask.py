@@ -30,16 +30,32 @@ class MaskClassifierModel(BaseModel):
         self._box_tensor_shape.assert_is_compatible_with(boxes.shape)
 
         if boxes.shape[0] > 0:
-            _norm_cropped = self._normalizer.normalize(mat=input_im,
-                                                       b_mat=boxes,
-                                                       interpolation=cv2.INTER_LINEAR,
-                                                       offset_per=0,
-                                                       cropping="large")
-            self._input_tensor_shape.assert_is_compatible_with(_norm_cropped.shape)
-            return self._model.predict(_norm_cropped)
+            return self._run_bucketed(self._predict, self.prepare(input_im, boxes))
         else:
             return np.empty((0, 1))
 
+    def prepare(self, input_im: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+        """
+        :param input_im: frame in shape (h,w,3)
+        :param boxes: boxes in shape (n,4)
+        :return: normalized crops in shape (n,64,64,3) for feed_dict
+        """
+        _norm_cropped = self._normalizer.normalize(mat=input_im,
+                                                   b_mat=boxes,
+                                                   interpolation=cv2.INTER_LINEAR,
+                                                   offset_per=0,
+                                                   cropping="large")
+        self._input_tensor_shape.assert_is_compatible_with(_norm_cropped.shape)
+        return _norm_cropped
+
+    def _predict(self, batch: np.ndarray) -> np.ndarray:
+        with self._scope():
+            return self._infer(batch)
+
+    def warmup(self, **kwargs) -> None:
+        self._warmup_buckets(self._predict, self._input_tensor_shape.as_list()[1:],
+                             on_call=kwargs.get("on_call"))
+
     def __validate_mask(self, mat: np.ndarray) -> np.ndarray:
         _ans = np.where(mat[:, :] <= self._score_threshold)
         return _ans[0]
@@ -20,15 +20,28 @@ class FaceNetModel(BaseModel):
         self._input_tensor_shape = tf.TensorShape([None, 160, 160, 3])
         self._normalizer = FaceNetNormalizer(name="faceNetNormalizer")
 
-    def get_embeddings(self, session: tf.compat.v1.Session, input_im: np.ndarray) -> np.ndarray:
-        _in_shape = input_im.shape
-        try:
-            self._input_tensor_shape.assert_is_compatible_with(_in_shape)
-            _fn_input_plc = self._inputs[0][0]
-            _fn_embed_plc = self._outputs[0][0]
-            _fn_phase_plc = tf.compat.v1.get_default_graph().get_tensor_by_name("phase_train:0")
-            _feed = {_fn_phase_plc: False, _fn_input_plc: self._normalizer.normalize(input_im)}
-            return session.run(_fn_embed_plc, feed_dict=_feed)
+    def feed_dict(self, batch: np.ndarray) -> dict:
+        _fn_phase_plc = self.graph.get_tensor_by_name("phase_train:0")
+        return {_fn_phase_plc: False, self._inputs[0][0]: batch}
 
+    def _run(self, session: tf.compat.v1.Session, batch: np.ndarray) -> np.ndarray:
+        return self._session_of(session).run(self.fetch, feed_dict=self.feed_dict(batch))
+
+    def prepare(self, input_im: np.ndarray) -> np.ndarray:
+        """
+        :param input_im: faces in shape (n,160,160,3)
+        :return: prewhitened faces for feed_dict
+        """
+        try:
+            self._input_tensor_shape.assert_is_compatible_with(input_im.shape)
         except ValueError:
             raise InCompatibleDimError("Input shape is not compatible with model shape")
+        return self._normalizer.normalize(input_im)
+
+    def get_embeddings(self, session: tf.compat.v1.Session, input_im: np.ndarray) -> np.ndarray:
+        return self._run_bucketed(lambda b: self._run(session, b), self.prepare(input_im))
+
+    def warmup(self, **kwargs) -> None:
+        _sess = self._session_of(kwargs.get("session"))
+        self._warmup_buckets(lambda b: self._run(_sess, b), self._input_tensor_shape.as_list()[1:],
+                             on_call=kwargs.get("on_call"))
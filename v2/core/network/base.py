@@ -1,19 +1,47 @@
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Tuple, List
+from typing import Callable, Sequence, Tuple, List, Union
+import numpy as np
 import tensorflow as tf
 
+from v2.tools import ThreadBudget
+from ._inference import KerasInference, INFERENCE_TRACED
+
 # exceptions
 from v2.core.exceptions import *
 
 
 class BaseModel:
+    # every call is padded to one of these batch sizes, so the session only sees a few shapes
+    BATCH_BUCKETS = (1, 2, 4, 8, 16, 32)
+
     __file_suffixes = {
         "tf": [".pb", ".pdtxt"],
-        "keras": [".h5", ".model"]
+        "keras": [".h5", ".model"],
+        "lite": [".tflite"]
     }
 
-    def __init__(self, model_path, name=None, *args, **kwargs):
+    def __init__(self, model_path, name=None, batch_buckets: Union[Sequence[int], None] = None,
+                 isolated: bool = False, session_config: Union[tf.compat.v1.ConfigProto, None] = None,
+                 keras_inference: str = INFERENCE_TRACED, *args, **kwargs):
+        """
+        :param isolated: load the model into its own graph and session instead of the default graph,
+        so models run concurrently from different threads without sharing names or thread pools
+        :param session_config: ConfigProto of the own session, see session_config
+        :param keras_inference: predict, traced or frozen call of a keras model, see KerasInference
+        """
         self._name = self.__class__.__name__ if name is None else name
+        self._keras_inference = keras_inference
+        self._infer = None
+        self._isolated = isolated
+        self._session_config = session_config
+        self._graph = None
+        self._session = None
+        self._buckets = tuple(sorted(set(int(b) for b in (self.BATCH_BUCKETS if batch_buckets is None
+                                                           else batch_buckets) if int(b) > 0)))
+        if not self._buckets:
+            raise ValueError("at least one positive batch bucket is required")
         if model_path is not None:
             _tm = self.__determine_type(model_path)
             self._model = None
@@ -48,18 +76,145 @@ class BaseModel:
     def outputs(self) -> List[Tuple[str, tf.TensorShape]]:
         return [(layer[1], layer[2]) for layer in self._outputs]
 
+    @property
+    def batch_buckets(self) -> Tuple[int, ...]:
+        return self._buckets
+
+    @staticmethod
+    def session_config(intra_op_threads: int = 0, inter_op_threads: int = 0) -> tf.compat.v1.ConfigProto:
+        """
+        :param intra_op_threads: threads inside one op, 0 lets tensorflow decide
+        :param inter_op_threads: ops which run at the same time, 0 lets tensorflow decide
+        :return: ConfigProto whose thread pools belong to the session only
+        """
+        return ThreadBudget(tf_intra_op=intra_op_threads, tf_inter_op=inter_op_threads).session_config()
+
+    @property
+    def isolated(self) -> bool:
+        return self._isolated
+
+    @property
+    def graph(self) -> tf.Graph:
+        """
+        own graph of an isolated model, the default graph otherwise
+        """
+        return self._graph if self._graph is not None else tf.compat.v1.get_default_graph()
+
+    @property
+    def session(self) -> Union[tf.compat.v1.Session, None]:
+        """
+        own session of an isolated model after load_model, None otherwise
+        """
+        return self._session
+
+    def _session_of(self, session: Union[tf.compat.v1.Session, None]) -> tf.compat.v1.Session:
+        """
+        :param session: session given by the caller
+        :return: the own session of an isolated model, the given one otherwise
+        """
+        if self._session is not None:
+            return self._session
+        if session is None:
+            raise SessionIsNotSetError("you should set session for a model which is not isolated")
+        return session
+
+    @contextmanager
+    def _scope(self):
+        """
+        own graph of an isolated model as the default graph
+        """
+        if self._graph is None:
+            yield
+        else:
+            with self._graph.as_default():
+                yield
+
+    def close(self) -> None:
+        """
+        release the own session of an isolated model
+        """
+        if self._session is not None:
+            self._session.close()
+        self._session, self._graph = None, None
+
+    def bucket_size(self, n: int) -> int:
+        """
+        :param n: batch size
+        :return: the smallest bucket which holds n, a multiple of the largest bucket when n is bigger
+        """
+        for b in self._buckets:
+            if b >= n:
+                return b
+        return -(-n // self._buckets[-1]) * self._buckets[-1]
+
+    def _run_bucketed(self, fn: Callable, batch: np.ndarray):
+        """
+        run fn on the batch padded with zeros to its bucket size and strip the padded rows from the outputs
+        :param fn: callable which takes (b,...) and returns an array or a tuple of arrays with batch first
+        :param batch: tensor in shape (n,...)
+        :return: output of fn for the n rows
+        """
+        n = batch.shape[0]
+        bucket = self.bucket_size(n)
+        if n == 0 or bucket == n:
+            return fn(batch)
+
+        padded = np.concatenate([batch, np.zeros((bucket - n,) + batch.shape[1:], dtype=batch.dtype)], axis=0)
+        out = fn(padded)
+        return tuple(o[:n] for o in out) if isinstance(out, (tuple, list)) else out[:n]
+
+    def _warmup_buckets(self, fn: Callable, sample_shape: Sequence[int], dtype=np.float32,
+                        on_call: Union[Callable, None] = None) -> None:
+        """
+        run every bucket once, so no batch size is seen for the first time while serving
+        :param fn: callable which takes (b,...)
+        :param sample_shape: shape of one sample
+        :param dtype: input type
+        :param on_call: callable(model name, input shape, seconds) which receives the timing of each call
+        :return: None
+        """
+        for b in self._buckets:
+            self._warmup_call(fn, np.zeros((b,) + tuple(sample_shape), dtype=dtype), on_call)
+
+    def _warmup_call(self, fn: Callable, batch: np.ndarray, on_call: Union[Callable, None] = None) -> None:
+        start = time.perf_counter()
+        fn(batch)
+        if on_call is not None:
+            on_call(self._name, batch.shape, time.perf_counter() - start)
+
+    def warmup(self, **kwargs) -> None:
+        raise NotImplementedError
+
+    @property
+    def fetch(self) -> tf.Tensor:
+        """
+        output tensor of the model in the session graph
+        """
+        return self._outputs[0][0]
+
+    def feed_dict(self, batch: np.ndarray) -> dict:
+        """
+        :param batch: preprocessed tensor in shape (n,...)
+        :return: feed of the model input
+        """
+        return {self._inputs[0][0]: batch}
+
     def __determine_type(self, filename: Path):
         suf = filename.suffix
         if suf in self.__file_suffixes["tf"]:
             return "tf"
         elif suf in self.__file_suffixes["keras"]:
             return "keras"
+        elif suf in self.__file_suffixes["lite"]:
+            return "lite"
         else:
             return "unknown"
 
     def __keras_inference(self, session: tf.compat.v1.Session, model_path: Path):
         tf.compat.v1.keras.backend.set_session(session)
         self._model = tf.keras.models.load_model(str(model_path))
+        self._infer = KerasInference(self._model, self._keras_inference, session=session,
+                                     name=f"{self._name}_inference")
         self._inputs = [(layer, layer.name, layer.shape) for layer in self._model.inputs]
         self._outputs = [(layer, layer.name, layer.shape) for layer in self._model.outputs]
 
@@ -77,12 +232,51 @@ class BaseModel:
         self._outputs = [(layer, layer.name, layer.shape) for layer in self._outputs]
 
     def load_model(self, **kwargs):
+        """
+        :param kwargs: session of the default graph, it is not needed by an isolated model
+        """
+        if self._isolated:
+            self.close()
+            self._graph = tf.Graph()
+            self._session = tf.compat.v1.Session(graph=self._graph, config=self._session_config)
+            with self._graph.as_default():
+                self._load(self._session)
+        else:
+            self._load(kwargs.get("session"))
 
+    def _load(self, session: Union[tf.compat.v1.Session, None]) -> None:
+        """
+        load the model into the default graph
+        """
         if self._type == "tf":
             self.__tf_inference(self._model_path)
 
         else:
-            _sess = kwargs.get("session")
-            if _sess is None:
+            if session is None:
                 raise SessionIsNotSetError("you should set session on load_model")
-            self.__keras_inference(_sess, self._model_path)
+            self.__keras_inference(session, self._model_path)
+
+
+def run_fused(session: tf.compat.v1.Session, parts: List[Tuple[BaseModel, np.ndarray]]) -> List[np.ndarray]:
+    """
+    run several models of one session graph by a single session.run, every batch is padded to the
+    bucket of its model and the padded rows are stripped from the outputs
+    :param session: session of the graph which holds every model
+    :param parts: (model, preprocessed batch) pairs
+    :return: raw output of each model in the order of parts
+    """
+    if any(model.session is not None and model.session is not session for model, _ in parts):
+        raise ValueError("run_fused needs models of one graph, isolated models have their own sessions")
+
+    feed, fetches, sizes = {}, [], []
+    for model, batch in parts:
+        n = batch.shape[0]
+        bucket = model.bucket_size(n)
+        if bucket > n:
+            batch = np.concatenate([batch, np.zeros((bucket - n,) + batch.shape[1:], dtype=batch.dtype)], axis=0)
+        feed.update(model.feed_dict(batch))
+        fetches.append(model.fetch)
+        sizes.append(n)
+
+    outputs = session.run(fetches, feed_dict=feed)
+    return [out[:n] for out, n in zip(outputs, sizes)]
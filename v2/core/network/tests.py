@@ -1,16 +1,22 @@
 from unittest import TestCase
 from pathlib import Path
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 import numpy as np
 import tensorflow as tf
 import cv2
 
 # from models
-from .base import BaseModel
+from .base import BaseModel, run_fused
 from ._face_detector import FaceDetector
 from ._recognizer import FaceNetModel
 from ._hpe import HeadPoseEstimatorModel
 from ._mask import MaskClassifierModel
+from ._lite import LiteFaceNetModel, convert_to_lite
+from ._inference import KerasInference, INFERENCE_MODES
+from .mtcnn import detect_face
 from v2.core.nomalizer import GrayScaleConvertor
 
 # exceptions
@@ -130,6 +136,140 @@ class FaceDetectorTestCase(TestCase):
             _, _ = face_detector.extract(im)
 
 
+    def test_warmup_pyramid_shapes(self):
+        face_detector = FaceDetector(min_face=20, scale_factor=0.709, stages_threshold=[0.8, 0.8, 0.9],
+                                     batch_buckets=[1, 2])
+        seen = []
+        face_detector._p_net_fn = lambda b: seen.append(("pnet", b.shape))
+        face_detector._r_net_fn = lambda b: seen.append(("rnet", b.shape))
+        face_detector._o_net_fn = lambda b: seen.append(("onet", b.shape))
+        face_detector.warmup(frame_shapes=[(120, 160)])
+
+        pnet = [shape for stage, shape in seen if stage == "pnet"]
+        self.assertEqual(pnet[0], (1, 96, 72, 3))
+        self.assertEqual(len(pnet), len(detect_face.pyramid_scales(120, 160, 20, 0.709)))
+        self.assertEqual([shape for stage, shape in seen if stage != "pnet"],
+                         [(1, 24, 24, 3), (2, 24, 24, 3), (1, 48, 48, 3), (2, 48, 48, 3)])
+
+    def test_load_face_detector_from_frozen_graph(self):
+        outputs = ["pnet/conv4-2/BiasAdd", "pnet/prob1", "rnet/conv5-2/conv5-2", "rnet/prob1",
+                   "onet/conv6-2/conv6-2", "onet/conv6-3/conv6-3", "onet/prob1"]
+        with tf.Graph().as_default() as graph:
+            with tf.compat.v1.Session() as sess:
+                reference = FaceDetector(min_face=20, scale_factor=0.8, stages_threshold=[0.8, 0.8, 0.9])
+                reference.load_model(session=sess)
+                graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(),
+                                                                                   outputs)
+                batch = np.random.RandomState(0).rand(3, 24, 24, 3).astype(np.float32)
+                expected = reference._r_net_fn(batch)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            graph_path = Path(tmp).joinpath("mtcnn.pb")
+            graph_path.write_bytes(graph_def.SerializeToString())
+            with tf.Graph().as_default():
+                with tf.compat.v1.Session() as sess:
+                    face_detector = FaceDetector(min_face=20, scale_factor=0.8, stages_threshold=[0.8, 0.8, 0.9],
+                                                 graph_path=str(graph_path))
+                    face_detector.load_model(session=sess)
+                    self.assertFalse(tf.compat.v1.global_variables())
+                    for out, exp in zip(face_detector._r_net_fn(batch), expected):
+                        np.testing.assert_allclose(out, exp, atol=1e-5)
+
+    def test_pyramid_canvas(self):
+        scales = detect_face.pyramid_scales(480, 640, 30, 0.8)
+        (ch, cw), regions = detect_face.pyramid_canvas(480, 640, scales)
+        canvas = np.zeros((ch, cw), dtype=np.int32)
+        for y, x, hs, ws in regions:
+            self.assertEqual((y % 2, x % 2), (0, 0))
+            canvas[y:y + hs, x:x + ws] += 1
+        self.assertEqual(canvas.max(), 1)
+        self.assertLess(ch * cw, sum(hs * ws for _, _, hs, ws in regions) * 1.5)
+
+    def test_packed_pnet_matches_per_scale(self):
+        im = cv2.resize(np.random.RandomState(0).randint(0, 255, (30, 40, 3)).astype(np.uint8), (160, 120))
+        with tf.Graph().as_default():
+            with tf.compat.v1.Session() as sess:
+                calls = []
+                pnet, _, _ = detect_face.create_mtcnn(sess)
+                counted = lambda img: calls.append(img.shape) or pnet(img)
+                scales = detect_face.pyramid_scales(120, 160, 20, 0.709)
+                per_scale = list(detect_face.pnet_scales(im, scales, counted))
+                packed = list(detect_face.pnet_packed(im, scales, counted))
+
+        self.assertEqual(len(calls), len(scales) + 1)
+        for scale, (reg, prob), (p_reg, p_prob) in zip(scales, per_scale, packed):
+            self.assertEqual(prob.shape, p_prob.shape)
+            # the pool reads the canvas after the last pixel of an odd side, the other cells are the same
+            np.testing.assert_allclose(p_prob[:-1, :-1], prob[:-1, :-1], atol=1e-5)
+            np.testing.assert_allclose(p_reg[:-1, :-1], reg[:-1, :-1], atol=1e-5)
+            if int(np.ceil(120 * scale)) % 2 == 0 and int(np.ceil(160 * scale)) % 2 == 0:
+                np.testing.assert_allclose(p_prob, prob, atol=1e-5)
+
+    def test_crop_boxes_matches_loop(self):
+        rs = np.random.RandomState(0)
+        im = rs.randint(0, 255, (120, 160, 3)).astype(np.uint8)
+        size = rs.randint(12, 80, 50)
+        x1, y1 = rs.randint(-size // 2, 160 - size // 2), rs.randint(-size // 2, 120 - size // 2)
+        boxes = np.stack([x1, y1, x1 + size, y1 + size, rs.rand(50)], axis=1).astype(np.float64)
+        for side in [24, 48]:
+            expected = detect_face.crop_boxes_loop(im, boxes, 160, 120, side)
+            crops = detect_face.crop_boxes(im, boxes, 160, 120, side)
+            self.assertEqual(crops.dtype, np.float32)
+            np.testing.assert_allclose(crops, expected, atol=1e-5)
+        # boxes which leave the frame on one side only
+        boxes = np.array([[140., 10., 180., 50., 1.], [20., 100., 50., 130., 1.]])
+        np.testing.assert_allclose(detect_face.crop_boxes(im, boxes, 160, 120, 24),
+                                   detect_face.crop_boxes_loop(im, boxes, 160, 120, 24), atol=1e-5)
+
+    def test_extract_batch_matches_extract(self):
+        rs = np.random.RandomState(1)
+        ims = [cv2.resize(rs.randint(0, 255, (30 + i, 40, 3)).astype(np.uint8), (160 + 40 * i, 120 + 20 * i))
+               for i in range(3)]
+        with tf.Graph().as_default():
+            with tf.compat.v1.Session() as sess:
+                face_detector = FaceDetector(min_face=20, scale_factor=0.709, stages_threshold=[0.5, 0.5, 0.3])
+                face_detector.load_model(session=sess)
+                calls = []
+                r_net_fn = face_detector._r_net_fn
+                expected = [face_detector.extract(im) for im in ims]
+                face_detector._r_net_fn = lambda b: calls.append(b.shape[0]) or r_net_fn(b)
+                detections = face_detector.extract_batch(ims)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(face_detector.extract_batch([]), [])
+        for (boxes, points), (e_boxes, e_points) in zip(detections, expected):
+            np.testing.assert_allclose(boxes, e_boxes)
+            np.testing.assert_allclose(points, e_points)
+
+    def test_extract_rois_matches_extract(self):
+        rs = np.random.RandomState(1)
+        im = cv2.resize(rs.randint(0, 255, (32, 40, 3)).astype(np.uint8), (240, 160))
+        with tf.Graph().as_default():
+            with tf.compat.v1.Session() as sess:
+                face_detector = FaceDetector(min_face=20, scale_factor=0.709, stages_threshold=[0.5, 0.5, 0.3])
+                face_detector.load_model(session=sess)
+                e_boxes, e_points = face_detector.extract(im)
+                boxes, points = face_detector.extract_rois(im, np.array([[0, 0, 240, 160]]))
+                empty, _ = face_detector.extract_rois(im, np.empty((0, 4)))
+
+        self.assertEqual(empty.shape[0], 0)
+        self.assertEqual(boxes.shape[0], e_boxes.shape[0])
+        if e_boxes.shape[0] > 0:
+            np.testing.assert_allclose(boxes, e_boxes)
+            np.testing.assert_allclose(points, e_points)
+
+    def test_warmup_packed_pyramid(self):
+        face_detector = FaceDetector(min_face=20, scale_factor=0.709, stages_threshold=[0.8, 0.8, 0.9],
+                                     batch_buckets=[1], packed_pyramid=True)
+        seen = []
+        face_detector._p_net_fn = lambda b: seen.append(b.shape)
+        face_detector._r_net_fn = face_detector._o_net_fn = lambda b: None
+        face_detector.warmup(frame_shapes=[(120, 160)])
+
+        (ch, cw), _ = detect_face.pyramid_canvas(120, 160, detect_face.pyramid_scales(120, 160, 20, 0.709))
+        self.assertEqual(seen, [(1, cw, ch, 3)])
+
+
 class FaceNetModelTestCase(TestCase):
     def setUp(self) -> None:
         self._model_path = Path(BASE_DIR).joinpath(MODEL_CONF.get("facenet"))
@@ -283,3 +423,187 @@ class MaskClassifierTestCase(TestCase):
             self.assertEqual(ans.shape, (0, 1))
             masks, masks_c = model.validate_mask(ans)
             self.assertTrue((len(masks) == 0 and len(masks_c) == 0))
+
+
+class BatchBucketTestCase(TestCase):
+    def setUp(self) -> None:
+        self.model = BaseModel(None, batch_buckets=[4, 1, 2])
+        self.seen = []
+
+    def _fn(self, batch):
+        self.seen.append(batch.shape[0])
+        return batch.sum(axis=1), batch[:, :1] * 2
+
+    def test_bucket_size(self):
+        self.assertEqual(self.model.batch_buckets, (1, 2, 4))
+        self.assertEqual([self.model.bucket_size(n) for n in [1, 2, 3, 4, 5, 9]], [1, 2, 4, 4, 8, 12])
+
+    def test_run_bucketed_strips_padding(self):
+        batch = np.arange(15, dtype=np.float32).reshape((5, 3))
+        out_sum, out_first = self.model._run_bucketed(self._fn, batch)
+        self.assertEqual(self.seen, [8])
+        np.testing.assert_allclose(out_sum, batch.sum(axis=1))
+        np.testing.assert_allclose(out_first, batch[:, :1] * 2)
+
+    def test_warmup_buckets(self):
+        self.model._warmup_buckets(self._fn, (3,))
+        self.assertEqual(self.seen, [1, 2, 4])
+
+    def test_warmup_buckets_timing(self):
+        calls = []
+        self.model._warmup_buckets(self._fn, (3,), on_call=lambda *call: calls.append(call))
+        self.assertEqual([(name, shape) for name, shape, _ in calls],
+                         [("BaseModel", (1, 3)), ("BaseModel", (2, 3)), ("BaseModel", (4, 3))])
+
+    def test_invalid_buckets(self):
+        with self.assertRaises(ValueError):
+            _ = BaseModel(None, batch_buckets=[0])
+
+
+class RunFusedTestCase(TestCase):
+    class _Model(BaseModel):
+        def __init__(self, plc, out, *args, **kwargs):
+            super(RunFusedTestCase._Model, self).__init__(None, *args, **kwargs)
+            self._plc, self._out = plc, out
+
+        @property
+        def fetch(self):
+            return self._out
+
+        def feed_dict(self, batch):
+            return {self._plc: batch}
+
+    def test_run_fused_single_call(self):
+        with tf.Graph().as_default():
+            plc_a = tf.compat.v1.placeholder(tf.float32, (None, 3))
+            plc_b = tf.compat.v1.placeholder(tf.float32, (None, 2))
+            model_a = self._Model(plc_a, tf.reduce_sum(plc_a, axis=1))
+            model_b = self._Model(plc_b, plc_b * 2., batch_buckets=[4])
+            with tf.compat.v1.Session() as sess:
+                calls = []
+                run = sess.run
+                sess.run = lambda *a, **kw: calls.append(kw["feed_dict"][plc_b].shape) or run(*a, **kw)
+
+                batch_a, batch_b = np.ones((3, 3), dtype=np.float32), np.ones((3, 2), dtype=np.float32)
+                out_a, out_b = run_fused(sess, [(model_a, batch_a), (model_b, batch_b)])
+
+        self.assertEqual(calls, [(4, 2)])
+        np.testing.assert_allclose(out_a, [3., 3., 3.])
+        np.testing.assert_allclose(out_b, np.full((3, 2), 2.))
+
+
+class LiteFaceNetModelTestCase(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        keras_path = Path(self.tmp.name).joinpath("tiny.h5")
+        model = tf.keras.Sequential([tf.keras.layers.Input((160, 160, 3)),
+                                     tf.keras.layers.GlobalAveragePooling2D(),
+                                     tf.keras.layers.Dense(8)])
+        model.save(str(keras_path))
+        self.keras_path = keras_path
+        self.reference = model
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_convert_and_embed(self):
+        batch = np.random.RandomState(0).normal(size=(3, 160, 160, 3)).astype(np.float32)
+        expected = self.reference.predict(batch)
+        for precision in ["float16", "int8"]:
+            path = convert_to_lite(self.keras_path, Path(self.tmp.name).joinpath(f"tiny_{precision}.tflite"),
+                                   precision)
+            model = LiteFaceNetModel(path, batch_buckets=[1, 4])
+            model.load_model()
+            self.assertEqual(model.embedding_size, 8)
+            np.testing.assert_allclose(model.embed(batch), expected, atol=0.1)
+            self.assertEqual(sorted(model._interpreters.keys()), [1, 4])
+
+    def test_unknown_precision(self):
+        with self.assertRaises(ValueError):
+            convert_to_lite(self.keras_path, Path(self.tmp.name).joinpath("tiny.tflite"), "int4")
+
+
+class IsolatedModelTestCase(TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.model_path = Path(self.tmp.name).joinpath("hpe.pb")
+        with tf.Graph().as_default() as graph:
+            x = tf.compat.v1.placeholder(tf.float32, (None, 64, 64, 1), "x")
+            tf.identity(tf.concat([tf.reduce_mean(x, axis=[1, 2]), tf.reduce_max(x, axis=[1, 2])], axis=1),
+                        name="Identity")
+            self.model_path.write_bytes(graph.as_graph_def().SerializeToString())
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def _hpe(self, **kwargs):
+        return HeadPoseEstimatorModel(self.model_path, img_norm=(0., 1.), tilt_norm=(0., 1.), pan_norm=(0., 1.),
+                                      rescale=1., conf=(0., 0., 0., 0.), batch_buckets=[4], **kwargs)
+
+    def test_own_graph_and_session(self):
+        config = BaseModel.session_config(intra_op_threads=1, inter_op_threads=1)
+        self.assertTrue(config.use_per_session_threads)
+        models = [self._hpe(isolated=True, session_config=config) for _ in range(2)]
+        with tf.Graph().as_default() as default:
+            for model in models:
+                model.load_model()
+            self.assertFalse(default.get_operations())
+        self.assertIsNot(models[0].session, models[1].session)
+        self.assertIs(models[0].fetch.graph, models[0].graph)
+
+        batch = np.ones((3, 64, 64, 1), dtype=np.float32)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            outputs = list(pool.map(lambda m: m._run_bucketed(lambda b: m._run(None, b), batch), models))
+        for out in outputs:
+            np.testing.assert_allclose(out, np.ones((3, 2)))
+
+        with tf.compat.v1.Session(graph=models[0].graph) as other:
+            with self.assertRaises(ValueError):
+                run_fused(other, [(models[0], batch)])
+
+        for model in models:
+            model.close()
+            self.assertIsNone(model.session)
+
+    def test_shared_graph_needs_session(self):
+        model = self._hpe()
+        with tf.Graph().as_default():
+            model.load_model()
+            self.assertIsNone(model.session)
+            with self.assertRaises(SessionIsNotSetError):
+                model.warmup()
+
+
+class KerasInferenceTestCase(TestCase):
+    def setUp(self) -> None:
+        self.model = tf.keras.Sequential([tf.keras.layers.Input((64, 64, 3)),
+                                          tf.keras.layers.Conv2D(4, 3),
+                                          tf.keras.layers.BatchNormalization(),
+                                          tf.keras.layers.GlobalAveragePooling2D(),
+                                          tf.keras.layers.Dense(1, activation="sigmoid")])
+        self.batch = np.random.RandomState(0).uniform(-1., 1., (5, 64, 64, 3)).astype(np.float32)
+
+    def test_same_outputs_as_predict(self):
+        expected = self.model.predict(self.batch, verbose=0)
+        for mode in INFERENCE_MODES:
+            np.testing.assert_allclose(KerasInference(self.model, mode)(self.batch), expected, atol=1e-5)
+
+    def test_traced_once(self):
+        infer = KerasInference(self.model, "traced")
+        for size in [1, 3, 16]:
+            self.assertEqual(infer(self.batch[:1].repeat(size, axis=0)).shape, (size, 1))
+        self.assertEqual(infer._fn.experimental_get_tracing_count(), 1)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            _ = KerasInference(self.model, "compiled")
+
+    def test_graph_mode_runs_session(self):
+        batch = self.batch[:2]
+        with tf.Graph().as_default():
+            x = tf.compat.v1.placeholder(tf.float32, [None, 64, 64, 3])
+            model = SimpleNamespace(inputs=[x], outputs=[tf.reduce_mean(x, axis=[1, 2, 3])[:, None]])
+            with tf.compat.v1.Session() as sess:
+                infer = KerasInference(model, "traced", session=sess)
+                self.assertEqual(infer.mode, "session")
+                np.testing.assert_allclose(infer(batch), batch.mean(axis=(1, 2, 3)).reshape((-1, 1)), atol=1e-6)
@@ -2,7 +2,7 @@ import time
 
 import numpy as np
 from uuid import uuid1
-from typing import Tuple
+from typing import Dict, List, Tuple
 from collections import deque
 from threading import Thread
 from pathlib import Path
@@ -115,6 +115,13 @@ class BaseSource:
     def source_type(self) -> str:
         return self._src_type
 
+    @property
+    def output_size(self) -> Tuple[int, int]:
+        """
+        (width, height) of the converted frames
+        """
+        return self._output_size
+
     def stream(self):
         self._last_modified_time = self.__modify_date_time()
         if not self._online:
@@ -134,9 +141,22 @@ class BaseSource:
 class SourcePool:
     def __init__(self, src_list):
         self._p_queue = []
+        # a frame of a source which was popped twice in one next_streams call, newest one per source
+        self._pending: Dict[str, Tuple] = {}
         for s in src_list:
             heappush(self._p_queue, (s.last_modified_time, s))
 
+    @property
+    def source_ids(self):
+        return [s.get_id for _, s in self._p_queue]
+
+    @property
+    def frame_shapes(self) -> List[Tuple[int, int]]:
+        """
+        distinct (height, width) of the converted frames of the sources
+        """
+        return sorted({(s.output_size[1], s.output_size[0]) for _, s in self._p_queue})
+
     def next_stream(self):
         """
         :return: origin_matrix, matrix, id, timestamp
@@ -161,3 +181,26 @@ class SourcePool:
                 return None, None, None, None
             else:
                 return origin_frame, frame, cap.get_id, timestamp
+
+    def next_streams(self, max_streams: int) -> List[Tuple]:
+        """
+        the next stream of up to max_streams sources, each source gives at most one frame, a frame of a
+        source which is already in the batch is kept for the next call
+        :param max_streams: maximum number of frames
+        :return: list of (origin_matrix, matrix, id, timestamp), sources without a frame are skipped
+        """
+        streams, seen = [], set()
+        for source_id in list(self._pending)[:max_streams]:
+            streams.append(self._pending.pop(source_id))
+            seen.add(source_id)
+
+        for _ in range(min(max_streams - len(streams), len(self._p_queue))):
+            origin_frame, frame, source_id, timestamp = self.next_stream()
+            if frame is None:
+                continue
+            if source_id in seen:
+                self._pending[source_id] = (origin_frame, frame, source_id, timestamp)
+                continue
+            seen.add(source_id)
+            streams.append((origin_frame, frame, source_id, timestamp))
+        return streams
@@ -1,6 +1,7 @@
 from unittest import TestCase
 import numpy as np
 from v2.core.source._image import SourceImage
+from v2.core.source._base import SourcePool
 from .serializer._field import BaseField
 
 # exception
@@ -33,3 +34,16 @@ class BaseFieldTestCase(TestCase):
         with self.assertRaises(NotImplementedError):
             field("")
 
+
+class SourcePoolTestCase(TestCase):
+    def test_next_streams_keeps_repeated_source(self):
+        pool = SourcePool([])
+        pool._p_queue = [None, None]
+        frame = np.zeros((2, 2))
+        script = iter([(frame, frame, "a", 1), (frame, frame, "a", 2), (frame, frame, "b", 3)])
+        pool.next_stream = lambda: next(script)
+
+        streams = pool.next_streams(2)
+        self.assertEqual([s[2:] for s in streams], [("a", 1)])
+        streams = pool.next_streams(2)
+        self.assertEqual([s[2:] for s in streams], [("a", 2), ("b", 3)])
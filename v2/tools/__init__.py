@@ -1,3 +1,6 @@
 from ._draw import draw_face
+from ._device import inference_device
+from ._threads import ThreadBudget, parse_cpu_groups
+from ._nms import non_max_suppression, non_max_suppression_loop, NMS_UNION, NMS_MIN
 
 draw_cure_face = draw_face
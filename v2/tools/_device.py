@@ -0,0 +1,23 @@
+import tensorflow as tf
+
+DEVICE_GPU = "gpu"
+DEVICE_CPU = "cpu"
+
+
+def inference_device(prefer: str = DEVICE_GPU) -> str:
+    """
+    pick the device of the inference graphs, memory growth is enabled on every visible gpu
+    :param prefer: gpu or cpu, gpu falls back to cpu on a box without gpu
+    :return: tensorflow device name
+    """
+    gpus = tf.config.list_physical_devices('GPU')
+    for gpu in gpus:
+        try:
+            tf.config.experimental.set_memory_growth(gpu, True)
+        except RuntimeError:
+            # the device is already initialized
+            pass
+
+    if prefer != DEVICE_CPU and gpus:
+        return '/device:gpu:0'
+    return '/device:cpu:0'
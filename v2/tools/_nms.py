@@ -0,0 +1,109 @@
+from typing import Union
+
+import numpy as np
+
+NMS_UNION = "Union"
+NMS_MIN = "Min"
+
+
+def _overlap(a, b, method, offset):
+    # overlap of every box of a with every box of b, both in shape (5,n) as x1, y1, x2, y2, area
+    w = np.minimum(a[2, :, None], b[2, None, :])
+    w -= np.maximum(a[0, :, None], b[0, None, :])
+    w += offset
+    np.maximum(w, 0.0, out=w)
+    h = np.minimum(a[3, :, None], b[3, None, :])
+    h -= np.maximum(a[1, :, None], b[1, None, :])
+    h += offset
+    np.maximum(h, 0.0, out=h)
+    w *= h
+    if method == NMS_MIN:
+        return w / np.minimum(a[4, :, None], b[4, None, :])
+    return w / (a[4, :, None] + b[4, None, :] - w)
+
+
+def non_max_suppression(boxes: np.ndarray, scores: np.ndarray, threshold: float, method: str = NMS_UNION,
+                        offset: float = 1., eps: float = 0., top_k: int = -1,
+                        max_candidates: Union[int, None] = None, block_size: int = 32) -> np.ndarray:
+    """
+    greedy nms on blocks of the boxes sorted by score, the kept boxes of a block are found with one
+    overlap matrix of the block and then drop the rest of the boxes with one more, so the python loop
+    only visits kept boxes and the suppressed ones are never compared again
+    :param boxes: boxes in shape (n,4+) as (x_min, y_min, x_max, y_max)
+    :param scores: scores in shape (n,)
+    :param threshold: a box whose overlap with a kept box is above threshold is dropped
+    :param method: Union for intersection over union, Min for intersection over the smaller area
+    :param offset: added to the sides, 1 for pixel inclusive boxes
+    :param eps: added to the sides of the areas only
+    :param top_k: stop after top_k boxes, -1 keeps every box
+    :param max_candidates: only the max_candidates best scores take part, None for all of them
+    :param block_size: boxes of one block
+    :return: indices of the kept boxes from the best score down
+    """
+    if method not in [NMS_UNION, NMS_MIN]:
+        raise ValueError(f"nms method {method} is unknown")
+
+    # the order of argsort is kept for ties, it is the order of non_max_suppression_loop
+    order = np.argsort(scores)[::-1]
+    if max_candidates is not None and max_candidates > 0:
+        order = order[:max_candidates]
+    if order.size == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # coordinates and areas of the boxes not suppressed yet, in the order of the scores
+    rest = np.empty((5, order.size))
+    rest[:4] = boxes[order, :4].T
+    rest[4] = (rest[2] - rest[0] + offset + eps) * (rest[3] - rest[1] + offset + eps)
+
+    keep = []
+    while order.size > 0:
+        block, rest = rest[:, :block_size], rest[:, block_size:]
+        overlap = _overlap(block, block, method, offset) <= threshold
+        alive = np.ones(block.shape[1], dtype=bool)
+        kept = []
+        for i in range(block.shape[1]):
+            if not alive[i]:
+                continue
+            kept.append(i)
+            if len(keep) + len(kept) == top_k:
+                break
+            alive[i + 1:] &= overlap[i, i + 1:]
+
+        keep.extend(order[kept])
+        if len(keep) == top_k:
+            break
+        order = order[block_size:]
+        if order.size > 0:
+            # the columns are cut so the overlap matrices stay in the cache
+            mask = np.concatenate([np.all(_overlap(block[:, kept], rest[:, c:c + 2048], method, offset) <= threshold,
+                                          axis=0) for c in range(0, order.size, 2048)])
+            order, rest = order[mask], rest[:, mask]
+
+    return np.array(keep, dtype=np.int64)
+
+
+def non_max_suppression_loop(boxes: np.ndarray, scores: np.ndarray, threshold: float, method: str = NMS_UNION,
+                             offset: float = 1., eps: float = 0., top_k: int = -1) -> np.ndarray:
+    """
+    argsort and filter nms which drops the suppressed boxes one kept box at a time, the reference of
+    non_max_suppression
+    """
+    x1, y1, x2, y2 = [boxes[:, i] for i in range(4)]
+    area = (x2 - x1 + offset + eps) * (y2 - y1 + offset + eps)
+    idxs = np.argsort(scores)
+    pick = []
+    while idxs.size > 0:
+        i = idxs[-1]
+        pick.append(i)
+        if len(pick) == top_k:
+            break
+        idx = idxs[:-1]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[idx]) - np.maximum(x1[i], x1[idx]) + offset)
+        h = np.maximum(0.0, np.minimum(y2[i], y2[idx]) - np.maximum(y1[i], y1[idx]) + offset)
+        inter = w * h
+        if method == NMS_MIN:
+            o = inter / np.minimum(area[i], area[idx])
+        else:
+            o = inter / (area[i] + area[idx] - inter)
+        idxs = idx[np.where(o <= threshold)]
+    return np.array(pick, dtype=np.int64)
@@ -0,0 +1,142 @@
+import os
+from typing import List, Sequence, Union
+
+import cv2
+import tensorflow as tf
+from threadpoolctl import threadpool_limits
+
+# environment variables of the BLAS builds numpy may be linked to, they only matter for new processes
+BLAS_ENV = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+
+def parse_cpu_groups(spec: str) -> List[List[int]]:
+    """
+    :param spec: cpu groups separated by ';', each one a list of cpus and ranges like 0-3,8
+    :return: list of cpu lists, empty for an empty spec
+    """
+    groups = []
+    for group in filter(None, (g.strip() for g in spec.split(";"))):
+        cpus = []
+        for part in filter(None, (p.strip() for p in group.split(","))):
+            first, _, last = part.partition("-")
+            cpus.extend(range(int(first), int(last or first) + 1))
+        groups.append(sorted(set(cpus)))
+    return groups
+
+
+class ThreadBudget:
+    """
+    one thread budget for the thread pools of a worker process, tensorflow sessions, opencv and the
+    numpy BLAS, so cameras on the same box do not oversubscribe the cores
+    """
+
+    def __init__(self, tf_intra_op: int = 0, tf_inter_op: int = 0, opencv: int = -1, blas: int = 0,
+                 affinity: Union[Sequence[Sequence[int]], None] = None, name=None):
+        """
+        :param tf_intra_op: threads inside one tensorflow op, 0 lets tensorflow decide
+        :param tf_inter_op: tensorflow ops which run at the same time, 0 lets tensorflow decide
+        :param opencv: threads of opencv, 0 disables its pool, -1 keeps the opencv default
+        :param blas: threads of the BLAS, 0 keeps the default
+        :param affinity: cpu groups, worker i is pinned to group i modulo the number of groups
+        """
+        if min(tf_intra_op, tf_inter_op, blas) < 0 or opencv < -1:
+            raise ValueError("thread counts should not be negative")
+        self._name = self.__class__.__name__ if name is None else name
+        self._tf_intra_op = tf_intra_op
+        self._tf_inter_op = tf_inter_op
+        self._opencv = opencv
+        self._blas = blas
+        self._affinity = [list(g) for g in affinity] if affinity else []
+        self._blas_limits = None
+
+    @classmethod
+    def from_config(cls, conf) -> "ThreadBudget":
+        """
+        :param conf: Threads section of the configuration
+        :return: ThreadBudget
+        """
+        return cls(tf_intra_op=int(conf.get("tf_intra_op")),
+                   tf_inter_op=int(conf.get("tf_inter_op")),
+                   opencv=int(conf.get("opencv")),
+                   blas=int(conf.get("blas")),
+                   affinity=parse_cpu_groups(conf.get("affinity")),
+                   name="threads")
+
+    @property
+    def tf_intra_op(self) -> int:
+        return self._tf_intra_op
+
+    @property
+    def tf_inter_op(self) -> int:
+        return self._tf_inter_op
+
+    @property
+    def opencv(self) -> int:
+        return self._opencv
+
+    @property
+    def blas(self) -> int:
+        return self._blas
+
+    def cpus(self, worker: int = 0) -> List[int]:
+        """
+        :param worker: index of the worker process
+        :return: cpus of the worker, empty when it is not pinned
+        """
+        return self._affinity[worker % len(self._affinity)] if self._affinity else []
+
+    def session_config(self, sessions: int = 1) -> tf.compat.v1.ConfigProto:
+        """
+        :param sessions: sessions which run at the same time, the thread counts are split between them
+        :return: ConfigProto whose thread pools belong to the session when a thread count is set
+        """
+        if sessions < 1:
+            raise ValueError("sessions should be positive")
+        intra_op = max(self._tf_intra_op // sessions, 1) if self._tf_intra_op > 0 else 0
+        inter_op = max(self._tf_inter_op // sessions, 1) if self._tf_inter_op > 0 else 0
+        config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=intra_op,
+                                          inter_op_parallelism_threads=inter_op,
+                                          use_per_session_threads=self._tf_intra_op > 0 or self._tf_inter_op > 0)
+        config.gpu_options.allow_growth = True
+        return config
+
+    def apply(self, worker: int = 0) -> "ThreadBudget":
+        """
+        apply the budget to the calling process, call it before the first session is created
+        :param worker: index of the worker process for the cpu affinity
+        :return: self
+        """
+        cpus = self.cpus(worker)
+        if cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+
+        if self._opencv >= 0:
+            cv2.setNumThreads(self._opencv)
+
+        if self._blas > 0:
+            for env in BLAS_ENV:
+                os.environ[env] = str(self._blas)
+            if self._blas_limits is not None:
+                self._blas_limits.restore_original_limits()
+            self._blas_limits = threadpool_limits(limits=self._blas, user_api="blas")
+
+        try:
+            if self._tf_intra_op > 0:
+                tf.config.threading.set_intra_op_parallelism_threads(self._tf_intra_op)
+            if self._tf_inter_op > 0:
+                tf.config.threading.set_inter_op_parallelism_threads(self._tf_inter_op)
+        except RuntimeError:
+            # the runtime is already initialized, session_config still applies to new sessions
+            pass
+        return self
+
+    def as_dict(self) -> dict:
+        return {"tf_intra_op": self._tf_intra_op,
+                "tf_inter_op": self._tf_inter_op,
+                "opencv": self._opencv,
+                "blas": self._blas,
+                "affinity": self._affinity}
+
+    def __repr__(self):
+        return f"ThreadBudget: intra {self._tf_intra_op} inter {self._tf_inter_op} opencv {self._opencv} " \
+               f"blas {self._blas} affinity {self._affinity}"
@@ -1,6 +1,14 @@
+import os
 import time
 from unittest import TestCase
+
+import cv2
+import numpy as np
+
 from ._measurement import Counter, FPS
+from ._device import inference_device
+from ._threads import ThreadBudget, parse_cpu_groups
+from ._nms import non_max_suppression, non_max_suppression_loop, NMS_UNION, NMS_MIN
 
 
 class CounterTestCase(TestCase):
@@ -43,3 +51,86 @@ class FpsTestCase(TestCase):
         fps.update()
         fps.stop()
         self.assertEqual(fps.fps(), 0.)
+
+
+class InferenceDeviceTestCase(TestCase):
+    def test_prefer_cpu(self):
+        self.assertEqual(inference_device("cpu"), '/device:cpu:0')
+
+    def test_prefer_gpu_falls_back(self):
+        device = inference_device("gpu")
+        self.assertIn(device, ['/device:gpu:0', '/device:cpu:0'])
+
+
+class ThreadBudgetTestCase(TestCase):
+    def test_parse_cpu_groups(self):
+        self.assertEqual(parse_cpu_groups("0-3,8; 4-5"), [[0, 1, 2, 3, 8], [4, 5]])
+        self.assertEqual(parse_cpu_groups(""), [])
+
+    def test_worker_cpus(self):
+        budget = ThreadBudget(affinity=[[0, 1], [2, 3]])
+        self.assertEqual(budget.cpus(0), [0, 1])
+        self.assertEqual(budget.cpus(3), [2, 3])
+        self.assertEqual(ThreadBudget().cpus(1), [])
+
+    def test_session_config(self):
+        config = ThreadBudget(tf_intra_op=2, tf_inter_op=1).session_config()
+        self.assertEqual(config.intra_op_parallelism_threads, 2)
+        self.assertEqual(config.inter_op_parallelism_threads, 1)
+        self.assertTrue(config.use_per_session_threads)
+        self.assertFalse(ThreadBudget().session_config().use_per_session_threads)
+
+    def test_session_config_split(self):
+        config = ThreadBudget(tf_intra_op=8, tf_inter_op=2).session_config(sessions=4)
+        self.assertEqual(config.intra_op_parallelism_threads, 2)
+        self.assertEqual(config.inter_op_parallelism_threads, 1)
+        self.assertEqual(ThreadBudget().session_config(sessions=4).intra_op_parallelism_threads, 0)
+        with self.assertRaises(ValueError):
+            ThreadBudget().session_config(sessions=0)
+
+    def test_negative_threads(self):
+        with self.assertRaises(ValueError):
+            ThreadBudget(tf_intra_op=-1)
+
+    def test_apply_blas(self):
+        budget = ThreadBudget(opencv=1, blas=1).apply()
+        self.assertEqual(os.environ["OMP_NUM_THREADS"], "1")
+        self.assertEqual(cv2.getNumThreads(), 1)
+        self.assertEqual(budget.blas, 1)
+
+
+class NonMaxSuppressionTestCase(TestCase):
+    @staticmethod
+    def _boxes(n, seed=0):
+        rng = np.random.RandomState(seed)
+        centers = rng.uniform(0., 200., (n, 2))
+        sides = rng.uniform(10., 40., (n, 1))
+        return np.hstack([np.fix(centers), np.fix(centers + sides), rng.uniform(0.5, 1., (n, 1))])
+
+    def test_matches_loop(self):
+        boxes = self._boxes(500)
+        for method in [NMS_UNION, NMS_MIN]:
+            for threshold in [0.3, 0.7]:
+                expected = non_max_suppression_loop(boxes, boxes[:, 4], threshold, method)
+                np.testing.assert_array_equal(non_max_suppression(boxes, boxes[:, 4], threshold, method,
+                                                                  block_size=16), expected)
+        expected = non_max_suppression_loop(boxes, boxes[:, 4], 0.5, offset=0., eps=1e-3)
+        np.testing.assert_array_equal(non_max_suppression(boxes, boxes[:, 4], 0.5, offset=0., eps=1e-3), expected)
+
+    def test_top_k_and_max_candidates(self):
+        boxes = self._boxes(300)
+        expected = non_max_suppression_loop(boxes, boxes[:, 4], 0.5)
+        np.testing.assert_array_equal(non_max_suppression(boxes, boxes[:, 4], 0.5, top_k=5), expected[:5])
+
+        best = np.argsort(boxes[:, 4])[::-1][:50]
+        capped = non_max_suppression(boxes, boxes[:, 4], 0.5, max_candidates=50)
+        np.testing.assert_array_equal(capped, best[non_max_suppression_loop(boxes[best], boxes[best, 4], 0.5)])
+        self.assertEqual(non_max_suppression(boxes[:0], boxes[:0, 4], 0.5).size, 0)
+        with self.assertRaises(ValueError):
+            non_max_suppression(boxes, boxes[:, 4], 0.5, method="Max")
+
+    def test_large_index(self):
+        # an int16 index would wrap around above 32767
+        boxes = np.tile([10., 10., 50., 50., 0.5], (33000, 1))
+        boxes[-1, 4] = 0.9
+        np.testing.assert_array_equal(non_max_suppression(boxes, boxes[:, 4], 0.5), [32999])